@@ -32,6 +32,14 @@ setup(
     
     data_files  = [('', ['src/__main__.py', ]), ],
     
+    # os.scandir is in the standard library since Python 3.5.
+    install_requires = ['scandir; python_version < "3.5"', ],
+    # AsyncDaemon and coroutine factories of nmapps.injection use the
+    # trollius backport of asyncio on Python 2.
+    extras_require = {
+        'async': ['trollius; python_version < "3.4"', ],
+    },
+    
     test_suite = 'nmapps.tests',
     
     classifiers = [
@@ -1,15 +1,28 @@
 # src/nmapps/app.py
 
+import os
 import sys
 import os.path as path
 import errno
+import time
+import glob
+import select
 import argparse
+import traceback
+import json
 import logging
 
+from nmapps.control import ControlException, send_command
+from nmapps.shared import SharedState, SharedException
+
 
 LOGGER = logging.getLogger(__name__)
 
 
+def format_time(timestamp):
+    return time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(timestamp))
+
+
 def guess_app_basename(fallback = None):
     if len(sys.argv) < 1 or len(sys.argv[0]) < 1:
         return fallback
@@ -62,11 +75,206 @@ class CommandApp(AppBase):
         print "Unknown command: %s %s" % (cmd, " ".join(args), )
 
 
+def parse_instance_index(pidfile, fallback):
+    """
+    Returns the instance index from a PID file path like name.3.pid (see
+    Daemon.instance_pidfile()), or the fallback.
+    """
+    root = path.splitext(pidfile)[0]
+    suffix = path.splitext(root)[1][1:]
+    if suffix.isdigit():
+        return int(suffix)
+    return fallback
+
+
 class DaemonControlApp(CommandApp):
+    """
+    Controls a daemon, or a set of its instances selected by
+    ``--instances N`` (PID files name.0.pid to name.N-1.pid) or
+    ``--pidfiles GLOB`` (existing PID files). A command runs for at most
+    ``--parallel`` instances at once, each in a child process, and the
+    results are printed once all of them finish. restart is rolling: at
+    most ``--max-unavailable`` instances restart at once and no more
+    instances are restarted after one fails to start again.
+    """
+    
     def __init__(self, daemon):
         CommandApp.__init__(self, daemon.name)
         self.daemon = daemon
     
+    def setup_args(self, parser):
+        CommandApp.setup_args(self, parser)
+        parser.add_argument("--instances", type = int, metavar = "N",
+                            help = "control N instances of the daemon")
+        parser.add_argument("--pidfiles", metavar = "GLOB",
+                            help = "control the instances with matching PID files")
+        parser.add_argument("--parallel", type = int, default = 8, metavar = "N",
+                            help = "instances controlled at once (default 8)")
+        parser.add_argument("--max-unavailable", type = int, default = 1, metavar = "N",
+                            help = "instances restarted at once (default 1)")
+    
+    def _run(self):
+        if self.daemon.inheriting:
+            # Executed as a new generation of the running daemon
+            # (see cmd_reload), whatever the command.
+            self.daemon.inherited_instance().start()
+            return
+        
+        instances = self.get_instances()
+        if instances is None:
+            CommandApp._run(self)
+            return
+        if not instances:
+            print "No PID files match %s. Exiting." % (self.args.pidfiles, )
+            sys.exit(1)
+        self.run_instances(instances)
+    
+    def get_instances(self):
+        """
+        Returns the list of daemon instances selected by the arguments, or
+        None.
+        """
+        if self.args.pidfiles:
+            pidfiles = sorted(glob.glob(self.args.pidfiles))
+            return [self.daemon.instance(parse_instance_index(pidfile, index), pidfile)
+                    for index, pidfile in enumerate(pidfiles)]
+        if self.args.instances:
+            return [self.daemon.instance(index) for index in range(self.args.instances)]
+        return None
+    
+    def run_instances(self, instances):
+        command = (self.args.cmd or "").lower().replace("-", "_")
+        handler = getattr(self, "cmd_" + command, None)
+        if handler is None:
+            self.handle_unknown_command(command, self.args.cmd_args)
+            return
+        
+        rolling = command == "restart"
+        if rolling:
+            limit = self.args.max_unavailable
+        else:
+            limit = self.args.parallel
+        
+        results = self.map_instances(instances, handler, command, self.args.cmd_args,
+                                     max(limit, 1), stop_on_failure = rolling)
+        
+        counts = {"OK": 0, "FAILED": 0, "SKIPPED": 0, }
+        for daemon, status, elapsed, output in results:
+            if status is None:
+                result = "SKIPPED"
+                print "[%s] %s" % (daemon.pidfile.path, result, )
+            else:
+                result = "OK" if status == 0 else "FAILED"
+                print "[%s] %s in %.3f s" % (daemon.pidfile.path, result, elapsed, )
+            counts[result] += 1
+            for line in output.splitlines():
+                print "    %s" % (line, )
+        
+        print "%d instances: %d OK, %d failed, %d skipped." % (
+            len(results), counts["OK"], counts["FAILED"], counts["SKIPPED"], )
+        if counts["FAILED"] or counts["SKIPPED"]:
+            sys.exit(1)
+    
+    def map_instances(self, instances, handler, command, args, limit,
+                      stop_on_failure = False):
+        """
+        Runs the command handler for every instance in a child process, at
+        most limit at once. Returns a list of (daemon, exit status, seconds,
+        output) tuples in the order of the instances, with the status None
+        for the instances skipped after a failure (with stop_on_failure).
+        """
+        pending = list(instances)
+        # PID -> [daemon, output pipe, output chunks, start time]
+        running = {}
+        results = {}
+        failed = False
+        
+        while pending or running:
+            while pending and len(running) < limit and not (failed and stop_on_failure):
+                daemon = pending.pop(0)
+                # Otherwise the child, and any daemon it starts, would keep
+                # the output pipes of the other children open.
+                pid, fd = self.fork_instance(daemon, handler, command, args,
+                                             [info[1] for info in running.values()])
+                running[pid] = [daemon, fd, [], time.time()]
+            if not running:
+                break
+            
+            fds = dict([(info[1], pid) for pid, info in running.items()
+                        if info[1] is not None])
+            try:
+                readable, _, _ = select.select(fds.keys(), [], [])
+            except (select.error, OSError, IOError) as e:
+                if e.args[0] == errno.EINTR:
+                    continue
+                raise
+            
+            for fd in readable:
+                info = running[fds[fd]]
+                chunk = os.read(fd, 4096)
+                if chunk:
+                    info[2].append(chunk)
+                    continue
+                # The output is complete, the child is exiting.
+                os.close(fd)
+                pid = fds[fd]
+                status = os.waitpid(pid, 0)[1]
+                if os.WIFSIGNALED(status):
+                    status = -os.WTERMSIG(status)
+                else:
+                    status = os.WEXITSTATUS(status)
+                del running[pid]
+                results[info[0].pidfile.path] = (status, time.time() - info[3], "".join(info[2]), )
+                if status != 0:
+                    failed = True
+        
+        return [(daemon, ) + results.get(daemon.pidfile.path, (None, 0.0, "", ))
+                for daemon in instances]
+    
+    def fork_instance(self, daemon, handler, command, args, close_fds = ()):
+        """
+        Forks a child process calling the command handler for the daemon
+        instance with the output redirected to a pipe. Returns the PID of
+        the child and the pipe. The child closes the close_fds descriptors.
+        """
+        r, w = os.pipe()
+        sys.stdout.flush()
+        sys.stderr.flush()
+        pid = os.fork()
+        if pid > 0:
+            os.close(w)
+            return pid, r
+        
+        child = os.getpid()
+        status = 1
+        try:
+            os.close(r)
+            for fd in close_fds:
+                os.close(fd)
+            os.dup2(w, sys.stdout.fileno())
+            os.dup2(w, sys.stderr.fileno())
+            os.close(w)
+            self.daemon = daemon
+            handler(command, args)
+            status = 0
+        except SystemExit as e:
+            if e.code is None:
+                status = 0
+            elif isinstance(e.code, int):
+                status = e.code
+            else:
+                print e.code
+        except Exception:
+            traceback.print_exc()
+        finally:
+            sys.stdout.flush()
+            sys.stderr.flush()
+            if os.getpid() == child:
+                os._exit(status)
+        # The daemon started by the handler (see Daemon.daemonize()) exits
+        # the usual way, running the atexit handlers.
+        sys.exit(status)
+    
     def cmd_start(self, cmd, args):
         pidfile = self.daemon.pidfile
         pid = pidfile.read()
@@ -86,32 +294,183 @@ class DaemonControlApp(CommandApp):
             return
         
         print "Starting daemon..."
-        self.daemon.start()
+        self.daemon.start(self.parse_timeout(args))
+    
+    def parse_timeout(self, args):
+        if len(args) < 1:
+            return None
+        try:
+            return float(args[0])
+        except ValueError:
+            print "Invalid timeout: %s" % (args[0], )
+            sys.exit(1)
     
     def cmd_stop(self, cmd, args):
+        timeout = self.parse_timeout(args)
         pid = self.daemon.pidfile.read()
         if pid is None:
             print "Daemon is not running. Exiting."
             return
         print "Stopping daemon..."
-        self.daemon.stop()
+        elapsed = self.daemon.stop(timeout)
+        if elapsed is not None:
+            print "Daemon stopped in %.3f s." % (elapsed, )
+    
+    def cmd_reload(self, cmd, args):
+        """Replaces the running daemon with a new process without closing
+        its listening sockets."""
+        timeout = self.parse_timeout(args)
+        pid = self.daemon.pidfile.read()
+        if pid is None:
+            print "Daemon is not running. Exiting."
+            return
+        print "Reloading daemon..."
+        result = self.daemon.reload(timeout)
+        if result is not None:
+            print "Daemon reloaded in %.3f s, PID %d -> %d." % (result[1], pid, result[0], )
     
     def cmd_restart(self, cmd, args):
+        timeout = self.parse_timeout(args)
         pid = self.daemon.pidfile.read()
         
         if pid is None:
             print "Daemon is not running, starting..."
         else:
             print "Daemon is running, restarting..."
-            self.daemon.stop()
+            elapsed = self.daemon.stop(timeout)
+            if elapsed is not None:
+                print "Daemon stopped in %.3f s." % (elapsed, )
         
         self.daemon.start()
     
+    def print_workers(self, workers):
+        print "Workers (%d):" % (len(workers), )
+        for worker in workers:
+            if worker.get("pid") is None:
+                line = "  #%d: not running" % (worker["index"], )
+            else:
+                line = "  #%d: PID %d" % (worker["index"], worker["pid"], )
+            if worker.get("restarts"):
+                line += ", %d restarts" % (worker["restarts"], )
+            if worker.get("last_failure") is not None:
+                line += ", last failed at %s with status %d" % (
+                    format_time(worker["last_failure"]), worker["last_status"], )
+            print line
+    
+    def print_shared(self):
+        """
+        Prints the totals of the counters and the records shared by the
+        processes of the daemon (see Daemon.shared_counters).
+        """
+        try:
+            shared = SharedState.attach(self.daemon.shared_path)
+        except (IOError, OSError):
+            return
+        except SharedException as e:
+            print "Cannot read the shared state: %s" % (e, )
+            return
+        try:
+            snapshot = shared.snapshot()
+        finally:
+            shared.close()
+        
+        if snapshot["counters"]:
+            print "Counters:"
+            for name, value in sorted(snapshot["counters"].items()):
+                print "  %s: %d" % (name, value, )
+        if snapshot["records"]:
+            print "Records:"
+            for name, values in sorted(snapshot["records"].items()):
+                print "  %s: %s" % (name, ", ".join([str(value) for value in values]), )
+    
     def cmd_status(self, cmd, arg):
         pid = self.daemon.pidfile.read()
         if pid is None:
             print "Daemon is not running."
+            
+            state = self.daemon.read_state()
+            if state is not None and state.get("gave_up") is not None:
+                print "It was stopped at %s after its workers crashed repeatedly." % (
+                    format_time(state["gave_up"]), )
+                self.print_workers(state.get("workers", []))
         else:
             print "Daemon is running with PID %d." % (pid, )
+            
+            state = self.daemon.read_state()
+            if state is not None and state.get("pid") == pid:
+                self.print_workers(state.get("workers", []))
+            
+            self.print_shared()
+            
+            if self.daemon.control_path is not None:
+                try:
+                    uptime = send_command(self.daemon.control_path, "uptime")
+                    print "Uptime: %.1f s" % (uptime, )
+                except ControlException as e:
+                    print "Control socket is not available: %s" % (e, )
+    
+    def control(self, command, args = ()):
+        """
+        Sends a command to the control socket of the running daemon,
+        returns its result or exits on failure.
+        """
+        if self.daemon.control_path is None:
+            print "The daemon has no control socket. Exiting."
+            sys.exit(1)
+        try:
+            return send_command(self.daemon.control_path, command, args)
+        except ControlException as e:
+            print "Control command %s failed: %s" % (command, e, )
+            sys.exit(1)
+    
+    def cmd_ctl(self, cmd, args):
+        """ctl COMMAND [ARGS...] - sends any command to the control socket."""
+        if len(args) < 1:
+            print "Usage: ctl COMMAND [ARGS...]"
+            sys.exit(1)
+        result = self.control(args[0], args[1:])
+        print json.dumps(result, indent = 2, sort_keys = True)
+    
+    def cmd_uptime(self, cmd, args):
+        print "%.1f s" % (self.control("uptime"), )
+    
+    def cmd_loglevel(self, cmd, args):
+        print self.control("loglevel", args[:1])
+    
+    def cmd_metrics(self, cmd, args):
+        """metrics [COUNT] - prints the last COUNT resource usage samples
+        and the percentiles of all the stored samples."""
+        count = 10
+        if len(args) > 0:
+            try:
+                count = int(args[0])
+            except ValueError:
+                print "Invalid count: %s" % (args[0], )
+                sys.exit(1)
+        
+        columns = [("rss", "RSS MB", 1.0 / (1024 * 1024)), ("cpu", "CPU %", 1),
+                   ("fds", "FDs", 1), ("ctx_switches", "CS/s", 1),
+                   ("gc_count", "GC", 1), ("gc_garbage", "Garbage", 1), ]
+        
+        def cell(value, scale):
+            if value is None:
+                return "%10s" % ("-", )
+            return "%10.1f" % (value * scale, )
+        
+        metrics = self.control("metrics", [count])
+        for name, process in sorted(metrics.items()):
+            print "%s (PID %d):" % (name, process["pid"], )
+            print "  %-8s" % ("", ) + "".join(["%10s" % (title, ) for field, title, scale in columns])
+            for sample in process["samples"]:
+                print "  %-8s" % (time.strftime("%H:%M:%S", time.localtime(sample["time"])), ) + \
+                    "".join([cell(sample[field], scale) for field, title, scale in columns])
+            summary = process["summary"]
+            for stat in ("p50", "p90", "p99", "max", ):
+                print "  %-8s" % (stat, ) + \
+                    "".join([cell(summary[field].get(stat), scale) for field, title, scale in columns])
+    
+    def cmd_flush(self, cmd, args):
+        self.control("flush")
+        print "Caches flushed."
 
 
@@ -0,0 +1,248 @@
+# src/nmapps/control.py
+
+"""
+Local control channel of running daemons.
+
+The server listens on a unix socket. Clients send one JSON object per line
+(``{"command": "uptime", "args": []}``) and the server replies with one JSON
+object per line, either ``{"ok": true, "result": ...}`` or
+``{"ok": false, "error": "..."}``. A connection can carry any number of
+requests.
+"""
+
+import os
+import errno
+import fcntl
+import socket
+import select
+import threading
+import json
+import logging
+
+from nmapps.utils import UserException
+
+
+__all__ = ["ControlException", "ControlServer", "send_command", ]
+
+
+LOGGER = logging.getLogger(__name__)
+
+
+class ControlException(UserException):
+    pass
+
+
+class ControlServer(object):
+    """
+    Serves control requests on a unix socket from a background thread.
+    
+    All the sockets are non-blocking and multiplexed by select(), so a slow
+    client can't stall the server and the server never blocks the thread
+    calling start(). The handler is called (in the server thread) with the
+    command name and the list of arguments and its return value is sent
+    back to the client.
+    
+    The socket is accessible only to the owner (``mode = 0600``), as any
+    client can control the daemon, regardless of the umask (daemons run
+    with the umask 0).
+    """
+    
+    # Maximal size of a single request.
+    max_request = 64 * 1024
+    
+    def __init__(self, path, handler, logger = LOGGER, mode = 0600):
+        self.path = path
+        self.mode = mode
+        self.handler = handler
+        self.logger = logger
+        
+        self.socket = None
+        self.inode = None
+        self.thread = None
+        self.wakeup = None
+        self.stopped = False
+    
+    def __repr__(self):
+        return "%s(%r)" % (type(self).__name__, self.path, )
+    
+    def start(self):
+        try:
+            os.remove(self.path)
+        except OSError as e:
+            if e.errno != errno.ENOENT:
+                raise
+        
+        self.socket = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.socket.setblocking(0)
+        # Created with the mode right away, so no other user can connect
+        # before a chmod.
+        umask = os.umask(0777 & ~self.mode)
+        try:
+            self.socket.bind(self.path)
+        finally:
+            os.umask(umask)
+        os.chmod(self.path, self.mode)
+        self.socket.listen(16)
+        self.inode = os.stat(self.path).st_ino
+        
+        self.wakeup = os.pipe()
+        for fd in self.wakeup:
+            fcntl.fcntl(fd, fcntl.F_SETFD,
+                        fcntl.fcntl(fd, fcntl.F_GETFD) | fcntl.FD_CLOEXEC)
+        self.stopped = False
+        
+        self.thread = threading.Thread(target = self.serve,
+                                       name = "nmapps.control")
+        self.thread.daemon = True
+        self.thread.start()
+    
+    def stop(self):
+        if self.thread is None:
+            return
+        self.stopped = True
+        os.write(self.wakeup[1], "x")
+        self.thread.join(5.0)
+        self.thread = None
+        
+        self.detach()
+        # The socket file may have been replaced by another server.
+        try:
+            if os.stat(self.path).st_ino == self.inode:
+                os.remove(self.path)
+        except OSError:
+            pass
+    
+    def detach(self):
+        """
+        Closes the sockets without removing the socket file. Forked
+        children call this.
+        """
+        if self.socket is not None:
+            self.socket.close()
+            self.socket = None
+        if self.wakeup is not None:
+            for fd in self.wakeup:
+                os.close(fd)
+            self.wakeup = None
+        self.thread = None
+    
+    def serve(self):
+        listener = self.socket
+        wakeup = self.wakeup[0]
+        # client socket -> [input buffer, output buffer]
+        clients = {}
+        
+        while not self.stopped:
+            readable = [listener, wakeup] + clients.keys()
+            writable = [client for client, buffers in clients.iteritems()
+                        if buffers[1]]
+            try:
+                readable, writable, _ = select.select(readable, writable, [], 1.0)
+            except (select.error, OSError, IOError) as e:
+                if e.args[0] == errno.EINTR:
+                    continue
+                raise
+            
+            for client in writable:
+                buffers = clients[client]
+                try:
+                    sent = client.send(buffers[1])
+                    buffers[1] = buffers[1][sent:]
+                except socket.error as e:
+                    if e.args[0] not in (errno.EAGAIN, errno.EWOULDBLOCK, ):
+                        self.drop(clients, client)
+            
+            for sock in readable:
+                if sock is listener:
+                    self.accept(clients)
+                elif sock is wakeup:
+                    os.read(wakeup, 512)
+                elif sock in clients:
+                    self.receive(clients, sock)
+        
+        for client in clients.keys():
+            self.drop(clients, client)
+    
+    def accept(self, clients):
+        try:
+            client, address = self.socket.accept()
+        except socket.error as e:
+            if e.args[0] in (errno.EAGAIN, errno.EWOULDBLOCK, errno.EINTR, ):
+                return
+            raise
+        client.setblocking(0)
+        clients[client] = ["", ""]
+    
+    def drop(self, clients, client):
+        clients.pop(client, None)
+        try:
+            client.close()
+        except socket.error:
+            pass
+    
+    def receive(self, clients, client):
+        try:
+            data = client.recv(4096)
+        except socket.error as e:
+            if e.args[0] not in (errno.EAGAIN, errno.EWOULDBLOCK, errno.EINTR, ):
+                self.drop(clients, client)
+            return
+        if not data:
+            self.drop(clients, client)
+            return
+        
+        buffers = clients[client]
+        buffers[0] += data
+        while "\n" in buffers[0]:
+            line, buffers[0] = buffers[0].split("\n", 1)
+            buffers[1] += json.dumps(self.handle(line)) + "\n"
+        if len(buffers[0]) > self.max_request:
+            self.drop(clients, client)
+    
+    def handle(self, line):
+        try:
+            request = json.loads(line)
+            command = request["command"]
+            args = request.get("args", [])
+        except (ValueError, KeyError, TypeError, AttributeError):
+            return {"ok": False, "error": "Malformed request."}
+        
+        try:
+            return {"ok": True, "result": self.handler(command, args)}
+        except UserException as e:
+            return {"ok": False, "error": str(e)}
+        except Exception as e:
+            self.logger.exception("Control command %r failed.", command)
+            return {"ok": False, "error": str(e) or type(e).__name__}
+
+
+def send_command(path, command, args = (), timeout = 5.0):
+    """
+    Sends a command to the control server listening on the path, returns
+    its result. Raises ControlException if the server can't be reached or
+    the command fails.
+    """
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    sock.settimeout(timeout)
+    try:
+        try:
+            sock.connect(path)
+            sock.sendall(json.dumps({"command": command, "args": list(args)}) + "\n")
+            data = ""
+            while not data.endswith("\n"):
+                chunk = sock.recv(4096)
+                if not chunk:
+                    break
+                data += chunk
+        except (socket.error, socket.timeout) as e:
+            raise ControlException(msg = "Cannot talk to %s: %s" % (path, e, ))
+    finally:
+        sock.close()
+    
+    try:
+        response = json.loads(data)
+    except ValueError:
+        raise ControlException(msg = "Malformed response from %s." % (path, ))
+    if not response.get("ok"):
+        raise ControlException(msg = response.get("error") or "Command failed.")
+    return response.get("result")
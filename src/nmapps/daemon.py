@@ -1,73 +1,458 @@
 # -*- coding: utf8 -*-
 
 import os, sys, time, atexit
+import copy
 import signal
+import select
+import socket
+import threading
+import errno
+import fcntl
+import json
 import logging
+import ctypes
+import platform
+import multiprocessing
+
+try:
+    import asyncio
+except ImportError:
+    try:
+        import trollius as asyncio
+    except ImportError:
+        asyncio = None
 
 from nmapps.utils import UserException
+from nmapps.control import ControlServer
+from nmapps.logs import LogWriter, QueueHandler
+from nmapps.scheduler import Scheduler, Job, Interval, Cron
+from nmapps.metrics import ResourceSampler
+from nmapps.resources import ResourceProfile, ResourceException, libc
+from nmapps.shared import SharedState
 
 
-__all__ = ["PIDFile", "Daemon", ]
+__all__ = ["PIDFile", "RestartPolicy", "Daemon", "AsyncDaemon",
+           "Scheduler", "Job", "Interval", "Cron", "ResourceProfile",
+           "SharedState", ]
 
 
 LOGGER = logging.getLogger(__name__)
 
 
+# Environment variables passed to the next generation of a daemon by
+# Daemon.spawn_generation().
+READY_FD_ENV = "NMAPPS_READY_FD"
+LISTEN_FDS_ENV = "NMAPPS_LISTEN_FDS"
+INSTANCE_ENV = "NMAPPS_INSTANCE"
+
+# Exit status of a worker which failed to set up (EX_CONFIG of sysexits.h),
+# the master doesn't restart it.
+EXIT_WORKER_SETUP = 78
+
+# Number of the pidfd_open system call on Linux (Python 2 has no
+# os.pidfd_open).
+PIDFD_OPEN_SYSCALLS = {
+    "x86_64": 434, "amd64": 434,
+    "i386": 434, "i486": 434, "i586": 434, "i686": 434,
+    "aarch64": 434, "arm64": 434,
+    "armv7l": 434, "armv6l": 434,
+    "ppc64": 434, "ppc64le": 434,
+    "s390x": 434,
+}
+
+
 class DaemonException(UserException):
     pass
 
 
+class StopDaemon(SystemExit):
+    """
+    Raised by the SIGTERM handler of Daemon.execute() to stop run().
+    """
+    pass
+
+
+def write_file_atomic(path, data):
+    """Writes the data to a temporary file and renames it to the path, so
+    that readers never see a partially written file."""
+    tmp_path = "%s.%d.tmp" % (path, os.getpid(), )
+    with file(tmp_path, 'w') as f:
+        f.write(data)
+    os.rename(tmp_path, path)
+
+
+def set_inheritable(fd, inheritable = True):
+    flags = fcntl.fcntl(fd, fcntl.F_GETFD)
+    if inheritable:
+        flags &= ~fcntl.FD_CLOEXEC
+    else:
+        flags |= fcntl.FD_CLOEXEC
+    fcntl.fcntl(fd, fcntl.F_SETFD, flags)
+
+
+def close_fds(keep = ()):
+    """Closes all the file descriptors except the standard ones and those
+    in keep."""
+    try:
+        fds = [int(fd) for fd in os.listdir("/proc/self/fd")]
+    except OSError:
+        try:
+            fds = range(os.sysconf("SC_OPEN_MAX"))
+        except (ValueError, OSError):
+            fds = range(1024)
+    for fd in fds:
+        if fd > 2 and fd not in keep:
+            try:
+                os.close(fd)
+            except OSError:
+                pass
+
+
+def read_ready(fd, timeout):
+    """
+    Waits for a readiness notification written by Daemon.notify_ready() or
+    Daemon.notify_error() to the pipe. Returns an (ok, message) tuple.
+    """
+    deadline = time.time() + timeout
+    data = ""
+    while not data.endswith("\n"):
+        remaining = deadline - time.time()
+        if remaining <= 0:
+            return False, "Timed out after %.1f s." % (timeout, )
+        try:
+            readable, _, _ = select.select([fd], [], [], remaining)
+        except (select.error, OSError, IOError) as e:
+            if e.args[0] == errno.EINTR:
+                continue
+            raise
+        if not readable:
+            continue
+        chunk = os.read(fd, 4096)
+        if not chunk:
+            break
+        data += chunk
+    
+    status, _, message = data.strip().partition(" ")
+    if status == "READY":
+        return True, message
+    if status == "ERROR":
+        return False, message or "Failed to start."
+    return False, "Exited before becoming ready."
+
+
+def cpu_count():
+    try:
+        return multiprocessing.cpu_count()
+    except NotImplementedError:
+        return 1
+
+
+def set_nonblocking(fd):
+    flags = fcntl.fcntl(fd, fcntl.F_GETFL)
+    fcntl.fcntl(fd, fcntl.F_SETFL, flags | os.O_NONBLOCK)
+
+
+def same_address(family, bound, address):
+    """Compares the address a socket is bound to with the requested one."""
+    if family == socket.AF_UNIX:
+        return bound == address
+    host, port = address[:2]
+    bound_host, bound_port = bound[:2]
+    if host in ("", "0.0.0.0", "::", ):
+        host = ""
+    if bound_host in ("", "0.0.0.0", "::", ):
+        bound_host = ""
+    return port == bound_port and host == bound_host
+
+
+def process_exists(pid):
+    """Returns True if the process is running (zombies don't count)."""
+    try:
+        os.kill(pid, 0)
+    except OSError as e:
+        if e.errno == errno.ESRCH:
+            return False
+        if e.errno != errno.EPERM:
+            raise
+    
+    try:
+        with file("/proc/%d/stat" % (pid, ), 'r') as f:
+            stat = f.read()
+    except IOError:
+        return True
+    # The state follows the parenthesized command name.
+    return stat[stat.rfind(")") + 2:][:1] != "Z"
+
+
+def pidfd_open(pid):
+    """Returns a file descriptor of the process, which becomes readable when
+    the process exits, see pidfd_open(2). Raises OSError, with ENOSYS where
+    it is not supported."""
+    if hasattr(os, "pidfd_open"):
+        return os.pidfd_open(pid)
+    number = PIDFD_OPEN_SYSCALLS.get(platform.machine().lower())
+    if number is None:
+        raise OSError(errno.ENOSYS, os.strerror(errno.ENOSYS))
+    try:
+        fd = libc().syscall(number, pid, 0)
+    except (OSError, AttributeError):
+        # No libc.
+        raise OSError(errno.ENOSYS, os.strerror(errno.ENOSYS))
+    if fd < 0:
+        error = ctypes.get_errno()
+        raise OSError(error, os.strerror(error))
+    return fd
+
+
+def wait_for_exit(pid, timeout):
+    """Waits until the process exits, returns False if it is still running
+    after the timeout (in seconds).
+    
+    On Linux 5.3+ the exit is awaited on a process file descriptor (see
+    pidfd_open()). Otherwise the process is polled with an exponentially
+    growing interval."""
+    deadline = time.time() + timeout
+    try:
+        fd = pidfd_open(pid)
+    except OSError as e:
+        if e.errno == errno.ESRCH:
+            return True
+        if e.errno != errno.ENOSYS:
+            raise
+    else:
+        try:
+            poller = select.poll()
+            poller.register(fd, select.POLLIN)
+            while True:
+                try:
+                    return len(poller.poll(max(0, deadline - time.time()) * 1000)) > 0
+                except select.error as e:
+                    if e.args[0] != errno.EINTR:
+                        raise
+        finally:
+            os.close(fd)
+    
+    delay = 0.001
+    while process_exists(pid):
+        remaining = deadline - time.time()
+        if remaining <= 0:
+            return False
+        time.sleep(min(delay, remaining))
+        delay = min(delay * 2, 0.05)
+    return True
+
+
 class PIDFile(object):
+    """
+    PID file guarded by an exclusive flock(2) lock.
+    
+    The process owning the PID file keeps the lock on an open descriptor
+    for its whole lifetime, so a PID file left behind by a crashed process
+    is recognized as stale because nobody holds its lock. The PID is always
+    written to a temporary file which is locked and then renamed over the
+    path, so readers never see a partially written file.
+    """
+    
+    # Readers hold a shared lock for a moment while checking the PID file,
+    # which can make a single attempt to take the lock fail.
+    lock_attempts = 5
+    lock_retry_delay = 0.01
+    
     @property
     def exists(self):
-        return os.path.exists(self.path)
+        """True if the PID file is locked by a running process."""
+        return self.read() is not None
+    
+    @property
+    def locked(self):
+        """True if the PID file is locked by this process."""
+        return self.fd is not None
     
     def __init__(self, path):
         self.path = path
         self.locked_pid = None
+        self.fd = None
     
     def __repr__(self):
         return "%s(%r)" % (type(self).__name__, self.path, )
     
+    def _same_file(self, fd):
+        try:
+            st = os.stat(self.path)
+        except OSError:
+            return False
+        fst = os.fstat(fd)
+        return (st.st_dev, st.st_ino) == (fst.st_dev, fst.st_ino)
+    
+    def _try_lock(self, fd, operation = fcntl.LOCK_EX):
+        try:
+            fcntl.flock(fd, operation | fcntl.LOCK_NB)
+        except (IOError, OSError) as e:
+            if e.errno in (errno.EWOULDBLOCK, errno.EAGAIN, ):
+                return False
+            raise
+        return True
+    
+    def _open_locked(self, create = True):
+        """
+        Opens the PID file and locks it exclusively. Returns the
+        descriptor, or None if the file is locked by another process (or
+        doesn't exist and create is False).
+        """
+        flags = os.O_RDWR
+        if create:
+            flags |= os.O_CREAT
+        
+        while True:
+            try:
+                fd = os.open(self.path, flags, 0644)
+            except OSError as e:
+                if e.errno == errno.ENOENT and not create:
+                    return None
+                raise
+            
+            try:
+                locked = self._try_lock(fd)
+            except:
+                os.close(fd)
+                raise
+            if not locked:
+                os.close(fd)
+                return None
+            
+            # The previous owner may have removed or replaced the file
+            # between our open() and flock(), in that case try again.
+            if self._same_file(fd):
+                return fd
+            os.close(fd)
+    
     def lock(self):
-        pid = self.read()
-        if pid:
+        """
+        Takes the PID file for this process. Returns False if it is locked
+        by another process.
+        """
+        if self.fd is not None:
+            return True
+        
+        for attempt in range(self.lock_attempts):
+            fd = self._open_locked()
+            if fd is not None:
+                break
+            time.sleep(self.lock_retry_delay)
+        else:
             return False
         
-        self.write()
+        # Other processes can't take the lock of the old file before the
+        # new file is renamed over it.
+        try:
+            self.write()
+        finally:
+            os.close(fd)
         return True
     
     def unlock(self):
+        """
+        Removes the PID file and releases the lock. When called by a process
+        not holding the lock, only removes a stale PID file.
+        """
+        fd = self.fd
+        if fd is None:
+            try:
+                fd = self._open_locked(create = False)
+            except OSError:
+                fd = None
+            if fd is None:
+                return
+        
         try:
-            os.remove(self.path)
-        except IOError:
+            if self._same_file(fd):
+                os.remove(self.path)
+        except OSError:
             sys.stderr.write("Failed to remove the PID file lock.\n")
-        self.locked_pid = None
+        finally:
+            os.close(fd)
+            self.fd = None
+            self.locked_pid = None
 
     def unlock_at_exit(self):
         atexit.register(self.unlock)
     
+    def detach(self):
+        """
+        Closes this process' descriptor of the PID file without removing it.
+        Forked children call this so that the lock reflects only the
+        process which took it.
+        """
+        if self.fd is not None:
+            os.close(self.fd)
+            self.fd = None
+    
     def write(self, pid = None):
+        """
+        Atomically replaces the PID file with a new one, locked by this
+        process, containing the PID (this process' PID by default).
+        
+        Doesn't check whether the PID file is locked by another process,
+        use lock() for that.
+        """
         if not pid:
-            pid = str(os.getpid())
-        with file(self.path, 'w+') as f:
-            f.write("%s\n" % (pid, ))
+            pid = os.getpid()
+        pid = int(pid)
+        
+        tmp_path = "%s.%d.tmp" % (self.path, os.getpid(), )
+        fd = os.open(tmp_path, os.O_RDWR | os.O_CREAT | os.O_TRUNC, 0644)
+        try:
+            fcntl.fcntl(fd, fcntl.F_SETFD,
+                        fcntl.fcntl(fd, fcntl.F_GETFD) | fcntl.FD_CLOEXEC)
+            self._try_lock(fd)
+            os.write(fd, "%d\n" % (pid, ))
+            os.rename(tmp_path, self.path)
+        except:
+            os.close(fd)
+            try:
+                os.remove(tmp_path)
+            except OSError:
+                pass
+            raise
+        
+        if self.fd is not None:
+            os.close(self.fd)
+        self.fd = fd
         self.locked_pid = pid
     
     def read(self):
+        """
+        Returns the PID of the process holding the PID file, or None if the
+        PID file doesn't exist or is stale.
+        """
+        if self.fd is not None:
+            return self.locked_pid
+        
         try:
-            with file(self.path, 'r') as f:
-                pid = int(f.read().strip())
-            self.locked_pid = pid
-            return pid
-        except IOError:
+            fd = os.open(self.path, os.O_RDONLY)
+        except OSError:
             return None
+        
+        try:
+            if self._try_lock(fd, fcntl.LOCK_SH):
+                # Nobody holds the lock, the PID file is stale.
+                return None
+            data = os.read(fd, 64)
+        finally:
+            os.close(fd)
+        
+        try:
+            pid = int(data.strip())
+        except ValueError:
+            return None
+        self.locked_pid = pid
+        return pid
     
     def test_write(self):
         try:
-            self.lock()
-            self.unlock()
-        except IOError as e:
+            if self.lock():
+                self.unlock()
+        except (IOError, OSError) as e:
             return e.errno
         return None
     
@@ -78,6 +463,54 @@ class PIDFile(object):
         return cls(unicode(value))
 
 
+class RestartPolicy(object):
+    """
+    Decides when the master restarts a worker which exited.
+    
+    A worker which ran for at least reset_after seconds is restarted
+    immediately. Otherwise its exit counts as a consecutive failure and the
+    worker is restarted after a delay growing by factor with every failure
+    (delay, delay * factor, ...) up to max_delay. After more than
+    max_failures consecutive failures (a crash loop), the master gives up
+    and stops. max_failures = None never gives up.
+    """
+    
+    def __init__(self, delay = 0.1, factor = 2.0, max_delay = 30.0,
+                 reset_after = 30.0, max_failures = 10):
+        self.delay = delay
+        self.factor = factor
+        self.max_delay = max_delay
+        self.reset_after = reset_after
+        self.max_failures = max_failures
+    
+    def __repr__(self):
+        return "%s(delay = %r, factor = %r, max_delay = %r, reset_after = %r, max_failures = %r)" % (
+            type(self).__name__, self.delay, self.factor, self.max_delay,
+            self.reset_after, self.max_failures, )
+    
+    def failed(self, uptime, failures):
+        """
+        Returns the number of consecutive failures after a worker, which
+        already failed the given number of times, exited after uptime
+        seconds.
+        """
+        if uptime >= self.reset_after:
+            return 0
+        return failures + 1
+    
+    def gives_up(self, failures):
+        return self.max_failures is not None and failures > self.max_failures
+    
+    def next_delay(self, failures):
+        """
+        Returns the number of seconds to wait before restarting a worker
+        after the given number of consecutive failures.
+        """
+        if failures <= 0:
+            return 0.0
+        return min(self.max_delay, self.delay * self.factor ** (failures - 1))
+
+
 class Daemon(object):
     """
     A generic daemon class.
@@ -86,11 +519,157 @@ class Daemon(object):
     http://www.jejik.com/articles/2007/02/a_simple_unix_linux_daemon_in_python/
     
     Usage: subclass the Daemon class and override the run() method
+    
+    In the prefork mode (``prefork = True``), the daemon process becomes a
+    master, which keeps the PID file and forks ``workers`` worker processes
+    (by default one per CPU), each calling run(). The master respawns
+    workers which exit, forwards SIGTERM and SIGHUP to them and records
+    them in the state file (see read_state()).
+    
+    In the supervise mode (``supervise = True``), the daemon process
+    becomes a master of a single worker (or of the prefork workers), so
+    run() raising an exception or the worker crashing doesn't take the
+    service down. Workers are restarted according to restart_policy (see
+    RestartPolicy), the restart counts and the last failures are recorded
+    in the state file and shown by DaemonControlApp's status command. When
+    run() of a supervised daemon returns normally, the daemon stops.
+    
+    With control_socket set (to a path, or to True for the PID file path
+    with the ".sock" suffix), the daemon serves control commands on a unix
+    socket (see nmapps.control). A command "foo" is handled by the
+    control_foo() method. In the prefork and the supervise modes the
+    socket is served by the master, which forwards the "loglevel" and
+    "flush" commands to the workers (see forward_command()).
+    
+    On SIGUSR2 (see reload()) the daemon re-executes its program as a new
+    generation, which inherits the listening sockets created by listen()
+    in setup_listeners(). Once the new generation reports it is ready (see
+    notify_ready()), it takes over the PID file and the old generation
+    closes its listening sockets (see drain()) and shuts down by SIGTERM.
+    So the listening sockets never stop accepting connections.
+    
+    Periodic jobs are added to the scheduler (see nmapps.scheduler) in
+    setup_jobs() or later from run(). Instead of sleeping in a loop, run()
+    should call wait(), which returns True as soon as SIGTERM is received:
+        
+        def run(self):
+            while not self.wait(5.0):
+                self.poll()
+    
+    SIGTERM received while run() is not in wait() raises StopDaemon in
+    run(), unless run() called wait() before (and so checks its result).
     """
     
     name = "python_daemon"
     
-    def __init__(self, pidfile = None, stdin='/dev/null', stdout='/dev/null', stderr='/dev/null', logger = LOGGER):
+    prefork = False
+    workers = None
+    
+    # Minimal lifetime of a worker, workers exiting sooner are respawned
+    # only after this delay. Used unless restart_policy is set.
+    respawn_delay = 1.0
+    
+    supervise = False
+    # RestartPolicy of the master, RestartPolicy() by default in the
+    # supervise mode.
+    restart_policy = None
+    
+    control_socket = None
+    
+    # With log_queue_size set, logging calls only enqueue the records, which
+    # are written by a background thread (see nmapps.logs). The log file is
+    # rotated by size (log_max_bytes) and time (log_rotate_interval seconds)
+    # and reopened on SIGHUP. When the queue is full, records are dropped
+    # (log_overflow = "drop") or the logging call waits ("block").
+    log_queue_size = None
+    log_overflow = LogWriter.DROP
+    log_max_bytes = None
+    log_rotate_interval = None
+    log_backup_count = 5
+    log_level = logging.INFO
+    
+    # Seconds start() waits for the daemon to become ready.
+    start_timeout = 30.0
+    # Seconds the old generation waits for the new one to become ready.
+    reload_timeout = 30.0
+    # Notify readiness right before calling run(). Set to False and call
+    # notify_ready() from run() when the initialization done in run() takes
+    # a while. In the prefork and supervise modes, the daemon is ready once
+    # its first worker is.
+    auto_ready = True
+    
+    # Number of threads running the jobs of the scheduler.
+    scheduler_workers = 4
+    
+    # With metrics_interval set, the process serving the control socket
+    # samples its resource usage (and the usage of its workers) every
+    # metrics_interval seconds and keeps the last metrics_capacity samples
+    # (see nmapps.metrics and the "metrics" control command).
+    metrics_interval = None
+    metrics_capacity = 360
+    
+    # ResourceProfile (CPU affinity, resource limits, nice and ionice)
+    # applied right after the double fork. The daemon doesn't start if it
+    # can't be applied.
+    resource_profile = None
+    
+    # Names of integer counters and record name -> struct format mapping of
+    # the state shared by the processes of the daemon (see nmapps.shared).
+    # The memory is mapped (self.shared) before the workers are forked, so
+    # every process updates it without IPC, e.g.
+    # ``self.shared.incr("requests")``. The status command of
+    # DaemonControlApp shows the totals. The state belongs to a generation
+    # of the daemon, so the counters start from zero after a reload.
+    shared_counters = ()
+    shared_records = None
+    
+    # Seconds stop() waits after SIGTERM before sending SIGKILL.
+    stop_timeout = 10.0
+    # Seconds stop() waits for the process to disappear after SIGKILL.
+    kill_timeout = 5.0
+    
+    @property
+    def log_path(self):
+        return "/var/log/%s.log" % (self.name, )
+    
+    @property
+    def state_path(self):
+        return "%s.state" % (self.pidfile.path, )
+    
+    @property
+    def shared_path(self):
+        return "%s.shm" % (self.pidfile.path, )
+    
+    @property
+    def reload_path(self):
+        """File where a failed reload is reported to reload()."""
+        return "%s.reload" % (self.pidfile.path, )
+    
+    @property
+    def inheriting(self):
+        """True in a new generation started by spawn_generation()."""
+        return READY_FD_ENV in os.environ
+    
+    def inherited_instance(self):
+        """
+        Returns the instance (see instance()) a new generation started by
+        spawn_generation() replaces, or the daemon itself.
+        """
+        spec = os.environ.pop(INSTANCE_ENV, None)
+        if not spec:
+            return self
+        index, pidfile = spec.split(":", 1)
+        return self.instance(int(index), pidfile)
+    
+    @property
+    def control_path(self):
+        if self.control_socket is True:
+            return "%s.sock" % (self.pidfile.path, )
+        return self.control_socket or None
+    
+    def __init__(self, pidfile = None, stdin='/dev/null', stdout='/dev/null', stderr='/dev/null', logger = LOGGER,
+                 prefork = None, workers = None, control_socket = None,
+                 supervise = None, restart_policy = None, resource_profile = None):
         if pidfile is None:
             pidfile = "/var/run/%s.pid" % (self.name, )
         self.pidfile = PIDFile.normalize(pidfile)
@@ -100,27 +679,121 @@ class Daemon(object):
         self.stderr = stderr
         
         self.logger = logger
+        
+        if prefork is not None:
+            self.prefork = prefork
+        if workers is not None:
+            self.workers = workers
+        if control_socket is not None:
+            self.control_socket = control_socket
+        if supervise is not None:
+            self.supervise = supervise
+        if restart_policy is not None:
+            self.restart_policy = restart_policy
+        if resource_profile is not None:
+            self.resource_profile = resource_profile
+        
+        # Index of the instance created by instance().
+        self.instance_index = None
+        self.worker_index = None
+        self.worker_pids = {}
+        # Worker index -> restart statistics (see run_master()).
+        self.worker_stats = {}
+        # Worker index -> the write end of its command pipe (see
+        # forward_command()), guarded by command_lock.
+        self.command_pipes = {}
+        self.command_lock = threading.Lock()
+        self.started_at = None
+        self.control = None
+        
+        self.argv = None
+        self.listeners = []
+        self.inherited = []
+        self.ready_fd = None
+        self.reloading = False
+        self.log_writer = None
+        
+        self.scheduler = None
+        self.samplers = {}
+        self.shared = None
+        self.stopping = False
+        # Self-pipe waking wait() up (see request_stop()).
+        self.stop_pipe = None
+        self.waits = False
+    
+    def instance_pidfile(self, index):
+        """
+        Returns the PID file path of the index-th instance, e.g.
+        /var/run/name.3.pid for /var/run/name.pid.
+        """
+        root, ext = os.path.splitext(self.pidfile.path)
+        return "%s.%d%s" % (root, index, ext, )
+    
+    def instance(self, index, pidfile = None):
+        """
+        Returns a copy of the (not yet started) daemon running as another
+        instance, with its own PID file (and so its own state file and
+        control socket, unless control_socket is a fixed path).
+        """
+        result = copy.copy(self)
+        result.instance_index = index
+        result.pidfile = PIDFile.normalize(pidfile or self.instance_pidfile(index))
+        result.worker_pids = {}
+        result.worker_stats = {}
+        result.listeners = []
+        result.inherited = []
+        result.samplers = {}
+        result.shared = None
+        return result
     
     def setup_logging(self):
-        log_file = "/var/log/%s.log" % (self.name, )
-        logging.basicConfig(filename = log_file, level = logging.INFO)
+        if not self.log_queue_size:
+            logging.basicConfig(filename = self.log_path, level = self.log_level)
+            return
+        
+        self.log_writer = LogWriter(self.log_path,
+                                    queue_size = self.log_queue_size,
+                                    overflow = self.log_overflow,
+                                    max_bytes = self.log_max_bytes,
+                                    backup_count = self.log_backup_count,
+                                    rotate_interval = self.log_rotate_interval)
+        self.log_writer.start()
+        atexit.register(self.log_writer.stop)
+        
+        handler = QueueHandler(self.log_writer)
+        handler.setFormatter(logging.Formatter(logging.BASIC_FORMAT))
+        root = logging.getLogger()
+        root.addHandler(handler)
+        root.setLevel(self.log_level)
     
-    def daemonize(self):
+    def daemonize(self, timeout = None):
         """
         do the UNIX double-fork magic, see Stevens' "Advanced 
         Programming in the UNIX Environment" for details (ISBN 0201563177)
         http://www.erlenstar.demon.co.uk/unix/faq_2.html#SEC16
+        
+        The original process waits until the daemon reports it is ready
+        (see notify_ready()) or fails and exits with the corresponding
+        status, see wait_ready().
         """
+        started = time.time()
+        ready_r, ready_w = os.pipe()
+        
         # do the first fork
         try: 
             pid = os.fork() 
             if pid > 0:
-                # exit first parent
-                sys.exit(0) 
+                # exit first parent once the daemon is ready
+                os.close(ready_w)
+                self.wait_ready(ready_r, started, timeout)
         except OSError, e: 
             sys.stderr.write("fork #1 failed: %d (%s)\n" % (e.errno, e.strerror))
             sys.exit(1)
         
+        os.close(ready_r)
+        set_inheritable(ready_w, False)
+        self.ready_fd = ready_w
+        
         # decouple from parent environment
         os.chdir("/") 
         os.setsid() 
@@ -133,9 +806,15 @@ class Daemon(object):
                 # exit from second parent
                 sys.exit(0) 
         except OSError, e: 
-            sys.stderr.write("fork #2 failed: %d (%s)\n" % (e.errno, e.strerror))
+            self.notify_error("fork #2 failed: %d (%s)" % (e.errno, e.strerror))
             sys.exit(1) 
         
+        try:
+            self.apply_resources()
+        except ResourceException as e:
+            self.notify_error("Cannot apply the resource profile: %s" % (e, ))
+            sys.exit(1)
+        
         # redirect standard file descriptors
         sys.stdout.flush()
         sys.stderr.flush()
@@ -147,40 +826,935 @@ class Daemon(object):
         os.dup2(se.fileno(), sys.stderr.fileno())
         
         # write pidfile
-        self.pidfile.lock()
+        if not self.pidfile.lock():
+            self.notify_error("PID file %s is locked by another process." % (
+                self.pidfile.path, ))
+            sys.exit(1)
         self.pidfile.unlock_at_exit()
     
-    def start(self):
+    def wait_ready(self, fd, started, timeout = None):
+        """
+        Waits (in the process which called start()) for the readiness
+        notification from the daemon, reports the time it took to start
+        and exits with status 0, or 1 if the daemon failed to start (or
+        didn't report readiness in the timeout, start_timeout by default).
+        """
+        if timeout is None:
+            timeout = self.start_timeout
+        ok, message = read_ready(fd, timeout)
+        os.close(fd)
+        if ok:
+            sys.stdout.write("Daemon started in %.3f s with PID %s.\n" % (
+                time.time() - started, message, ))
+            sys.exit(0)
+        sys.stderr.write("Daemon failed to start: %s\n" % (message, ))
+        sys.exit(1)
+    
+    def apply_resources(self):
+        if self.resource_profile is not None:
+            self.resource_profile.apply()
+    
+    def start(self, timeout = None):
         """
         Start the daemon
+        
+        Returns (and exits) in the calling process once the daemon is ready,
+        see daemonize().
         """
-        # Check for a pidfile to see if the daemon already runs
-        if self.pidfile.read():
-            sys.stderr.write(
-                "PID file %s already exists. "
-                "It seems that the daemon is already "
-                "running with PID %d." % (self.pidfile.path, self.pidfile.locked_pid, ))
-            sys.exit(1)
+        # The program is executed again by spawn_generation(), after
+        # daemonize() changed the working directory.
+        self.argv = [sys.executable] + sys.argv
+        if len(sys.argv) > 0 and os.path.exists(sys.argv[0]):
+            self.argv[1] = os.path.abspath(sys.argv[0])
         
-        # Start the daemon
-        self.daemonize()
+        if self.inheriting:
+            self.inherit()
+            try:
+                self.apply_resources()
+            except ResourceException as e:
+                self.notify_error("Cannot apply the resource profile: %s" % (e, ))
+                sys.exit(1)
+        else:
+            # Check for a pidfile to see if the daemon already runs
+            if self.pidfile.read():
+                sys.stderr.write(
+                    "PID file %s already exists. "
+                    "It seems that the daemon is already "
+                    "running with PID %d." % (self.pidfile.path, self.pidfile.locked_pid, ))
+                sys.exit(1)
+            
+            # Start the daemon
+            self.daemonize(timeout)
         
         try:
             self.setup_logging()
         except Exception:
             self.logger.exception("Exception occured while setting up logging.")
         
+        self.started_at = time.time()
         self.logger.info("Daemon started.")
         
+        signal.signal(signal.SIGUSR2, lambda signum, frame: self.request_reload())
+        signal.siginterrupt(signal.SIGUSR2, False)
+        
         try:
-            self.run()
-            self.logger.info("Daemon stopped.")
+            self.create_shared()
+        except Exception as e:
+            self.logger.exception("Exception occured while creating the shared state.")
+            self.notify_error("Cannot create the shared state: %s" % (e, ))
+            raise
+        try:
+            # A new generation takes over the control socket of the old
+            # one only once it is ready (see notify_ready()).
+            if self.pidfile.locked:
+                self.start_control()
+        except Exception as e:
+            self.logger.exception("Exception occured while starting the control server.")
+            self.notify_error(str(e))
+            self.remove_shared()
+            raise
+        try:
+            try:
+                self.setup_listeners()
+            except Exception as e:
+                self.logger.exception("Exception occured while setting up listeners.")
+                self.notify_error(str(e))
+                raise
+            for sock in self.inherited:
+                self.logger.warning("Closing unused inherited socket %r.",
+                                    sock.getsockname())
+                sock.close()
+            self.inherited = []
+            
+            if self.prefork or self.supervise:
+                self.run_master()
+            else:
+                self.execute()
+        finally:
+            self.stop_control()
+            self.remove_shared()
+    
+    def worker_count(self):
+        """
+        Returns the number of workers run_master() runs.
+        """
+        if self.prefork:
+            return self.workers or cpu_count()
+        return 1
+    
+    def create_shared(self):
+        """
+        Maps the shared state (see shared_counters), with a slot of
+        counters for the daemon process and each of its workers.
+        """
+        if not self.shared_counters and not self.shared_records:
+            return
+        slots = 1
+        if self.prefork or self.supervise:
+            slots += self.worker_count()
+        shared = SharedState(self.shared_counters, self.shared_records,
+                             slots, self.shared_path)
+        # A new generation replaces the file of the old one only once it
+        # is ready (see notify_ready()).
+        self.shared = shared.create(publish = self.pidfile.locked)
+    
+    def remove_shared(self):
+        if self.shared is not None:
+            self.shared.remove()
+            self.shared = None
+    
+    def inherit(self):
+        """
+        Takes the readiness pipe and listening sockets passed by the
+        previous generation of the daemon (see spawn_generation()).
+        """
+        self.ready_fd = int(os.environ.pop(READY_FD_ENV))
+        
+        specs = os.environ.pop(LISTEN_FDS_ENV, "")
+        for spec in specs.split(","):
+            if not spec:
+                continue
+            fd, family, type = [int(x) for x in spec.split(":")]
+            sock = socket.fromfd(fd, family, type)
+            os.close(fd)
+            self.inherited.append(sock)
+    
+    def setup_listeners(self):
+        """
+        Called before run() (before the workers are forked in the prefork
+        mode). Override to create the listening sockets by listen().
+        """
+        pass
+    
+    def listen(self, address, family = None, type = socket.SOCK_STREAM, backlog = 128):
+        """
+        Returns a listening socket bound to the address. A socket inherited
+        from the previous generation of the daemon is reused if it is bound
+        to the same address.
+        """
+        if family is None:
+            if isinstance(address, basestring):
+                family = socket.AF_UNIX
+            elif ":" in address[0]:
+                family = socket.AF_INET6
+            else:
+                family = socket.AF_INET
+        
+        for sock in self.inherited:
+            if sock.family == family and \
+                    same_address(family, sock.getsockname(), address):
+                self.inherited.remove(sock)
+                self.listeners.append(sock)
+                return sock
+        
+        sock = socket.socket(family, type)
+        if family == socket.AF_UNIX:
+            try:
+                os.remove(address)
+            except OSError:
+                pass
+        else:
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        sock.bind(address)
+        sock.listen(backlog)
+        self.listeners.append(sock)
+        return sock
+    
+    def notify_ready(self):
+        """
+        Reports that the daemon is ready to the process waiting for it.
+        Called automatically before run() unless auto_ready is False.
+        """
+        if self.ready_fd is None:
+            return
+        if not self.pidfile.locked and self.worker_index is None:
+            # A new generation takes over the PID file, the control socket
+            # and the shared state file of the old one.
+            self.pidfile.write()
+            self.pidfile.unlock_at_exit()
+            self.start_control()
+            if self.shared is not None:
+                try:
+                    self.shared.publish()
+                except OSError as e:
+                    self.logger.error("Cannot publish the shared state %s: %s",
+                                      self.shared_path, e)
+        self._notify("READY %d" % (os.getpid(), ))
+    
+    def notify_error(self, message):
+        """
+        Reports that the daemon failed to start to the process waiting for
+        it.
+        """
+        self._notify("ERROR %s" % (" ".join(message.split()), ))
+    
+    def _notify(self, line):
+        if self.ready_fd is None:
+            return
+        fd, self.ready_fd = self.ready_fd, None
+        try:
+            os.write(fd, line + "\n")
+        except OSError as e:
+            self.logger.warning("Failed to notify readiness: %s", e)
+        finally:
+            os.close(fd)
+    
+    def request_reload(self):
+        """
+        Starts a new generation of the daemon in a background thread (see
+        spawn_generation()). Called on SIGUSR2.
+        """
+        if self.reloading:
+            self.logger.warning("Reload is already in progress.")
+            return
+        self.reloading = True
+        thread = threading.Thread(target = self.spawn_generation,
+                                  name = "nmapps.daemon.reload")
+        thread.daemon = True
+        thread.start()
+    
+    def spawn_generation(self):
+        """
+        Executes a new generation of the daemon, passing it the listening
+        sockets. When the new generation becomes ready, drains this one and
+        shuts it down by SIGTERM. Otherwise keeps running.
+        """
+        try:
+            started = time.time()
+            ready_r, ready_w = os.pipe()
+            
+            env = dict(os.environ)
+            env[READY_FD_ENV] = str(ready_w)
+            env[LISTEN_FDS_ENV] = ",".join([
+                "%d:%d:%d" % (sock.fileno(), sock.family, sock.type)
+                for sock in self.listeners])
+            if self.instance_index is not None:
+                env[INSTANCE_ENV] = "%d:%s" % (self.instance_index, self.pidfile.path, )
+            keep = [ready_w] + [sock.fileno() for sock in self.listeners]
+            
+            self.logger.info("Starting a new generation: %s", " ".join(self.argv))
+            pid = os.fork()
+            if pid == 0:
+                try:
+                    close_fds(keep)
+                    for fd in keep:
+                        set_inheritable(fd)
+                    os.execve(self.argv[0], self.argv, env)
+                finally:
+                    os._exit(127)
+            
+            os.close(ready_w)
+            try:
+                ok, message = read_ready(ready_r, self.reload_timeout)
+            finally:
+                os.close(ready_r)
+            
+            if not ok:
+                self.logger.error("New generation (PID %d) failed: %s", pid, message)
+                try:
+                    os.kill(pid, signal.SIGTERM)
+                    if not wait_for_exit(pid, self.stop_timeout):
+                        os.kill(pid, signal.SIGKILL)
+                    os.waitpid(pid, 0)
+                except OSError:
+                    # Already reaped by run_master().
+                    pass
+                write_file_atomic(self.reload_path, json.dumps({
+                    "pid": os.getpid(), "error": message, }))
+                return
+            
+            self.logger.info("New generation (PID %d) is ready after %.3f s, "
+                             "shutting down.", pid, time.time() - started)
+            self.drain()
+            os.kill(os.getpid(), signal.SIGTERM)
         except Exception:
-            self.logger.exception("Exception occured in the daemon's run() method.")
+            self.logger.exception("Exception occured while reloading.")
+        finally:
+            self.reloading = False
+    
+    def drain(self):
+        """
+        Called in the old generation once the new one is ready. Closes the
+        listening sockets, so that new connections are accepted only by
+        the new generation. Override to stop accepting in other ways.
+        """
+        for sock in self.listeners:
+            sock.close()
+        self.listeners = []
+    
+    def execute(self):
+        """
+        Calls run() in the current process, returns False if it raised an
+        exception.
+        """
+        signal.signal(signal.SIGHUP, lambda signum, frame: self.handle_hangup())
+        signal.siginterrupt(signal.SIGHUP, False)
+        self.open_stop_pipe()
+        signal.signal(signal.SIGTERM, lambda signum, frame: self.handle_term())
+        
+        self.start_scheduler()
+        try:
+            if self.auto_ready:
+                self.notify_ready()
+            
+            try:
+                self.run()
+            except StopDaemon:
+                pass
+            except Exception as e:
+                self.logger.exception("Exception occured in the daemon's run() method.")
+                # In case run() failed before calling notify_ready().
+                self.notify_error("run() failed: %s: %s" % (type(e).__name__, e, ))
+                return False
+            self.logger.info("Daemon stopped.")
+            return True
+        finally:
+            self.stop_scheduler()
+    
+    def handle_term(self):
+        self.request_stop()
+        if not self.waits:
+            raise StopDaemon()
+    
+    def open_stop_pipe(self):
+        if self.stop_pipe is None:
+            self.stop_pipe = os.pipe()
+            for fd in self.stop_pipe:
+                set_nonblocking(fd)
+                set_inheritable(fd, False)
+    
+    def request_stop(self):
+        """
+        Makes wait() return True and stops scheduling the jobs. Safe to
+        call from signal handlers and other threads (it takes no locks).
+        """
+        self.stopping = True
+        if self.stop_pipe is not None:
+            try:
+                os.write(self.stop_pipe[1], "x")
+            except OSError as e:
+                if e.errno != errno.EAGAIN:
+                    raise
+        if self.scheduler is not None:
+            self.scheduler.stop(wait = False)
+    
+    def wait(self, timeout = None):
+        """
+        Waits for the timeout (in seconds) or until the daemon is stopped.
+        Returns True if the daemon should stop.
+        """
+        self.waits = True
+        self.open_stop_pipe()
+        if timeout is not None:
+            deadline = time.time() + timeout
+        while not self.stopping:
+            if timeout is not None:
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    break
+            else:
+                remaining = None
+            try:
+                select.select([self.stop_pipe[0]], [], [], remaining)
+            except (select.error, OSError, IOError) as e:
+                if e.args[0] != errno.EINTR:
+                    raise
+        return self.stopping
+    
+    def setup_jobs(self, scheduler):
+        """
+        Called before run() (in every worker in the prefork mode). Override
+        to add periodic jobs, e.g. ``scheduler.every(60.0, self.cleanup)``.
+        """
+        pass
+    
+    def start_scheduler(self):
+        self.scheduler = Scheduler(self.scheduler_workers, logger = self.logger)
+        self.setup_jobs(self.scheduler)
+        if self.metrics_interval and self.worker_index is None:
+            self.sample_resources()
+            self.scheduler.every(self.metrics_interval, self.sample_resources,
+                                 name = "metrics")
+        self.scheduler.start()
+    
+    def stop_scheduler(self):
+        if self.scheduler is not None:
+            self.scheduler.stop()
+            self.scheduler = None
+    
+    def handle_hangup(self):
+        if self.log_writer is not None:
+            self.log_writer.reopen()
+        self.on_hangup()
+    
+    def on_hangup(self):
+        """
+        Called when the process receives SIGHUP. Override to reload
+        configuration and similar.
+        """
+        self.logger.info("Received SIGHUP.")
+    
+    def flush_caches(self):
+        """
+        Called by the "flush" control command (from a background thread,
+        in the master and in every worker in the prefork and the supervise
+        modes). Override to drop the caches of the daemon.
+        """
+        self.logger.info("Flushing caches.")
+    
+    def start_control(self):
+        path = self.control_path
+        if path is None:
+            return
+        self.control = ControlServer(path, self.handle_control, self.logger)
+        try:
+            self.control.start()
+        except (IOError, OSError) as e:
+            self.logger.error("Cannot listen on the control socket %s: %s", path, e)
+            self.control = None
+    
+    def stop_control(self):
+        if self.control is not None:
+            self.control.stop()
+            self.control = None
+    
+    def handle_control(self, command, args):
+        handler = getattr(self, "control_" + str(command), None)
+        if handler is None:
+            raise DaemonException(msg = "Unknown command %s." % (command, ))
+        return handler(*args)
+    
+    def control_status(self):
+        return {
+            "name": self.name,
+            "pid": os.getpid(),
+            "uptime": self.control_uptime(),
+            "prefork": bool(self.prefork),
+            "supervise": bool(self.supervise),
+            "workers": self.control_workers(),
+            "shared": self.control_shared(),
+        }
+    
+    def control_uptime(self):
+        if self.started_at is None:
+            return None
+        return time.time() - self.started_at
+    
+    def control_workers(self):
+        """
+        Returns a list of the workers, including the ones waiting to be
+        restarted (with the PID None).
+        """
+        pids = dict([(index, pid) for pid, index in self.worker_pids.items()])
+        result = []
+        for index in sorted(set(pids) | set(self.worker_stats)):
+            worker = dict(self.worker_stats.get(index, {}))
+            worker["index"] = index
+            worker["pid"] = pids.get(index)
+            result.append(worker)
+        return result
+    
+    def control_shared(self):
+        """
+        Returns the totals of the shared counters and the shared records
+        (see shared_counters), or None.
+        """
+        if self.shared is None:
+            return None
+        return self.shared.snapshot()
+    
+    def control_loglevel(self, level = None):
+        """
+        Returns the level of the root logger, sets it first if given (in
+        the workers too, see forward_command()).
+        """
+        logger = logging.getLogger()
+        if level is not None:
+            if str(level).isdigit():
+                level = int(level)
+            else:
+                level = str(level).upper()
+            logger.setLevel(level)
+            self.logger.info("Log level set to %s.", logging.getLevelName(logger.level))
+            self.forward_command("loglevel", [level])
+        return logging.getLevelName(logger.level)
+    
+    def control_metrics(self, count = 10):
+        """
+        Returns the last count resource usage samples and the summary of
+        all the stored samples of the daemon process and its workers.
+        """
+        if not self.metrics_interval:
+            raise DaemonException(msg = "Resource sampling is disabled (metrics_interval).")
+        result = {}
+        for name, sampler in sorted(self.samplers.items()):
+            result[name] = {
+                "pid": sampler.pid or os.getpid(),
+                "samples": sampler.samples(int(count)),
+                "summary": sampler.summary(),
+            }
+        return result
+    
+    def sample_resources(self):
+        """
+        Samples the resource usage of the current process and its workers.
+        """
+        processes = {"daemon": None}
+        for pid, index in self.worker_pids.items():
+            processes["worker-%d" % (index, )] = pid
+        
+        for name, pid in processes.items():
+            sampler = self.samplers.get(name)
+            if sampler is None or sampler.pid != pid:
+                # A new sampler for a respawned worker.
+                sampler = ResourceSampler(self.metrics_capacity, pid)
+                self.samplers[name] = sampler
+            sampler.sample()
+    
+    def control_flush(self):
+        self.flush_caches()
+        self.forward_command("flush")
+        return True
+    
+    def forward_command(self, command, args = ()):
+        """
+        Sends the control command to the running workers, which apply it
+        in order (see read_commands()). Does nothing outside the master.
+        Raises DaemonException if a worker can't take the command.
+        """
+        line = json.dumps({"command": command, "args": list(args)}) + "\n"
+        failed = []
+        with self.command_lock:
+            for index, fd in sorted(self.command_pipes.items()):
+                try:
+                    os.write(fd, line)
+                except OSError as e:
+                    if e.errno not in (errno.EAGAIN, errno.EPIPE):
+                        raise
+                    failed.append(str(index))
+        if failed:
+            raise DaemonException(msg = "The command %s did not reach the workers %s." % (
+                command, ", ".join(failed), ))
+    
+    def read_commands(self, fd):
+        """
+        Applies the control commands forwarded by the master (see
+        forward_command()) in a worker until the master closes the pipe.
+        """
+        with os.fdopen(fd, "r") as f:
+            for line in iter(f.readline, ""):
+                try:
+                    request = json.loads(line)
+                    self.handle_control(request["command"], request["args"])
+                except Exception:
+                    self.logger.exception("Failed to apply the control command %r.",
+                                          line)
+    
+    def control_reload(self):
+        """
+        Reloads the daemon the same way SIGHUP does (see on_hangup()).
+        """
+        os.kill(os.getpid(), signal.SIGHUP)
+        return True
+    
+    def get_restart_policy(self):
+        if self.restart_policy is not None:
+            return self.restart_policy
+        if self.supervise:
+            return RestartPolicy()
+        return RestartPolicy(delay = self.respawn_delay, factor = 1.0,
+                             max_delay = self.respawn_delay,
+                             reset_after = self.respawn_delay,
+                             max_failures = None)
+    
+    def run_master(self):
+        """
+        Runs the master process of the prefork or the supervise mode until
+        SIGTERM is received (or the workers crash too often, see
+        RestartPolicy, or a worker can't apply the resource profile) and
+        all the workers exit. Returns False if the master gave up
+        restarting the workers.
+        """
+        count = self.worker_count()
+        policy = self.get_restart_policy()
+        self.logger.info("Starting %d workers.", count)
+        
+        received = []
+        def handler(signum, frame):
+            received.append(signum)
+        
+        wakeup_r, wakeup_w = os.pipe()
+        set_nonblocking(wakeup_r)
+        set_nonblocking(wakeup_w)
+        signal.set_wakeup_fd(wakeup_w)
+        for signum in (signal.SIGTERM, signal.SIGHUP, signal.SIGCHLD):
+            signal.signal(signum, handler)
+        
+        self.worker_pids = {}
+        self.worker_stats = dict([
+            (index, {"restarts": 0, "failures": 0,
+                     "last_failure": None, "last_status": None, })
+            for index in range(count)])
+        started = {}
+        spawn_at = dict([(index, 0) for index in range(count)])
+        stopping = False
+        gave_up = False
+        # Readiness pipes of the workers (see read_worker_ready()) -> index.
+        ready_pipes = {}
+        # The state file belongs to the old generation until a new one is
+        # ready (see notify_ready()).
+        dirty = False
+        sample_at = time.time()
+        
+        try:
+            while True:
+                changed = False
+                for pid, index, status in self.reap_workers():
+                    changed = True
+                    self.close_command_pipe(index)
+                    if stopping:
+                        self.logger.info("Worker %d (PID %d) exited with status %d.",
+                                         index, pid, status)
+                        continue
+                    
+                    now = time.time()
+                    stats = self.worker_stats[index]
+                    stats["last_status"] = status
+                    if status == 0 and not self.prefork:
+                        self.logger.info("Worker %d (PID %d) finished.", index, pid)
+                        stopping = True
+                        self.signal_workers(signal.SIGTERM)
+                        continue
+                    
+                    if status == EXIT_WORKER_SETUP:
+                        self.logger.error("Worker %d failed to set up, giving up.", index)
+                        self.notify_error("Worker %d failed to set up, see the log." % (
+                            index, ))
+                        stopping = gave_up = True
+                        self.signal_workers(signal.SIGTERM)
+                        continue
+                    
+                    self.logger.warning("Worker %d (PID %d) exited with status %d.",
+                                        index, pid, status)
+                    stats["last_failure"] = now
+                    stats["failures"] = policy.failed(now - started.pop(index, 0),
+                                                      stats["failures"])
+                    if policy.gives_up(stats["failures"]):
+                        self.logger.error("Worker %d failed %d times in a row, giving up.",
+                                          index, stats["failures"])
+                        self.notify_error("Worker %d failed %d times in a row." % (
+                            index, stats["failures"], ))
+                        stopping = gave_up = True
+                        self.signal_workers(signal.SIGTERM)
+                        continue
+                    
+                    delay = policy.next_delay(stats["failures"])
+                    if delay > 0:
+                        self.logger.info("Restarting worker %d in %.1f s.", index, delay)
+                    spawn_at[index] = now + delay
+                    stats["restarts"] += 1
+                
+                timeout = 1.0
+                if not stopping:
+                    now = time.time()
+                    for index, at in sorted(spawn_at.items()):
+                        if at <= now:
+                            del spawn_at[index]
+                            ready_r, ready_w = os.pipe()
+                            command_r, command_w = os.pipe()
+                            set_inheritable(command_w, False)
+                            set_nonblocking(command_w)
+                            try:
+                                self.spawn_worker(index, ready_w, command_r,
+                                                  [wakeup_r, wakeup_w, ready_r, command_w]
+                                                  + ready_pipes.keys()
+                                                  + self.command_pipes.values())
+                            except:
+                                os.close(command_w)
+                                raise
+                            finally:
+                                os.close(ready_w)
+                                os.close(command_r)
+                            ready_pipes[ready_r] = index
+                            with self.command_lock:
+                                self.command_pipes[index] = command_w
+                            started[index] = now
+                            changed = True
+                        else:
+                            timeout = min(timeout, at - now)
+                elif not self.worker_pids:
+                    break
+                
+                dirty = dirty or changed
+                if dirty and self.pidfile.locked:
+                    self.write_state()
+                    dirty = False
+                
+                if self.metrics_interval:
+                    now = time.time()
+                    if now >= sample_at:
+                        self.sample_resources()
+                        sample_at = now + self.metrics_interval
+                    timeout = min(timeout, max(sample_at - now, 0))
+                
+                try:
+                    readable, _, _ = select.select([wakeup_r] + ready_pipes.keys(),
+                                                   [], [], timeout)
+                except (select.error, OSError, IOError) as e:
+                    if e.args[0] != errno.EINTR:
+                        raise
+                    readable = []
+                for fd in readable:
+                    if fd in ready_pipes:
+                        self.read_worker_ready(fd, ready_pipes.pop(fd))
+                try:
+                    while os.read(wakeup_r, 512):
+                        pass
+                except OSError as e:
+                    if e.errno != errno.EAGAIN:
+                        raise
+                
+                while received:
+                    signum = received.pop(0)
+                    if signum == signal.SIGTERM:
+                        if not stopping:
+                            self.logger.info("Stopping workers.")
+                        stopping = True
+                        self.signal_workers(signal.SIGTERM)
+                    elif signum == signal.SIGHUP:
+                        if self.log_writer is not None:
+                            self.log_writer.reopen()
+                        self.signal_workers(signal.SIGHUP)
+        finally:
+            signal.set_wakeup_fd(-1)
+            for fd in ready_pipes:
+                os.close(fd)
+            for index in self.command_pipes.keys():
+                self.close_command_pipe(index)
+            os.close(wakeup_r)
+            os.close(wakeup_w)
+            # The state file may already belong to the next generation.
+            state = self.read_state()
+            if gave_up and self.pidfile.locked:
+                # Kept for the status command.
+                self.write_state(gave_up = time.time())
+            elif state is not None and state.get("pid") == os.getpid():
+                try:
+                    os.remove(self.state_path)
+                except OSError:
+                    pass
+        
+        self.logger.info("Daemon stopped.")
+        return not gave_up
+    
+    def close_command_pipe(self, index):
+        with self.command_lock:
+            fd = self.command_pipes.pop(index, None)
+            if fd is not None:
+                os.close(fd)
+    
+    def spawn_worker(self, index, ready_fd = None, command_fd = None, close_fds = ()):
+        """
+        Forks the index-th worker, which reports its readiness (see
+        notify_ready()) to ready_fd, reads the forwarded control commands
+        from command_fd (see read_commands()) and closes the close_fds
+        descriptors.
+        """
+        pid = os.fork()
+        if pid == 0:
+            status = 1
+            try:
+                signal.set_wakeup_fd(-1)
+                for fd in close_fds:
+                    os.close(fd)
+                self.pidfile.detach()
+                if self.ready_fd is not None:
+                    os.close(self.ready_fd)
+                self.ready_fd = ready_fd
+                if self.control is not None:
+                    self.control.detach()
+                    self.control = None
+                for signum in (signal.SIGTERM, signal.SIGHUP, signal.SIGCHLD,
+                               signal.SIGUSR2):
+                    signal.signal(signum, signal.SIG_DFL)
+                
+                if self.log_writer is not None:
+                    self.log_writer.after_fork()
+                
+                if self.resource_profile is not None:
+                    try:
+                        self.resource_profile.apply_worker(index)
+                    except ResourceException as e:
+                        self.logger.error("Cannot apply the resource profile to worker %d: %s",
+                                          index, e)
+                        status = EXIT_WORKER_SETUP
+                        return
+                
+                if self.shared is not None:
+                    self.shared.after_fork(index + 1)
+                
+                self.worker_index = index
+                self.worker_pids = {}
+                self.worker_stats = {}
+                self.command_pipes = {}
+                # Might have been held by the control thread of the master.
+                self.command_lock = threading.Lock()
+                if command_fd is not None:
+                    thread = threading.Thread(target = self.read_commands,
+                                              args = (command_fd, ),
+                                              name = "nmapps.daemon.commands")
+                    thread.daemon = True
+                    thread.start()
+                if self.execute():
+                    status = 0
+            finally:
+                # os._exit() skips the atexit handlers.
+                if self.log_writer is not None:
+                    self.log_writer.stop()
+                os._exit(status)
+        
+        self.logger.info("Started worker %d with PID %d.", index, pid)
+        self.worker_pids[pid] = index
+        return pid
     
-    def stop(self):
+    def read_worker_ready(self, fd, index):
+        """
+        Reads the readiness notification of a worker, the daemon is ready
+        once its first worker is.
+        """
+        try:
+            data = os.read(fd, 4096)
+        finally:
+            os.close(fd)
+        if data.startswith("READY"):
+            self.logger.info("Worker %d is ready.", index)
+            self.notify_ready()
+    
+    def reap_workers(self):
+        """
+        Collects exited workers, returns a list of (PID, index, exit status)
+        tuples.
+        """
+        result = []
+        while self.worker_pids:
+            try:
+                pid, status = os.waitpid(-1, os.WNOHANG)
+            except OSError as e:
+                if e.errno == errno.EINTR:
+                    continue
+                if e.errno != errno.ECHILD:
+                    raise
+                pid = 0
+            if pid == 0:
+                break
+            index = self.worker_pids.pop(pid, None)
+            if index is not None:
+                if os.WIFSIGNALED(status):
+                    status = -os.WTERMSIG(status)
+                else:
+                    status = os.WEXITSTATUS(status)
+                result.append((pid, index, status))
+        return result
+    
+    def signal_workers(self, signum):
+        for pid in self.worker_pids:
+            try:
+                os.kill(pid, signum)
+            except OSError as e:
+                if e.errno != errno.ESRCH:
+                    raise
+    
+    def write_state(self, **extra):
+        """
+        Writes the state of the master process (its workers) to the state
+        file.
+        """
+        state = {"pid": os.getpid(), "workers": self.control_workers()}
+        state.update(extra)
+        try:
+            write_file_atomic(self.state_path, json.dumps(state))
+        except (IOError, OSError):
+            self.logger.exception("Failed to write the state file %s.",
+                                  self.state_path)
+    
+    def read_state(self):
+        """
+        Returns the state written by a running master process, or None.
+        """
+        try:
+            with file(self.state_path, 'r') as f:
+                return json.load(f)
+        except (IOError, ValueError):
+            return None
+    
+    def stop(self, timeout = None):
         """
         Stop the daemon
+        
+        Sends SIGTERM once and waits for the daemon to exit. If it is still
+        running after the timeout (stop_timeout by default), it is killed
+        by SIGKILL. Returns the number of seconds the shutdown took, or
+        None if the daemon was not running.
         """
         # Get the pid from the pidfile
         pid = self.pidfile.read()
@@ -189,21 +1763,90 @@ class Daemon(object):
             message = "PID file %s does not exist. " \
                 "It seems the daemon is not running.\n"
             sys.stderr.write(message % self.pidfile)
-            return # not an error in a restart
+            return None # not an error in a restart
+        
+        if timeout is None:
+            timeout = self.stop_timeout
+        
+        started = time.time()
         
-        # Try killing the daemon process    
         try:
-            while 1:
-                os.kill(pid, signal.SIGTERM)
-                time.sleep(0.1)
-        except OSError, err:
-            err = str(err)
-            if err.find("No such process") > 0:
-                if self.pidfile.exists:
-                    self.pidfile.unlock()
-            else:
-                sys.stderr.write(err + "\n")
+            os.kill(pid, signal.SIGTERM)
+            if not wait_for_exit(pid, timeout):
+                sys.stderr.write("Daemon did not stop in %.1f s, killing it.\n" % (
+                    timeout, ))
+                os.kill(pid, signal.SIGKILL)
+                if not wait_for_exit(pid, self.kill_timeout):
+                    sys.stderr.write("Failed to kill the daemon (PID %d).\n" % (pid, ))
+                    sys.exit(1)
+        except OSError as e:
+            if e.errno != errno.ESRCH:
+                sys.stderr.write("%s\n" % (e, ))
                 sys.exit(1)
+        
+        # Removes the PID file if the daemon couldn't (e.g. after SIGKILL).
+        self.pidfile.unlock()
+        
+        return time.time() - started
+    
+    def reload(self, timeout = None):
+        """
+        Reload the daemon without downtime
+        
+        Sends SIGUSR2 to the running daemon and waits until a new generation
+        takes over the PID file. Returns a (new PID, seconds) tuple, or None
+        if the daemon is not running.
+        """
+        pid = self.pidfile.read()
+        if not pid:
+            sys.stderr.write("The daemon is not running.\n")
+            return None
+        
+        if timeout is None:
+            timeout = self.reload_timeout
+        
+        try:
+            os.remove(self.reload_path)
+        except OSError:
+            pass
+        
+        started = time.time()
+        os.kill(pid, signal.SIGUSR2)
+        
+        delay = 0.001
+        while time.time() - started < timeout:
+            new_pid = self.pidfile.read()
+            if new_pid is not None and new_pid != pid:
+                return new_pid, time.time() - started
+            if new_pid is None and not process_exists(pid):
+                break
+            error = self.read_reload_error(pid)
+            if error is not None:
+                try:
+                    os.remove(self.reload_path)
+                except OSError:
+                    pass
+                sys.stderr.write("The daemon was not reloaded: %s\n" % (error, ))
+                sys.exit(1)
+            time.sleep(delay)
+            delay = min(delay * 2, 0.05)
+        
+        sys.stderr.write("The daemon was not reloaded in %.1f s.\n" % (timeout, ))
+        sys.exit(1)
+    
+    def read_reload_error(self, pid):
+        """
+        Returns the error of the last reload of the daemon process reported
+        by spawn_generation(), or None.
+        """
+        try:
+            with file(self.reload_path, 'r') as f:
+                result = json.load(f)
+        except (IOError, ValueError):
+            return None
+        if result.get("pid") != pid:
+            return None
+        return result.get("error")
     
     def restart(self):
         """
@@ -227,18 +1870,107 @@ class Daemon(object):
             raise Exception()
 
 
+class AsyncDaemon(Daemon):
+    """
+    A daemon whose run() method is a coroutine function driven by an
+    asyncio event loop.
+    
+    The event loop is created by execute(), so only after the double fork
+    (and in every worker in the prefork mode). SIGTERM cancels the run()
+    task and stops the scheduler, SIGHUP calls on_hangup(). The uvloop event loop policy is used
+    when uvloop is installed, unless use_uvloop is False. On Python 2 the
+    trollius backport of asyncio is used.
+    """
+    
+    use_uvloop = True
+    
+    def __init__(self, *args, **kwargs):
+        if asyncio is None:
+            raise DaemonException(msg = "AsyncDaemon requires asyncio (or trollius).")
+        Daemon.__init__(self, *args, **kwargs)
+        self.loop = None
+        self.task = None
+    
+    def create_loop(self):
+        if self.use_uvloop:
+            try:
+                import uvloop
+            except ImportError:
+                pass
+            else:
+                asyncio.set_event_loop_policy(uvloop.EventLoopPolicy())
+        loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(loop)
+        return loop
+    
+    def execute(self):
+        self.loop = loop = self.create_loop()
+        try:
+            self.task = asyncio.ensure_future(self.run(), loop = loop)
+            loop.add_signal_handler(signal.SIGTERM, self.handle_term)
+            loop.add_signal_handler(signal.SIGHUP, self.handle_hangup)
+            self.start_scheduler()
+            if self.auto_ready:
+                self.notify_ready()
+            
+            try:
+                loop.run_until_complete(self.task)
+            except asyncio.CancelledError:
+                pass
+            except Exception as e:
+                self.logger.exception("Exception occured in the daemon's run() method.")
+                # In case run() failed before calling notify_ready().
+                self.notify_error("run() failed: %s: %s" % (type(e).__name__, e, ))
+                return False
+            finally:
+                self.cancel_tasks()
+                self.stop_scheduler()
+            
+            self.logger.info("Daemon stopped.")
+            return True
+        finally:
+            loop.remove_signal_handler(signal.SIGTERM)
+            loop.remove_signal_handler(signal.SIGHUP)
+            loop.close()
+            asyncio.set_event_loop(None)
+            self.loop = None
+            self.task = None
+    
+    def handle_term(self):
+        self.request_stop()
+        self.task.cancel()
+    
+    def cancel_tasks(self):
+        """
+        Cancels the tasks left running by run() and waits for them to
+        finish.
+        """
+        all_tasks = getattr(asyncio, "all_tasks", None) or asyncio.Task.all_tasks
+        tasks = [task for task in all_tasks(self.loop) if not task.done()]
+        if not tasks:
+            return
+        for task in tasks:
+            task.cancel()
+        self.loop.run_until_complete(
+            asyncio.gather(*tasks, return_exceptions = True))
+    
+    def run(self):
+        """
+        Override this method with a coroutine function when you subclass
+        AsyncDaemon.
+        """
+        raise NotImplementedError()
+
+
 class TestDaemon(Daemon):
     def __init__(self):
         self.name = "test_python_daemon"
         super(TestDaemon, self).__init__(stdout = "/home/jan/Projects/nmapps/test_daemon.stdout")
     
-    def setup_logging(self):
-        log_file = "/var/log/%s.log" % (self.name, )
-        logging.basicConfig(filename = log_file, level = logging.DEBUG)
+    log_level = logging.DEBUG
     
     def run(self):
-        while True:
-            time.sleep(5)
+        while not self.wait(5):
             sys.stdout.write(str(time.time()) + "\n")
 
 
@@ -3,29 +3,206 @@
 import sys
 import os
 import os.path as path
+import io
+import stat
+import time
+import mmap
+import errno
+import zlib
+import shutil
+import thread
+import fnmatch
 import zipfile
+import threading
+import multiprocessing
+import contextlib
+import collections
+import Queue
 
+from nmapps.utils import ThreadPool
 
-__all__ = ["Path", "File", "Directory", "ZipFile", ]
+try:
+    from os import scandir
+except ImportError:
+    try:
+        from scandir import scandir
+    except ImportError:
+        scandir = None
+
+
+__all__ = ["Path", "File", "Directory", "ZipFile", "Walker", "StatCache",
+           "enable_stat_cache", "disable_stat_cache", ]
+
+
+class StatCache(object):
+    """
+    Process-wide cache of stat results (see enable_stat_cache()), keeping
+    at most ``capacity`` paths and evicting the least recently used ones.
+    With ``ttl`` set, results older than ttl seconds are not used.
+    """
+    
+    def __init__(self, capacity = 10000, ttl = None):
+        self.capacity = capacity
+        self.ttl = ttl
+        # key -> (time, stat result or None)
+        self.entries = collections.OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+    
+    def __repr__(self):
+        return "%s(%d/%d)" % (type(self).__name__, len(self.entries), self.capacity, )
+    
+    def __len__(self):
+        return len(self.entries)
+    
+    def get(self, key):
+        """
+        Returns a (found, stat result or None) tuple.
+        """
+        with self.lock:
+            entry = self.entries.pop(key, None)
+            if entry is None or (self.ttl is not None and
+                                 time.time() - entry[0] >= self.ttl):
+                self.misses += 1
+                return False, None
+            # Moves the entry to the end, the least recently used are first.
+            self.entries[key] = entry
+            self.hits += 1
+            return True, entry[1]
+    
+    def put(self, key, result):
+        with self.lock:
+            self.entries.pop(key, None)
+            self.entries[key] = (time.time(), result)
+            while len(self.entries) > self.capacity:
+                self.entries.popitem(last = False)
+    
+    def invalidate(self, key = None):
+        """
+        Drops the cached result of the key, or all of them.
+        """
+        with self.lock:
+            if key is None:
+                self.entries.clear()
+            else:
+                self.entries.pop((key, True), None)
+                self.entries.pop((key, False), None)
+
+
+STAT_CACHE = None
+
+
+def enable_stat_cache(capacity = 10000, ttl = None):
+    """
+    Makes all the Path objects share their stat results through a
+    StatCache. Use for (mostly) unchanging trees, e.g. when walking large
+    trees on network file systems. Returns the cache.
+    """
+    global STAT_CACHE
+    STAT_CACHE = StatCache(capacity, ttl)
+    return STAT_CACHE
+
+
+def disable_stat_cache():
+    global STAT_CACHE
+    STAT_CACHE = None
+
+
+def stat_or_none(value, follow_symlinks = True, entry = None):
+    try:
+        if entry is not None:
+            return entry.stat(follow_symlinks = follow_symlinks)
+        if follow_symlinks:
+            return os.stat(value)
+        return os.lstat(value)
+    except OSError as e:
+        if e.errno in (errno.ENOENT, errno.ENOTDIR, errno.ELOOP, errno.ENAMETOOLONG, ):
+            return None
+        raise
 
 
 class Path(object):
+    """
+    A file system path.
+    
+    The file type predicates (is_file, is_dir, exists, ...) are derived
+    from a single stat call, whose result the path keeps until refresh()
+    is called, or for ``ttl`` seconds (forever by default). Like the
+    os.path predicates, they are False when stat fails (e.g. with EACCES).
+    With the process-wide stat cache enabled (see enable_stat_cache()),
+    different Path objects of the same path share the result.
+    
+    Paths listed by Directory (see from_entry()) take the file type from
+    the directory entry, without calling stat, until refresh() is called
+    or the ttl expires.
+    """
+    
+    # Default ttl of the cached stat results.
+    stat_ttl = None
+    
     @property
     def is_file(self):
-        return path.isfile(self.value)
+        entry = self.fresh_entry()
+        if entry is not None:
+            try:
+                return entry.is_file()
+            except OSError:
+                return False
+        result = self.try_stat()
+        return result is not None and stat.S_ISREG(result.st_mode)
     
     @property
     def is_dir(self):
-        return path.isdir(self.value)
-
+        entry = self.fresh_entry()
+        if entry is not None:
+            try:
+                return entry.is_dir()
+            except OSError:
+                return False
+        result = self.try_stat()
+        return result is not None and stat.S_ISDIR(result.st_mode)
+    
+    @property
+    def is_link(self):
+        entry = self.fresh_entry()
+        if entry is not None:
+            try:
+                return entry.is_symlink()
+            except OSError:
+                return False
+        result = self.try_stat(False)
+        return result is not None and stat.S_ISLNK(result.st_mode)
+    
     @property
     def is_abs(self):
         return path.isabs(self.value)
     
     @property
     def exists(self):
-        return self.is_file or self.is_dir
-
+        return self.try_stat() is not None
+    
+    @property
+    def mode(self):
+        result = self.stat()
+        if result is None:
+            return None
+        return result.st_mode
+    
+    @property
+    def size(self):
+        result = self.stat()
+        if result is None:
+            return None
+        return result.st_size
+    
+    @property
+    def mtime(self):
+        result = self.stat()
+        if result is None:
+            return None
+        return result.st_mtime
+    
     @property
     def base(self):
         return path.basename(self.value)
@@ -40,7 +217,7 @@ class Path(object):
         if len(parts) > 1:
             return parts[-1]
         return ""
-
+    
     @property
     def base_without_ext(self):
         ext = self.extension
@@ -60,8 +237,16 @@ class Path(object):
     def relative(self):
         return Path(path.relpath(self.value))
     
-    def __init__(self, value):
+    def __init__(self, value, ttl = None):
         self.value = value
+        if ttl is not None:
+            self.stat_ttl = ttl
+        # follow_symlinks -> (time, stat result or None)
+        self._stats = {}
+        # Directory entry returned by scandir (see from_entry()) and the
+        # time it was listed.
+        self.entry = None
+        self.entry_time = None
     
     def __str__(self):
         return str(self.value)
@@ -76,12 +261,75 @@ class Path(object):
         right = Path.make(right)
         return Path(path.join(self.value, right.value))
     
+    def stat(self, follow_symlinks = True):
+        """
+        Returns the (cached) os.stat() result, or os.lstat() result without
+        follow_symlinks, or None if the path doesn't exist. Other errors
+        (e.g. EACCES) raise OSError.
+        """
+        entry = self._stats.get(follow_symlinks)
+        if entry is not None and (self.stat_ttl is None or
+                                  time.time() - entry[0] < self.stat_ttl):
+            return entry[1]
+        
+        cache = STAT_CACHE
+        dir_entry = self.fresh_entry()
+        if dir_entry is not None:
+            # The entry caches the result itself.
+            result = stat_or_none(self.value, follow_symlinks, dir_entry)
+        elif cache is not None:
+            key = (path.abspath(self.value), follow_symlinks, )
+            found, result = cache.get(key)
+            if not found:
+                result = stat_or_none(self.value, follow_symlinks)
+                cache.put(key, result)
+        else:
+            result = stat_or_none(self.value, follow_symlinks)
+        self._stats[follow_symlinks] = (time.time(), result, )
+        return result
+    
+    def lstat(self):
+        return self.stat(False)
+    
+    def try_stat(self, follow_symlinks = True):
+        """
+        Like stat(), but returns None on any error (e.g. EACCES), like the
+        os.path predicates do.
+        """
+        try:
+            return self.stat(follow_symlinks)
+        except OSError:
+            return None
+    
+    def fresh_entry(self):
+        """
+        Returns the directory entry of the path (see from_entry()), or None
+        if there is none or it is older than the ttl (it is dropped then).
+        """
+        entry = self.entry
+        if entry is not None and self.stat_ttl is not None and \
+           time.time() - self.entry_time >= self.stat_ttl:
+            self.entry = entry = None
+        return entry
+    
+    def refresh(self):
+        """
+        Drops the cached stat results, the next query calls stat again.
+        """
+        self._stats = {}
+        self.entry = None
+        self.entry_time = None
+        cache = STAT_CACHE
+        if cache is not None:
+            cache.invalidate(path.abspath(self.value))
+        return self
+    
     def get_parts(self):
         return self.value.split(os.sep)
     
     def iter_parents(self):
         parts = self.real.get_parts()
-
+        
         if str(self.real).startswith(os.sep):
             root = os.sep
         else:
@@ -95,6 +343,16 @@ class Path(object):
     def add_to_import(self):
         sys.path.insert(1, self.abs)
     
+    @classmethod
+    def from_entry(cls, entry):
+        """
+        Makes a Path from a directory entry returned by scandir.
+        """
+        result = cls(entry.path)
+        result.entry = entry
+        result.entry_time = time.time()
+        return result
+    
     @classmethod
     def make(cls, value):
         if isinstance(value, Path):
@@ -110,11 +368,11 @@ class Path(object):
 class File(object):
     @property
     def exists(self):
-        return path.isfile(self.path)
+        return self.path.is_file
     
     @property
     def basename(self):
-        return path.basename(self.path)
+        return self.path.base
     
     @property
     def extension(self):
@@ -129,18 +387,71 @@ class File(object):
     def __str__(self):
         return str(self.path)
     
+    # Default size of the chunks of iter_chunks().
+    CHUNK_SIZE = 1024 * 1024
+    
     def open(self, mode = "r"):
-        return open(self.path.real, mode)
+        return open(str(self.path), mode)
     
     def read(self):
-        c = None
-        try:
-            f = self.open()
-            c = f.read()
-            f.close()
-        except Exception, e:
-            return None
-        return c
+        """
+        Returns the contents of the file. Raises IOError if it can't be
+        read.
+        """
+        with self.open() as f:
+            return f.read()
+    
+    def mmap(self):
+        """
+        Returns a read-only memory mapping of the file, which can be sliced
+        and searched like a string without reading the whole file into
+        memory. Close it when done (contextlib.closing()). Raises
+        ValueError for an empty file, which can't be mapped.
+        """
+        with self.open("rb") as f:
+            return mmap.mmap(f.fileno(), 0, access = mmap.ACCESS_READ)
+    
+    def iter_chunks(self, size = None):
+        """
+        Yields the contents of the file in chunks of at most size bytes
+        (CHUNK_SIZE by default). The chunks are memoryviews of a single
+        buffer, which is overwritten by the next chunk, so copy them
+        (bytes(chunk)) to keep them.
+        """
+        buf = bytearray(size or self.CHUNK_SIZE)
+        view = memoryview(buf)
+        with io.open(str(self.path), "rb", buffering = 0) as f:
+            while True:
+                count = f.readinto(buf)
+                if not count:
+                    return
+                yield view[:count]
+    
+    def readinto(self, buf, offset = 0):
+        """
+        Reads the file from the offset into the buffer (a bytearray or a
+        writable memoryview) until it is full or the end of the file,
+        returns the number of bytes read.
+        """
+        view = memoryview(buf)
+        total = 0
+        with io.open(str(self.path), "rb", buffering = 0) as f:
+            if offset:
+                f.seek(offset)
+            while total < len(view):
+                count = f.readinto(view[total:])
+                if not count:
+                    break
+                total += count
+        return total
+    
+    @classmethod
+    def from_entry(cls, entry):
+        """
+        Makes a File, Directory or ZipFile from a directory entry returned
+        by scandir, using the file type of the entry instead of stat.
+        """
+        return cls.make(Path.from_entry(entry))
     
     @classmethod
     def make(cls, pth):
@@ -158,7 +469,7 @@ class File(object):
 class Directory(File):
     @property
     def exists(self):
-        return path.isdir(self.path)
+        return self.path.is_dir
     
     def __init__(self, pth = os.curdir):
         File.__init__(self, pth)
@@ -167,29 +478,162 @@ class Directory(File):
         return self.iter_list()
     
     def iter_list(self):
-        for f in os.listdir(str(self.path)):
-            yield File.make(self.path + f)
+        if scandir is None:
+            value = str(self.path)
+            for f in os.listdir(value):
+                yield File.make(Path(path.join(value, f)))
+            return
+        for entry in scandir(str(self.path)):
+            yield File.from_entry(entry)
     
     def list(self):
-        files = os.listdir(str(self.path))
-        result = []
-        for f in files:
-            result.append(File.make(self.path + f))
-        return result
+        return list(self.iter_list())
+    
+    def walk(self, include = None, exclude = None, max_depth = None,
+             follow_symlinks = False, zip_files = False, workers = 1,
+             ordered = False, onerror = None):
+        """
+        Yields the files and directories in the tree (without the directory
+        itself), see Walker for the options.
+        """
+        walker = Walker(include, exclude, max_depth, follow_symlinks,
+                        zip_files, workers, ordered, onerror)
+        return walker.walk(self)
 
 
 class ZipFile(File):
+    """
+    A zip archive (also a jar or an egg).
+    
+    The members are found by name in the index of the archive (get()), or
+    listed by directory (list_dir()). They are read through a pool of
+    archive handles, so several threads can read them at once, and at most
+    max_handles idle handles are kept open. Close the archive (or use it
+    as a context manager) to close the handles, it is opened again when
+    needed.
+    """
+    
     EXTENSIONS = set(["zip", "jar", "egg", ])
     
-    def __init__(self, pth):
+    # Maximal number of idle archive handles.
+    max_handles = 4
+    
+    def __init__(self, pth, max_handles = None):
         File.__init__(self, pth)
+        if max_handles is not None:
+            self.max_handles = max_handles
         self._zip_file = None
+        # Directory ("" or "dir/") -> sorted names of its children.
+        self._dirs = None
+        # Idle handles, handles in use and handles in use while the
+        # archive was closed.
+        self._handles = []
+        self._in_use = set()
+        self._stale = set()
+        self._lock = threading.Lock()
+    
+    def __enter__(self):
+        return self
+    
+    def __exit__(self, type, value, traceback):
+        self.close()
+    
+    def __contains__(self, name):
+        return name in self.zip_file.NameToInfo
     
     @property
     def zip_file(self):
-        if self._zip_file is None:
-            self._zip_file = zipfile.ZipFile(str(self.path), "r")
-        return self._zip_file
+        """
+        The handle of the archive the index and the list of members are
+        read from.
+        """
+        with self._lock:
+            if self._zip_file is None:
+                self._zip_file = zipfile.ZipFile(str(self.path), "r")
+            return self._zip_file
+    
+    def close(self):
+        with self._lock:
+            handles, self._handles = self._handles, []
+            self._stale.update(self._in_use)
+            zip_file, self._zip_file = self._zip_file, None
+            self._dirs = None
+        for handle in handles:
+            handle.close()
+        if zip_file is not None:
+            zip_file.close()
+    
+    def acquire(self):
+        """
+        Returns an archive handle for reading the members, give it back by
+        release().
+        """
+        with self._lock:
+            if self._handles:
+                handle = self._handles.pop()
+                self._in_use.add(handle)
+                return handle
+        handle = zipfile.ZipFile(str(self.path), "r")
+        with self._lock:
+            self._in_use.add(handle)
+        return handle
+    
+    def release(self, handle):
+        with self._lock:
+            self._in_use.discard(handle)
+            if handle in self._stale:
+                # Acquired before close().
+                self._stale.discard(handle)
+            elif len(self._handles) < self.max_handles:
+                self._handles.append(handle)
+                return
+        handle.close()
+    
+    @contextlib.contextmanager
+    def handle(self):
+        handle = self.acquire()
+        try:
+            yield handle
+        finally:
+            self.release(handle)
+    
+    def get(self, name):
+        """
+        Returns the ZipFileEntry of the member, raises KeyError if there
+        is none.
+        """
+        return ZipFileEntry(self, self.zip_file.getinfo(name))
+    
+    def list_dir(self, prefix = ""):
+        """
+        Returns the sorted names of the members and the subdirectories
+        (with a trailing slash) in the directory (e.g. "" for the root or
+        "dir/sub/"), including directories without their own member.
+        Raises KeyError if there is no such directory.
+        """
+        prefix = prefix.strip("/")
+        if prefix:
+            prefix += "/"
+        
+        dirs = self._dirs
+        if dirs is None:
+            children = {"": set()}
+            for name in self.zip_file.NameToInfo:
+                parent = ""
+                parts = name.split("/")
+                for part in parts[:-1]:
+                    children[parent].add(part + "/")
+                    parent += part + "/"
+                    children.setdefault(parent, set())
+                if parts[-1]:
+                    children[parent].add(parts[-1])
+            dirs = dict([(key, sorted(value)) for key, value in children.items()])
+            self._dirs = dirs
+        
+        try:
+            return list(dirs[prefix])
+        except KeyError:
+            raise KeyError("There is no directory %s in %s." % (prefix, self.path, ))
     
     def iter_list(self):
         for info in self.zip_file.infolist():
@@ -197,6 +641,196 @@ class ZipFile(File):
     
     def list(self):
         return list(self.iter_list())
+    
+    def read_many(self, names = None, workers = 4, processes = False):
+        """
+        Yields (name, data) tuples of the members (all by default), in the
+        order of the names. The members are decompressed by a pool of
+        workers threads, or processes with their own archive handles, at
+        most 2 * workers members ahead of the consumer.
+        """
+        if names is None:
+            names = self.zip_file.namelist()
+        if processes:
+            return map_processes(self.path, read_member, names, workers)
+        return self.map_threads(read_member, names, workers)
+    
+    def extract_all(self, dest, names = None, workers = 4, processes = False):
+        """
+        Extracts the members (all by default) to the directory dest by a
+        pool of workers threads (or processes) and returns a list of
+        (name, extracted) tuples in the order of the names. Each file is
+        written to a temporary file renamed over the target, files of the
+        same size and CRC as their member are kept (and reported as not
+        extracted). Raises ValueError for members outside dest (e.g.
+        "../x") before anything is extracted.
+        """
+        return list(self.iter_extract(dest, names, workers, processes))
+    
+    def iter_extract(self, dest, names = None, workers = 4, processes = False):
+        """
+        Like extract_all(), but returns an iterator of the (name, extracted)
+        tuples. The directories are created right away, the files are
+        extracted as the iterator is consumed, at most 2 * workers members
+        ahead.
+        """
+        if names is None:
+            names = self.zip_file.namelist()
+        names = list(names)
+        dest = path.abspath(dest)
+        
+        dirs = []
+        members = []
+        for name in names:
+            target = path.normpath(path.join(dest, name))
+            if path.isabs(name) or not target.startswith(path.join(dest, "")):
+                raise ValueError("Member %s is outside %s." % (name, dest, ))
+            if name.endswith("/"):
+                dirs.append((name, target, ))
+            else:
+                members.append((name, target, ))
+        # The directories are created before the workers start.
+        directories = {}
+        for name, target in dirs:
+            created = not path.isdir(target)
+            if created:
+                os.makedirs(target)
+            directories[name] = created
+        for directory in sorted(set([path.dirname(target) for name, target in members])):
+            if not path.isdir(directory):
+                os.makedirs(directory)
+        
+        if processes:
+            results = map_processes(self.path, extract_member, members, workers)
+        else:
+            results = self.map_threads(extract_member, members, workers)
+        return self._merge_extracted(names, directories, results)
+    
+    def _merge_extracted(self, names, directories, results):
+        for name in names:
+            if name in directories:
+                yield name, directories[name]
+            else:
+                yield next(results)
+    
+    def map_threads(self, func, items, workers):
+        def call(item):
+            with self.handle() as handle:
+                return func(handle, item)
+        with ThreadPool(workers, name = "nmapps.fs.ZipFile") as pool:
+            for result in pool.map(call, items):
+                yield result
+
+
+# The archive handle of a process of map_processes().
+WORKER_ARCHIVE = None
+
+
+def open_worker_archive(value):
+    global WORKER_ARCHIVE
+    WORKER_ARCHIVE = zipfile.ZipFile(value, "r")
+
+
+def call_worker(func, item):
+    return func(WORKER_ARCHIVE, item)
+
+
+def map_processes(archive, func, items, workers):
+    """
+    Yields func(archive handle, item) for the items, called by a pool of
+    processes, each with its own handle of the archive.
+    """
+    pool = multiprocessing.Pool(workers, open_worker_archive, (str(archive), ))
+    finished = False
+    try:
+        pending = collections.deque()
+        for item in items:
+            pending.append(pool.apply_async(call_worker, (func, item, )))
+            if len(pending) >= 2 * workers:
+                yield pending.popleft().get()
+        while pending:
+            yield pending.popleft().get()
+        finished = True
+    finally:
+        if finished:
+            pool.close()
+        else:
+            pool.terminate()
+        pool.join()
+
+
+def read_member(handle, name):
+    return name, handle.read(name)
+
+
+def same_contents(target, info):
+    """
+    Returns True if the file has the size and the CRC of the member.
+    """
+    result = stat_or_none(target)
+    if result is None or result.st_size != info.file_size:
+        return False
+    crc = 0
+    for chunk in File(target).iter_chunks():
+        # zlib doesn't take memoryviews on Python 2.
+        crc = zlib.crc32(chunk.tobytes(), crc)
+    return crc & 0xffffffff == info.CRC
+
+
+def extract_member(handle, member):
+    """
+    Extracts the member to its target file unless it has the same
+    contents already. Returns a (name, extracted) tuple.
+    """
+    name, target = member
+    info = handle.getinfo(name)
+    if same_contents(target, info):
+        return name, False
+    
+    temp = "%s.%d.%d.tmp" % (target, os.getpid(), thread.get_ident(), )
+    try:
+        source = handle.open(info)
+        try:
+            with open(temp, "wb") as f:
+                shutil.copyfileobj(source, f, File.CHUNK_SIZE)
+        finally:
+            source.close()
+        os.rename(temp, target)
+    except:
+        if path.exists(temp):
+            os.remove(temp)
+        raise
+    return name, True
+
+
+class ZipEntryStream(object):
+    """
+    A member opened by ZipFileEntry.open(), which gives its archive handle
+    back to the ZipFile when closed.
+    """
+    
+    def __init__(self, stream, zip_file, handle):
+        self.stream = stream
+        self.zip_file = zip_file
+        self.handle = handle
+    
+    def __getattr__(self, name):
+        return getattr(self.stream, name)
+    
+    def __iter__(self):
+        return iter(self.stream)
+    
+    def __enter__(self):
+        return self
+    
+    def __exit__(self, type, value, traceback):
+        self.close()
+    
+    def close(self):
+        if self.handle is not None:
+            self.stream.close()
+            self.zip_file.release(self.handle)
+            self.handle = None
 
 
 class ZipFileEntry(object):
@@ -211,10 +845,315 @@ class ZipFileEntry(object):
         return self.info.filename
     
     def open(self):
-        return self.zip_file.zip_file.open(self.info)
+        handle = self.zip_file.acquire()
+        try:
+            return ZipEntryStream(handle.open(self.info), self.zip_file, handle)
+        except:
+            self.zip_file.release(handle)
+            raise
     
     def read(self):
-        return self.zip_file.zip_file.read(self.info)
+        with self.zip_file.handle() as handle:
+            return handle.read(self.info)
+
+
+def compile_filter(value):
+    """
+    Returns a function (file, name, relative path) -> bool for a callable
+    (called with the file), a glob pattern or a list of glob patterns
+    (matched against the name, or the relative path if the pattern
+    contains a slash), or None.
+    """
+    if value is None:
+        return None
+    if callable(value):
+        return lambda f, name, relative: value(f)
+    if isinstance(value, basestring):
+        value = [value]
+    names = [pattern for pattern in value if "/" not in pattern]
+    paths = [pattern for pattern in value if "/" in pattern]
+    def matches(f, name, relative):
+        for pattern in names:
+            if fnmatch.fnmatch(name, pattern):
+                return True
+        for pattern in paths:
+            if fnmatch.fnmatch(relative, pattern):
+                return True
+        return False
+    return matches
+
+
+class Listing(object):
+    """
+    Children of a directory, listed by a Walker in the walking thread or
+    prefetched by its thread pool.
+    """
+    
+    def __init__(self, walker, directory, depth):
+        self.walker = walker
+        self.directory = directory
+        self.depth = depth
+        self.future = None
+    
+    def submit(self, pool):
+        self.future = pool.submit(self.walker.list_children, self.directory, self.depth)
+    
+    def result(self):
+        try:
+            if self.future is None:
+                return self.walker.list_children(self.directory, self.depth)
+            return self.future.result()
+        except (EnvironmentError, zipfile.BadZipfile) as e:
+            self.walker.error(e)
+            return []
+
+
+class Level(object):
+    """
+    Children of a directory being walked in the ordered mode.
+    """
+    
+    def __init__(self, children):
+        # (file, listing or None) tuples
+        self.children = children
+        self.position = 0
+        self.listings = [listing for f, listing in children if listing is not None]
+        self.prefetched = 0
+
+
+class Walker(object):
+    """
+    Recursive traversal of a directory tree.
+    
+    - include -- only the files (and directories) matching the filter are
+      yielded, the directories are descended into anyway;
+    - exclude -- the matching files are neither yielded nor descended into;
+    - max_depth -- the depth of the deepest yielded files, the children of
+      the walked directory have depth 1;
+    - follow_symlinks -- descend into symlinked directories (each directory
+      at most once, so symlink loops end);
+    - zip_files -- yield the entries (ZipFileEntry) of the zip files too;
+    - workers -- with more than one, the directories are listed by a pool
+      of as many threads, which pays off on slow (network) storage;
+    - ordered -- yield the files in a deterministic order, depth first with
+      the children of a directory sorted by name (otherwise in the order
+      their directories were listed);
+    - onerror -- called with the exception when a directory or a zip file
+      can't be read, which are skipped by default.
+    
+    The filters are callables (called with the file), glob patterns or
+    lists of glob patterns, see compile_filter(). At most 2 * workers
+    directory listings are read ahead of the consumer.
+    """
+    
+    def __init__(self, include = None, exclude = None, max_depth = None,
+                 follow_symlinks = False, zip_files = False, workers = 1,
+                 ordered = False, onerror = None):
+        self.include = compile_filter(include)
+        self.exclude = compile_filter(exclude)
+        self.max_depth = max_depth
+        self.follow_symlinks = follow_symlinks
+        self.zip_files = zip_files
+        self.workers = workers
+        self.ordered = ordered
+        self.onerror = onerror
+        self.window = 2 * workers
+        
+        # Length of the path of the walked directory with the separator.
+        self.prefix = 0
+        # (device, inode) of the directories descended into, with
+        # follow_symlinks.
+        self.visited = set()
+    
+    def __repr__(self):
+        return "%s(workers = %d)" % (type(self).__name__, self.workers, )
+    
+    def error(self, e):
+        if self.onerror is not None:
+            self.onerror(e)
+    
+    def walk(self, directory):
+        self.prefix = len(path.join(directory.path.value, ""))
+        self.visited = set()
+        self.enter(directory)
+        
+        if self.workers <= 1:
+            return self.walk_ordered(directory, None)
+        pool = ThreadPool(self.workers, name = "nmapps.fs.Walker")
+        if self.ordered:
+            return self.shutdown(self.walk_ordered(directory, pool), pool)
+        return self.shutdown(self.walk_unordered(directory, pool), pool)
+    
+    def shutdown(self, files, pool):
+        finished = False
+        try:
+            for f in files:
+                yield f
+            finished = True
+        finally:
+            # Doesn't wait for the listings read ahead when the consumer
+            # stopped early.
+            pool.shutdown(wait = finished)
+    
+    def enter(self, directory):
+        """
+        Returns True if the directory should be descended into (it wasn't
+        visited yet through another symlink). A failing stat is passed to
+        onerror.
+        """
+        if not self.follow_symlinks:
+            return True
+        try:
+            result = directory.path.stat()
+        except OSError as e:
+            self.error(e)
+            return False
+        if result is None:
+            return False
+        key = (result.st_dev, result.st_ino, )
+        if key in self.visited:
+            return False
+        self.visited.add(key)
+        return True
+    
+    def list_children(self, directory, depth):
+        """
+        Lists the directory or the zip file, returns a list of (file,
+        depth, descend, included) tuples of the children not excluded.
+        Called by the threads of the pool.
+        """
+        depth += 1
+        if isinstance(directory, ZipFile):
+            base = directory.path.value[self.prefix:] + "/"
+            children = []
+            for entry in directory.iter_list():
+                name = entry.info.filename
+                children.append((entry, path.basename(name.rstrip("/")), base + name, ))
+            # Many archives shouldn't stay open, the entries open their
+            # archive again when read.
+            directory.close()
+        else:
+            children = [(f, f.path.base, f.path.value[self.prefix:], )
+                        for f in directory.iter_list()]
+        if self.ordered:
+            children.sort(key = lambda child: child[1])
+        
+        descend_depth = self.max_depth is None or depth < self.max_depth
+        result = []
+        for f, name, relative in children:
+            if self.exclude is not None and self.exclude(f, name, relative):
+                continue
+            descend = False
+            if descend_depth:
+                if isinstance(f, Directory):
+                    descend = self.follow_symlinks or not f.path.is_link
+                elif isinstance(f, ZipFile):
+                    descend = self.zip_files
+            included = self.include is None or self.include(f, name, relative)
+            result.append((f, depth, descend, included, ))
+        return result
+    
+    def walk_ordered(self, directory, pool):
+        """
+        Walks the tree depth first. With a pool, the listings of the next
+        directories are read ahead.
+        """
+        stack = []
+        prefetched = [0]
+        
+        def level(children):
+            result = []
+            for f, depth, descend, included in children:
+                listing = None
+                if descend and (isinstance(f, ZipFile) or self.enter(f)):
+                    listing = Listing(self, f, depth)
+                result.append((f if included else None, listing, ))
+            return Level(result)
+        
+        def prefetch():
+            # The deepest directories are needed first.
+            for current in reversed(stack):
+                while current.prefetched < len(current.listings):
+                    if prefetched[0] >= self.window:
+                        return
+                    current.listings[current.prefetched].submit(pool)
+                    current.prefetched += 1
+                    prefetched[0] += 1
+        
+        stack.append(level(Listing(self, directory, 0).result()))
+        while stack:
+            current = stack[-1]
+            if current.position >= len(current.children):
+                stack.pop()
+                continue
+            f, listing = current.children[current.position]
+            current.position += 1
+            if pool is not None:
+                prefetch()
+            if f is not None:
+                yield f
+            if listing is not None:
+                if listing.future is not None:
+                    prefetched[0] -= 1
+                stack.append(level(listing.result()))
+    
+    def walk_unordered(self, directory, pool):
+        """
+        Walks the tree yielding the children of the directories in the
+        order their listings are read by the pool. The listed children
+        are walked only while at most window directories wait for the
+        pool, so the memory is bounded by the depth of the tree rather
+        than by its width.
+        """
+        results = Queue.Queue()
+        def list_children(directory, depth):
+            # Every listing must put a result, or the loop below waits
+            # forever.
+            try:
+                results.put((self.list_children(directory, depth), None, ))
+            except BaseException:
+                results.put((None, sys.exc_info(), ))
+        
+        # Iterators over the children of the listed directories, the last
+        # one is walked first, so the tree is walked roughly depth first.
+        levels = []
+        pending = [(directory, 0, )]
+        running = 0
+        while levels or pending or running:
+            while pending and running < self.window:
+                pool.submit(list_children, *pending.pop())
+                running += 1
+            
+            # Takes the finished listings, waits for one if there is nothing
+            # to walk or enough directories are pending.
+            wait = not levels or len(pending) >= self.window
+            if running:
+                try:
+                    children, exc_info = results.get(wait)
+                except Queue.Empty:
+                    pass
+                else:
+                    running -= 1
+                    if exc_info is None:
+                        levels.append(iter(children))
+                    elif isinstance(exc_info[1], (EnvironmentError, zipfile.BadZipfile, )):
+                        self.error(exc_info[1])
+                    else:
+                        raise exc_info[0], exc_info[1], exc_info[2]
+                    continue
+            if not levels:
+                continue
+            
+            # Walks the children until enough directories are pending.
+            for f, depth, descend, included in levels[-1]:
+                if included:
+                    yield f
+                if descend and (isinstance(f, ZipFile) or self.enter(f)):
+                    pending.append((f, depth, ))
+                    if len(pending) >= self.window:
+                        break
+            else:
+                levels.pop()
 
 
 def executing_file():
@@ -225,15 +1164,16 @@ def foo():
     print executing_file()
     print __file__
     print __name__
-
+    
     import __main__
     print "\n===== __main__ ====="
     print "__name__: %r" % (getattr(__main__, "__name__", None), )
     print "__file__: %r" % (getattr(__main__, "__file__", None), )
-
+    
     import inspect
     import pprint
     s = inspect.stack()
     print "\n"
     pprint.pprint(s)
 
+
@@ -1,6 +1,18 @@
 # src/nmapps/injection.py
 
+import sys
 import logging
+import inspect
+import threading
+import Queue
+
+try:
+    import asyncio
+except ImportError:
+    try:
+        import trollius as asyncio
+    except ImportError:
+        asyncio = None
 
 from nmapps.utils import UserException
 
@@ -12,6 +24,278 @@ class DependencyException(UserException):
     pass
 
 
+def coroutine(func):
+    """Marks the generator function as a coroutine (when asyncio is
+    available)."""
+    if asyncio is None:
+        return func
+    return asyncio.coroutine(func)
+
+
+SINGLETON = "singleton"
+THREAD = "thread"
+TRANSIENT = "transient"
+
+
+class Provider(object):
+    """Base class of lazy dependency providers.
+    
+    A provider is stored as an alternative of a dependency instead of the
+    value itself. The manager calls :meth:`get` whenever the provider is the
+    selected alternative of a requested dependency.
+    
+    The factory may return a coroutine (when :mod:`asyncio`, or its
+    backport trollius, is available). :meth:`get` runs it to completion in
+    the event loop of the calling thread (see :func:`run_coroutine`), while
+    :meth:`DefaultDependencyManager.resolve_all_async` awaits it in the
+    loop running the resolution. Either way the loop is left open, as the
+    value (e.g. a connection pool) may be bound to it.
+    
+    ``requires`` lists the keys of the dependencies the factory needs, which
+    is used to order the initialization in :meth:`resolve_all`. For
+    autowired classes (see :func:`wire`) it defaults to the keys of the
+    constructor parameters."""
+    
+    lifetime = None
+    
+    @property
+    def requires(self):
+        if self._requires is not None:
+            return self._requires
+        plan = get_plan(self.factory)
+        if plan is None:
+            return ()
+        return plan.keys
+    
+    def __init__(self, factory, args = (), kwargs = None, requires = None):
+        self.factory = factory
+        self.args = tuple(args)
+        self.kwargs = kwargs or {}
+        
+        self._requires = None
+        if requires is not None:
+            self._requires = tuple(requires)
+    
+    def __repr__(self):
+        return "%s(%r)" % (type(self).__name__, self.factory, )
+    
+    def create(self):
+        value = self.factory(*self.args, **self.kwargs)
+        if asyncio is not None and asyncio.iscoroutine(value):
+            value = run_coroutine(value)
+        return value
+    
+    def get(self):
+        raise NotImplementedError()
+
+
+# Guards the building attributes of singleton providers and _WAITING.
+_BUILD_LOCK = threading.Lock()
+# Thread ident -> the singleton provider the thread waits for.
+_WAITING = {}
+
+
+class SingletonProvider(Provider):
+    """Builds the value on the first request and shares it afterwards.
+    
+    The factory is called exactly once, even when several threads request
+    the value at the same time. Factories requesting each other from
+    different threads would wait for each other forever, so a thread which
+    would close such a cycle raises :class:`DependencyException` instead."""
+    
+    lifetime = SINGLETON
+    
+    def __init__(self, factory, args = (), kwargs = None, requires = None):
+        Provider.__init__(self, factory, args, kwargs, requires)
+        self.lock = threading.Lock()
+        self.built = False
+        self.value = None
+        self.building = None
+    
+    def get(self):
+        if self.built:
+            return self.value
+        ident = threading.current_thread().ident
+        with _BUILD_LOCK:
+            if self.waits_for(ident):
+                raise DependencyException(
+                    msg = "Circular dependency while building %r." % (self, ))
+            _WAITING[ident] = self
+        try:
+            self.lock.acquire()
+        finally:
+            with _BUILD_LOCK:
+                del _WAITING[ident]
+        try:
+            if not self.built:
+                with _BUILD_LOCK:
+                    self.building = ident
+                try:
+                    self.value = self.create()
+                finally:
+                    with _BUILD_LOCK:
+                        self.building = None
+                self.built = True
+        finally:
+            self.lock.release()
+        return self.value
+    
+    @coroutine
+    def get_async(self, manager = None, loop = None):
+        """Coroutine building the value like :meth:`get`, awaiting a
+        coroutine returned by the factory in the loop (the current one by
+        default). The factory is called with the manager (if given) being
+        current. A value being built by another thread or task is waited
+        for in the default executor of the loop."""
+        if self.built:
+            raise asyncio.Return(self.value)
+        if loop is None:
+            loop = asyncio.get_event_loop()
+        if not self.lock.acquire(False):
+            value = yield asyncio.From(loop.run_in_executor(None, self.get))
+            raise asyncio.Return(value)
+        try:
+            if not self.built:
+                with _BUILD_LOCK:
+                    self.building = threading.current_thread().ident
+                try:
+                    if manager is None:
+                        value = self.factory(*self.args, **self.kwargs)
+                    else:
+                        with manager:
+                            value = self.factory(*self.args, **self.kwargs)
+                    if asyncio.iscoroutine(value):
+                        value = yield asyncio.From(value)
+                    self.value = value
+                finally:
+                    with _BUILD_LOCK:
+                        self.building = None
+                self.built = True
+        finally:
+            self.lock.release()
+        raise asyncio.Return(self.value)
+    
+    def waits_for(self, ident):
+        """Returns True if the provider is being built by the thread, or by
+        a thread waiting (through other providers) for the thread. Must be
+        called with _BUILD_LOCK held."""
+        owner = self.building
+        # Every waiting thread is visited at most once.
+        for i in xrange(len(_WAITING) + 1):
+            if owner is None:
+                return False
+            if owner == ident:
+                return True
+            provider = _WAITING.get(owner)
+            if provider is None:
+                return False
+            owner = provider.building
+        return False
+
+
+class ThreadLocalProvider(Provider):
+    """Builds one value per thread."""
+    
+    lifetime = THREAD
+    
+    def __init__(self, factory, args = (), kwargs = None, requires = None):
+        Provider.__init__(self, factory, args, kwargs, requires)
+        self.local = threading.local()
+    
+    def get(self):
+        try:
+            return self.local.value
+        except AttributeError:
+            value = self.create()
+            self.local.value = value
+            return value
+
+
+class TransientProvider(Provider):
+    """Builds a new value for every request."""
+    
+    lifetime = TRANSIENT
+    
+    def get(self):
+        return self.create()
+
+
+PROVIDERS = {
+    SINGLETON: SingletonProvider,
+    THREAD: ThreadLocalProvider,
+    TRANSIENT: TransientProvider,
+}
+
+
+def make_provider(factory, lifetime = SINGLETON, args = (), kwargs = None,
+                  requires = None):
+    """Creates a provider for the factory with the given lifetime."""
+    try:
+        provider_class = PROVIDERS[lifetime]
+    except KeyError:
+        raise DependencyException(msg = "Unknown lifetime %r." % (lifetime, ))
+    return provider_class(factory, args, kwargs, requires)
+
+
+def run_coroutine(coroutine):
+    """Runs the coroutine to completion in the event loop of the calling
+    thread. A new loop is created and made current if the thread has none
+    (or it is closed). The loop is never closed, the value may be bound to
+    it. Raises :class:`DependencyException` if the loop is running, such
+    dependencies have to be built by :func:`resolve_all_async`."""
+    try:
+        loop = asyncio.get_event_loop()
+    except RuntimeError:
+        loop = None
+    if loop is None or loop.is_closed():
+        loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(loop)
+    if loop.is_running():
+        coroutine.close()
+        raise DependencyException(
+            msg = "Cannot run a coroutine factory inside the running event " \
+                  "loop, use resolve_all_async() instead.")
+    return loop.run_until_complete(coroutine)
+
+
+def find_cycle(graph):
+    """Returns a list of keys forming a cycle in the dependency graph
+    (a dictionary mapping keys to the keys they depend on), or ``None``."""
+    visited = {}
+    
+    for root in graph:
+        if root in visited:
+            continue
+        
+        path = [root]
+        visited[root] = True
+        stack = [iter(graph[root])]
+        while stack:
+            for key in stack[-1]:
+                if key in path:
+                    return path[path.index(key):] + [key]
+                if key not in visited and key in graph:
+                    visited[key] = True
+                    path.append(key)
+                    stack.append(iter(graph[key]))
+                    break
+            else:
+                stack.pop()
+                path.pop()
+    
+    return None
+
+
+def build_error(key, exc_info):
+    """Returns the DependencyException reporting the failed build of the
+    dependency."""
+    exception = DependencyException(
+        msg = "Failed to build dependency %r: %s" % (key, exc_info[1], ),
+        inner = exc_info[1])
+    exc_info[1].exc_info = exc_info
+    return exception
+
+
 class DependencyManager(object):
     def __str__(self):
         return "%s()" % (type(self).__name__, )
@@ -19,6 +303,11 @@ class DependencyManager(object):
     def set(key, value, *args, **kwargs):
         pass
     
+    def provide(self, key, factory, name = None, lifetime = SINGLETON,
+                args = (), kwargs = None, requires = None):
+        self.set(key, make_provider(factory, lifetime, args, kwargs, requires),
+                 name)
+    
     def get(key, fallback = None):
         if fallback is not None:
             return fallback
@@ -29,18 +318,40 @@ class DependencyManager(object):
 
     def clear(self):
         pass
+    
+    def freeze(self):
+        pass
+    
+    def unfreeze(self):
+        pass
+    
+    def resolve_all(self, workers = None):
+        return []
+    
+    @coroutine
+    def resolve_all_async(self, loop = None):
+        return []
 
 
 class NullDependencyManager(DependencyManager):
     pass
 
 
+_UNSET = object()
+
+
 class DependencyEntry(object):
+    """Alternatives of a single dependency.
+    
+    Changes are serialized by the entry's lock and the selected alternative
+    is published eagerly on every change, so that reading :attr:`selected`
+    is a single attribute access which needs no locking."""
+    
     def __init__(self, key):
         self.key = key
+        self.lock = threading.Lock()
         
-        self.dirty = True
-        self._selected = None
+        self._selected = _UNSET
         self.selected_name = None
         
         self.alternatives = []
@@ -48,104 +359,585 @@ class DependencyEntry(object):
     
     @property
     def selected(self):
-        if self.dirty:
-            if self.selected_name is not None:
-                try:
-                    self._selected = self.named[self.selected_name]
-                    return self._selected
-                except KeyError:
+        selected = self._selected
+        if selected is _UNSET:
+            LOGGER.error("There are no alternatives for dependency %r.", self.key)
+            raise DependencyException()
+        return selected
+    
+    @property
+    def has_value(self):
+        return self._selected is not _UNSET
+    
+    def _update(self):
+        # Must be called with the lock held.
+        if self.selected_name is not None:
+            try:
+                self._selected = self.named[self.selected_name]
+                return
+            except KeyError:
+                if len(self.alternatives) > 0:
                     LOGGER.warning("Selected named alternative %r for " \
                                    "dependency %r could not be found, " \
                                    "falling back to the last alternative.",
                                    self.selected_name, self.key)
-            if len(self.alternatives) < 1:
-                LOGGER.error("There are no alternatives for dependency %r.", self.key)
-                raise DependencyException()
+        if len(self.alternatives) < 1:
+            self._selected = _UNSET
+        else:
             self._selected = self.alternatives[-1]
-            self.dirty = False
-        return self._selected
     
     def add(self, value, name = None):
-        self.dirty = True
-        
-        self.alternatives.append(value)
-        
-        if name is not None:
-            if name in self.named:
-                raise DependencyException()
-            self.named[name] = value
+        with self.lock:
+            if name is not None:
+                if name in self.named:
+                    raise DependencyException()
+                self.named[name] = value
+            
+            self.alternatives.append(value)
+            self._update()
     
     def select(self, name):
-        self.dirty = True
-        self.selected_name = name
+        with self.lock:
+            self.selected_name = name
+            self._update()
+    
+    def copy(self):
+        """Returns an independent copy of the entry."""
+        with self.lock:
+            entry = DependencyEntry(self.key)
+            entry._selected = self._selected
+            entry.selected_name = self.selected_name
+            entry.alternatives = list(self.alternatives)
+            entry.named = dict(self.named)
+        return entry
+
+
+_LOCAL = threading.local()
 
 
 class DefaultDependencyManager(DependencyManager):
-    def __init__(self):
+    """Dependency manager keeping a :class:`DependencyEntry` for every key.
+    
+    The manager is thread-safe. Changes are serialized by the manager's
+    lock, while :meth:`get` doesn't lock at all.
+    
+    Once the wiring is finished, the manager can be frozen by calling
+    :meth:`freeze`. A frozen manager resolves dependencies from a flat
+    snapshot of selected values, so that :meth:`get` is a single dictionary
+    lookup. Any subsequent change (:meth:`set`, :meth:`select` or
+    :meth:`clear`) invalidates the snapshot, which is then rebuilt on the
+    next :meth:`get`.
+    
+    A manager created with a parent (see :meth:`scope`) overlays it:
+    dependencies not set in the child are resolved by the parent, while
+    changes made to the child are not visible in the parent. An entry of
+    the parent is copied into the child on the first change of its key."""
+    
+    def __init__(self, parent = None):
+        self.parent = parent
         self.entries = {}
+        self.lock = threading.RLock()
+        
+        self.frozen = False
+        self._snapshot = None
+    
+    def __enter__(self):
+        """Makes the manager the current one in the calling thread."""
+        stack = _LOCAL.__dict__.setdefault("stack", [])
+        stack.append(getattr(_LOCAL, "manager", None))
+        _LOCAL.manager = self
+        return self
+    
+    def __exit__(self, exc_type, exc_value, traceback):
+        _LOCAL.manager = _LOCAL.stack.pop()
+        return False
+    
+    def find_entry(self, key):
+        """Returns the entry for the key from this manager or its parents,
+        or ``None``."""
+        manager = self
+        while manager is not None:
+            entry = manager.entries.get(key, None)
+            if entry is not None:
+                return entry
+            manager = manager.parent
+        return None
     
     def get_entry(self, key, throw = False):
         entry = self.entries.get(key, None)
         if entry is None:
             if throw:
                 raise DependencyException()
-            entry = DependencyEntry(key)
-            self.entries[key] = entry
+            with self.lock:
+                entry = self.entries.get(key, None)
+                if entry is None:
+                    if self.parent is not None:
+                        entry = self.parent.find_entry(key)
+                    if entry is None:
+                        entry = DependencyEntry(key)
+                    else:
+                        entry = entry.copy()
+                    self.entries[key] = entry
         return entry
     
     def set(self, key, value, name = None):
-        entry = self.get_entry(key)
-        entry.add(value, name)
+        with self.lock:
+            entry = self.get_entry(key)
+            entry.add(value, name)
+            self._snapshot = None
     
     def select(self, key, name):
-        entry = self.get_entry(key)
-        entry.select(name)
+        with self.lock:
+            entry = self.get_entry(key)
+            entry.select(name)
+            self._snapshot = None
     
     def get(self, key, fallback = None):
-        if fallback is None:
-            entry = self.get_entry(key, True)
-            return entry.selected
-        else:
-            entry = self.get_entry(key)
+        snapshot = self._snapshot
+        if snapshot is None and self.frozen:
+            snapshot = self.build_snapshot()
+        if snapshot is not None:
+            values, lazy = snapshot
             try:
-                return entry.selected
-            except DependencyException:
-                return fallback
+                value = values[key]
+            except KeyError:
+                pass
+            else:
+                if key in lazy:
+                    return value.get()
+                return value
+        
+        entry = self.entries.get(key, None)
+        if entry is not None and entry.has_value:
+            value = entry.selected
+        elif self.parent is not None:
+            return self.parent.get(key, fallback)
+        elif fallback is None:
+            raise DependencyException(msg = "Dependency %r is not set." % (key, ))
+        else:
+            return fallback
+        
+        if isinstance(value, Provider):
+            return value.get()
+        return value
     
     def clear(self):
-        self.entries.clear()
+        with self.lock:
+            self.entries.clear()
+            self._snapshot = None
+    
+    def build_snapshot(self):
+        """Builds the flat key to value snapshot used by frozen managers.
+        
+        The snapshot is a pair of the key to value dictionary and the set
+        of keys whose values are providers. Keys without any alternative
+        are left out, so they are resolved by the regular path (by the
+        parent, raising or returning the fallback)."""
+        with self.lock:
+            values = {}
+            lazy = []
+            for key, entry in self.entries.iteritems():
+                if entry.has_value:
+                    value = values[key] = entry.selected
+                    if isinstance(value, Provider):
+                        lazy.append(key)
+            snapshot = (values, frozenset(lazy))
+            self._snapshot = snapshot
+        return snapshot
+    
+    def freeze(self):
+        with self.lock:
+            self.frozen = True
+            self.build_snapshot()
+    
+    def unfreeze(self):
+        with self.lock:
+            self.frozen = False
+            self._snapshot = None
+    
+    def resolve_all(self, workers = None):
+        """Builds all the selected singleton providers which are not built
+        yet, returns their keys in the order they were built.
+        
+        Providers are built concurrently by up to ``workers`` threads (by
+        default one per provider), each as soon as all the providers it
+        requires are built. So the time it takes is given by the longest
+        chain of dependencies rather than by the sum of all the
+        initialization times.
+        
+        The factories are called with this manager being current (see
+        :func:`current`). Raises :class:`DependencyException` if the
+        required dependencies form a cycle or if a factory fails."""
+        providers, graph = self.get_unbuilt()
+        if len(providers) < 1:
+            return []
+        
+        dependents = dict([(key, []) for key in providers])
+        for key, deps in graph.iteritems():
+            for dep in deps:
+                dependents[dep].append(key)
+        
+        waiting = dict([(key, len(deps)) for key, deps in graph.iteritems()])
+        ready = Queue.Queue()
+        for key, count in waiting.iteritems():
+            if count == 0:
+                ready.put(key)
+        
+        if workers is None:
+            workers = len(providers)
+        workers = max(1, min(workers, len(providers)))
+        
+        lock = threading.Lock()
+        built = []
+        errors = []
+        
+        def stop():
+            for i in range(workers):
+                ready.put(None)
+        
+        def work():
+            with self:
+                build()
+        
+        def build():
+            while True:
+                key = ready.get()
+                if key is None:
+                    return
+                try:
+                    providers[key].get()
+                except Exception:
+                    with lock:
+                        errors.append((key, sys.exc_info()))
+                    stop()
+                    return
+                with lock:
+                    built.append(key)
+                    for dependent in dependents[key]:
+                        waiting[dependent] -= 1
+                        if waiting[dependent] == 0:
+                            ready.put(dependent)
+                    if len(built) == len(providers):
+                        stop()
+        
+        threads = []
+        for i in range(workers):
+            thread = threading.Thread(target = work,
+                                      name = "nmapps.injection.resolve_all")
+            thread.daemon = True
+            thread.start()
+            threads.append(thread)
+        for thread in threads:
+            thread.join()
+        
+        if errors:
+            raise build_error(*errors[0])
+        
+        return built
+    
+    @coroutine
+    def resolve_all_async(self, loop = None):
+        """Coroutine building all the selected singleton providers which
+        are not built yet in the event loop (the current one by default),
+        returns their keys in the order they were built::
+            
+            yield From(injection.resolve_all_async())
+        
+        Every provider is built by a task of the loop as soon as all the
+        providers it requires are built, so independent providers (and
+        the coroutines their factories return) are awaited concurrently.
+        The synchronous parts of the factories run in the loop's thread.
+        The loop is neither replaced nor closed.
+        
+        Raises :class:`DependencyException` like :meth:`resolve_all`."""
+        if loop is None:
+            loop = asyncio.get_event_loop()
+        providers, graph = self.get_unbuilt()
+        if len(providers) < 1:
+            raise asyncio.Return([])
+        
+        built = []
+        errors = []
+        tasks = {}
+        
+        @coroutine
+        def build(key, deps):
+            if deps:
+                yield asyncio.From(asyncio.gather(*deps, loop = loop))
+            try:
+                yield asyncio.From(providers[key].get_async(self, loop))
+            except Exception:
+                errors.append((key, sys.exc_info()))
+                raise
+            built.append(key)
+        
+        def schedule(key):
+            task = tasks.get(key)
+            if task is None:
+                deps = [schedule(dep) for dep in graph[key]]
+                task = asyncio.ensure_future(build(key, deps), loop = loop)
+                tasks[key] = task
+            return task
+        
+        for key in providers:
+            schedule(key)
+        yield asyncio.From(asyncio.gather(*tasks.values(), loop = loop,
+                                          return_exceptions = True))
+        
+        if errors:
+            raise build_error(*errors[0])
+        
+        raise asyncio.Return(built)
+    
+    def get_unbuilt(self):
+        """Returns the selected singleton providers which are not built yet
+        (a key to provider dictionary) and the graph of the dependencies
+        between them (a key to the required keys dictionary). Raises
+        :class:`DependencyException` if the graph has a cycle."""
+        selected = {}
+        chain = []
+        manager = self
+        while manager is not None:
+            chain.append(manager)
+            manager = manager.parent
+        for manager in reversed(chain):
+            for key, entry in manager.entries.items():
+                if entry.has_value:
+                    selected[key] = entry.selected
+        
+        providers = {}
+        for key, value in selected.iteritems():
+            if isinstance(value, SingletonProvider) and not value.built:
+                providers[key] = value
+        
+        graph = {}
+        for key, provider in providers.iteritems():
+            graph[key] = [dep for dep in provider.requires if dep in providers]
+        
+        cycle = find_cycle(graph)
+        if cycle is not None:
+            raise DependencyException(msg = "Circular dependency: %s." % (
+                " -> ".join([repr(key) for key in cycle]), ))
+        
+        return providers, graph
+    
+    def scope(self):
+        """Creates a child manager overlaying this one.
+        
+        Creating a scope is cheap, no entries are copied. The scope can be
+        used as a context manager, which makes it the current manager of
+        the calling thread (see :func:`current`)."""
+        return type(self)(parent = self)
 
 
 MANAGER = DefaultDependencyManager()
 
 
+def current():
+    """Returns the dependency manager of the calling thread.
+    
+    That is the innermost scope entered in the thread, or :data:`MANAGER`."""
+    manager = getattr(_LOCAL, "manager", None)
+    if manager is None:
+        return MANAGER
+    return manager
+
+
+def scope():
+    """Creates a child scope of the current manager.
+    
+    Changes made to the scope are not visible outside of it::
+        
+        with injection.scope():
+            injection.set("database", database)
+            handle_request()
+    """
+    return current().scope()
+
+
 def get(key, fallback = None):
     """Get the value of a dependency by a key."""
-    return MANAGER.get(key, fallback)
+    return current().get(key, fallback)
 
 
 def set(key, value, name = None):
     """Set the value of a dependency, optionally specifying a symbolic name."""
-    MANAGER.set(key, value, name)
+    current().set(key, value, name)
+
+
+def provide(key, factory, name = None, lifetime = SINGLETON, args = (), kwargs = None,
+            requires = None):
+    """Set a factory for a dependency, which is called lazily on the first
+    request for the value.
+    
+    The lifetime is one of :data:`SINGLETON` (built once and shared),
+    :data:`THREAD` (built once per thread) and :data:`TRANSIENT` (built
+    for every request). ``requires`` lists the keys of the dependencies
+    needed by the factory (see :func:`resolve_all`)."""
+    current().provide(key, factory, name, lifetime, args, kwargs, requires)
 
 
 def select(key, name):
     """Select an alternative for a dependency by name.
     
     An alternative can be selected by name before it is provided."""
-    MANAGER.select(key, name)
+    current().select(key, name)
 
 
 def clear():
     """Resets and clears all the values for the dependencies."""
-    MANAGER.clear()
+    current().clear()
+
+
+_MISSING = object()
+
 
+class InjectionPlan(object):
+    """Precomputed description of the constructor parameters of a class
+    filled from the dependency manager.
+    
+    The plan holds the ordered parameter names, the dependency key of every
+    parameter, the parameter defaults and whether the parameter is optional,
+    so that instantiating an autowired class doesn't need to introspect the
+    constructor again."""
+    
+    def __init__(self, init, keys = None):
+        keys = keys or {}
+        
+        try:
+            argspec = inspect.getargspec(init)
+        except TypeError:
+            # Constructors implemented in C (e.g. object.__init__)
+            # have no introspectable parameters.
+            names, defaults = [], ()
+        else:
+            names = argspec.args[1:]
+            defaults = argspec.defaults or ()
+        
+        first_default = len(names) - len(defaults)
+        
+        self.names = tuple(names)
+        self.keys = tuple([keys.get(name, name) for name in names])
+        self.optional = tuple([i >= first_default for i in range(len(names))])
+        self.defaults = dict(zip(names[first_default:], defaults))
+        
+        self.params = tuple(zip(self.names, self.keys, self.optional))
+    
+    def __repr__(self):
+        return "%s(%r)" % (type(self).__name__, self.params, )
+    
+    def resolve(self, args, kwargs):
+        """Fills the keyword arguments for parameters not given by the
+        caller, returns the updated ``kwargs``."""
+        for name, key, optional in self.params[len(args):]:
+            if name in kwargs:
+                continue
+            if optional:
+                value = get(key, _MISSING)
+                if value is _MISSING:
+                    value = self.defaults[name]
+                kwargs[name] = value
+            else:
+                kwargs[name] = get(key)
+        return kwargs
 
-def provides(key, name, *args, **kwargs):
-    """Class and function decorator which specifies dependencies by key and name.""" 
+
+def wire(cls, **keys):
+    """Makes the constructor of the class fill its parameters from the
+    dependency manager.
+    
+    Every parameter is resolved by the key given for it in ``keys``, or by
+    its name. Parameters with a default value are optional and keep the
+    default when the dependency is not set. Arguments passed by the caller
+    always take precedence.
+    
+    The injection plan is computed on the first instantiation and cached on
+    the class. Wiring the class again (e.g. with different keys) discards
+    the cached plan."""
+    init = cls.__dict__.get("__injection_init__")
+    if init is None:
+        init = cls.__init__
+        init = getattr(init, "im_func", init)
+    
+    def __init__(self, *args, **kwargs):
+        plan = get_plan(cls)
+        init(self, *args, **plan.resolve(args, kwargs))
+    
+    __init__.__doc__ = getattr(init, "__doc__", None)
+    
+    cls.__injection_init__ = init
+    cls.__injection_keys__ = keys
+    cls.__injection_plan__ = None
+    cls.__init__ = __init__
+    return cls
+
+
+def get_plan(cls):
+    """Returns the (cached) injection plan of a wired class, or ``None``
+    for anything else."""
+    attrs = getattr(cls, "__dict__", None)
+    if attrs is None:
+        return None
+    plan = attrs.get("__injection_plan__")
+    if plan is None:
+        init = attrs.get("__injection_init__")
+        if init is None:
+            return None
+        plan = InjectionPlan(init, attrs["__injection_keys__"])
+        cls.__injection_plan__ = plan
+    return plan
+
+
+def autowired(cls = None, **keys):
+    """Class decorator which wires the constructor of the class to the
+    dependency manager (see :func:`wire`).
+    
+    Can be used both as ``@autowired`` and ``@autowired(param = "key")``."""
+    if cls is not None:
+        return wire(cls, **keys)
+    def decorator(cls):
+        return wire(cls, **keys)
+    return decorator
+
+
+def resolve_all(workers = None):
+    """Builds all the singleton dependencies, independent ones concurrently
+    (see :meth:`DefaultDependencyManager.resolve_all`)."""
+    return current().resolve_all(workers)
+
+
+def resolve_all_async(loop = None):
+    """Coroutine building all the singleton dependencies in the event loop,
+    independent ones concurrently (see
+    :meth:`DefaultDependencyManager.resolve_all_async`)."""
+    return current().resolve_all_async(loop)
+
+
+def freeze():
+    """Switches the manager to the frozen, snapshot-backed resolution.
+    
+    Call this once all the dependencies are set. Further changes are still
+    allowed, they only invalidate the snapshot."""
+    current().freeze()
+
+
+def unfreeze():
+    """Switches the manager back to the regular resolution."""
+    current().unfreeze()
+
+
+def provides(key, name = None, *args, **kwargs):
+    """Class and function decorator which specifies dependencies by key and name.
+    
+    The decorated factory is not called until the dependency is requested.
+    The remaining arguments are passed to the factory, except for the
+    ``lifetime`` and ``requires`` keyword arguments (see :func:`provide`).""" 
+    lifetime = kwargs.pop("lifetime", SINGLETON)
+    requires = kwargs.pop("requires", None)
     def decorator(factory):
-        set(key, factory(*args, **kwargs), name = name)
+        provide(key, factory, name, lifetime, args, kwargs, requires)
         return factory
+    return decorator
 
 
 if __name__ == "__main__":
@@ -0,0 +1,209 @@
+# src/nmapps/logs.py
+
+"""
+Non-blocking logging.
+
+Logging calls only format the record and put the line to a bounded queue
+(:class:`QueueHandler`). A background thread (:class:`LogWriter`) writes the
+queued lines to the log file in batches, rotates the file by size and time
+and reopens it on request (e.g. on SIGHUP) or when it was replaced (by an
+external logrotate or by another process writing the same file, like the
+workers of a preforking daemon).
+"""
+
+import os
+import sys
+import errno
+import time
+import threading
+import logging
+import Queue
+
+
+__all__ = ["LogWriter", "QueueHandler", ]
+
+
+class LogWriter(object):
+    """
+    Writes lines queued by put() to a file from a background thread.
+    
+    When the queue is full, put() either drops the line (``overflow =
+    "drop"``, the number of dropped lines is logged afterwards) or waits
+    for a free slot (``overflow = "block"``). The file is rotated when it
+    grows over max_bytes or every rotate_interval seconds, keeping
+    backup_count old files (``path.1`` being the newest).
+    """
+    
+    DROP = "drop"
+    BLOCK = "block"
+    
+    def __init__(self, path, queue_size = 10000, overflow = DROP,
+                 max_bytes = None, backup_count = 5, rotate_interval = None,
+                 batch_size = 512):
+        if overflow not in (self.DROP, self.BLOCK, ):
+            raise ValueError("Unknown overflow behaviour %r." % (overflow, ))
+        
+        self.path = path
+        self.queue_size = queue_size
+        self.overflow = overflow
+        self.max_bytes = max_bytes
+        self.backup_count = backup_count
+        self.rotate_interval = rotate_interval
+        self.batch_size = batch_size
+        
+        self.queue = None
+        self.thread = None
+        self.file = None
+        self.inode = None
+        self.rollover_at = None
+        self.dropped = 0
+        self.reopen_requested = False
+    
+    def __repr__(self):
+        return "%s(%r)" % (type(self).__name__, self.path, )
+    
+    def start(self):
+        self.queue = Queue.Queue(self.queue_size)
+        self.open()
+        self.thread = threading.Thread(target = self.serve,
+                                       name = "nmapps.logs.LogWriter")
+        self.thread.daemon = True
+        self.thread.start()
+    
+    def stop(self):
+        """
+        Writes all the queued lines and stops the writer thread.
+        """
+        if self.thread is None:
+            return
+        self.queue.put(None)
+        self.thread.join()
+        self.thread = None
+        self.close()
+    
+    def after_fork(self):
+        """
+        Starts the writer again in a forked child, which doesn't inherit
+        the writer thread. Lines queued but not written by the parent are
+        discarded.
+        """
+        self.thread = None
+        self.file = None
+        self.start()
+    
+    def reopen(self):
+        """
+        Makes the writer thread reopen the log file before writing the next
+        batch.
+        """
+        self.reopen_requested = True
+        if self.queue is not None:
+            try:
+                self.queue.put_nowait("")
+            except Queue.Full:
+                pass
+    
+    def put(self, line):
+        if self.overflow == self.BLOCK:
+            self.queue.put(line)
+            return
+        try:
+            self.queue.put_nowait(line)
+        except Queue.Full:
+            self.dropped += 1
+    
+    def open(self):
+        self.file = open(self.path, "a")
+        self.inode = os.fstat(self.file.fileno()).st_ino
+        if self.rotate_interval:
+            self.rollover_at = time.time() + self.rotate_interval
+    
+    def close(self):
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+    
+    def replaced(self):
+        try:
+            return os.stat(self.path).st_ino != self.inode
+        except OSError as e:
+            if e.errno == errno.ENOENT:
+                return True
+            raise
+    
+    def rotate(self):
+        self.close()
+        if self.backup_count > 0:
+            for i in range(self.backup_count - 1, 0, -1):
+                source = "%s.%d" % (self.path, i, )
+                if os.path.exists(source):
+                    os.rename(source, "%s.%d" % (self.path, i + 1, ))
+            if os.path.exists(self.path):
+                os.rename(self.path, "%s.1" % (self.path, ))
+        else:
+            os.remove(self.path)
+        self.open()
+    
+    def serve(self):
+        queue = self.queue
+        stopping = False
+        
+        while not stopping:
+            batch = [queue.get()]
+            try:
+                while len(batch) < self.batch_size:
+                    batch.append(queue.get_nowait())
+            except Queue.Empty:
+                pass
+            if None in batch:
+                stopping = True
+                batch = batch[:batch.index(None)]
+            
+            try:
+                self.write(batch)
+            except Exception:
+                # There is nowhere else to log to.
+                sys.stderr.write("Failed to write the log %s.\n" % (self.path, ))
+    
+    def write(self, lines):
+        if self.reopen_requested or self.replaced():
+            self.reopen_requested = False
+            self.close()
+            self.open()
+        
+        if self.dropped:
+            dropped, self.dropped = self.dropped, 0
+            lines.insert(0, "%d log records were dropped.\n" % (dropped, ))
+        
+        data = "".join(lines)
+        if not data:
+            return
+        
+        self.file.write(data)
+        self.file.flush()
+        
+        if (self.max_bytes and self.file.tell() >= self.max_bytes) or \
+                (self.rollover_at is not None and time.time() >= self.rollover_at):
+            self.rotate()
+
+
+class QueueHandler(logging.Handler):
+    """
+    Logging handler which only formats the records and hands the lines to
+    a LogWriter.
+    """
+    
+    def __init__(self, writer, level = logging.NOTSET):
+        logging.Handler.__init__(self, level)
+        self.writer = writer
+    
+    def emit(self, record):
+        try:
+            line = self.format(record)
+            if isinstance(line, unicode):
+                line = line.encode("utf-8")
+            self.writer.put(line + "\n")
+        except (KeyboardInterrupt, SystemExit):
+            raise
+        except Exception:
+            self.handleError(record)
@@ -0,0 +1,260 @@
+# src/nmapps/metrics.py
+
+"""
+Resource usage sampling.
+
+A ResourceSampler periodically reads the resource usage of a process (its
+RSS, CPU utilisation, number of open file descriptors, context switches and
+for the current process also the garbage collector counters) and keeps the
+last samples in fixed-size ring buffers backed by arrays, so sampling
+doesn't allocate and the memory used by the history is constant.
+"""
+
+import os
+import gc
+import time
+import array
+import resource
+import threading
+
+try:
+    PAGE_SIZE = os.sysconf("SC_PAGE_SIZE")
+    CLOCK_TICKS = float(os.sysconf("SC_CLK_TCK"))
+except (ValueError, OSError, AttributeError):
+    PAGE_SIZE = 4096
+    CLOCK_TICKS = 100.0
+
+
+__all__ = ["RingBuffer", "ResourceSampler", "read_usage", "percentile", ]
+
+
+NAN = float("nan")
+
+
+def percentile(values, p):
+    """
+    Returns the p-th percentile (0 to 100) of the values, interpolating
+    linearly between the closest ranks. Returns None for no values.
+    """
+    values = sorted(values)
+    if not values:
+        return None
+    rank = (len(values) - 1) * p / 100.0
+    low = int(rank)
+    high = min(low + 1, len(values) - 1)
+    return values[low] + (values[high] - values[low]) * (rank - low)
+
+
+class RingBuffer(object):
+    """
+    Keeps the last ``capacity`` numbers in a preallocated array.
+    """
+    
+    def __init__(self, capacity, typecode = "d"):
+        if capacity < 1:
+            raise ValueError("Capacity must be positive, got %r." % (capacity, ))
+        self.capacity = capacity
+        self.data = array.array(typecode, [0]) * capacity
+        self.start = 0
+        self.count = 0
+    
+    def __repr__(self):
+        return "%s(%d/%d)" % (type(self).__name__, self.count, self.capacity, )
+    
+    def __len__(self):
+        return self.count
+    
+    def __iter__(self):
+        return iter(self.values())
+    
+    def append(self, value):
+        if self.count < self.capacity:
+            self.data[(self.start + self.count) % self.capacity] = value
+            self.count += 1
+        else:
+            self.data[self.start] = value
+            self.start = (self.start + 1) % self.capacity
+    
+    def values(self, count = None):
+        """
+        Returns a list of the last count values (all by default), the
+        oldest first.
+        """
+        if count is None or count > self.count:
+            count = self.count
+        first = (self.start + self.count - count) % self.capacity
+        end = first + count
+        if end <= self.capacity:
+            return self.data[first:end].tolist()
+        return (self.data[first:] + self.data[:end - self.capacity]).tolist()
+    
+    def last(self):
+        if self.count == 0:
+            return None
+        return self.data[(self.start + self.count - 1) % self.capacity]
+    
+    def clear(self):
+        self.start = 0
+        self.count = 0
+
+
+def read_proc_status(pid):
+    result = {}
+    with open("/proc/%s/status" % (pid, )) as f:
+        for line in f:
+            key, _, value = line.partition(":")
+            result[key] = value.strip()
+    return result
+
+
+def count_fds(pid):
+    paths = ["/proc/%s/fd" % (pid, )]
+    if pid == "self":
+        paths.append("/dev/fd")
+    for path in paths:
+        try:
+            count = len(os.listdir(path))
+        except OSError:
+            continue
+        if pid == "self":
+            # Without the descriptor of the listed directory.
+            count -= 1
+        return count
+    return NAN
+
+
+def read_usage(pid = None):
+    """
+    Returns the cumulative resource usage of the process (the current one
+    by default) as a dict: rss (bytes), cpu_time (seconds), fds, ctx_switches
+    and, for the current process, gc_count (objects tracked by the garbage
+    collector since the last collections) and gc_garbage (uncollectable
+    objects). The values which can't be read are NaN.
+    
+    Raises OSError or IOError if the process doesn't exist.
+    """
+    usage = {"gc_count": NAN, "gc_garbage": NAN, }
+    
+    if pid is None or pid == os.getpid():
+        rusage = resource.getrusage(resource.RUSAGE_SELF)
+        usage["cpu_time"] = rusage.ru_utime + rusage.ru_stime
+        usage["ctx_switches"] = rusage.ru_nvcsw + rusage.ru_nivcsw
+        try:
+            with open("/proc/self/statm") as f:
+                usage["rss"] = int(f.read().split()[1]) * PAGE_SIZE
+        except (IOError, OSError):
+            # The peak RSS, in kilobytes on Linux.
+            usage["rss"] = rusage.ru_maxrss * 1024
+        usage["fds"] = count_fds("self")
+        usage["gc_count"] = sum(gc.get_count())
+        usage["gc_garbage"] = len(gc.garbage)
+        return usage
+    
+    with open("/proc/%d/stat" % (pid, )) as f:
+        # The process name may contain spaces and parentheses.
+        fields = f.read().rsplit(")", 1)[1].split()
+    usage["cpu_time"] = (int(fields[11]) + int(fields[12])) / CLOCK_TICKS
+    usage["rss"] = int(fields[21]) * PAGE_SIZE
+    status = read_proc_status(pid)
+    usage["ctx_switches"] = (int(status.get("voluntary_ctxt_switches", 0)) +
+                             int(status.get("nonvoluntary_ctxt_switches", 0)))
+    usage["fds"] = count_fds(pid)
+    return usage
+
+
+class ResourceSampler(object):
+    """
+    Samples the resource usage of a process (the current one by default)
+    into ring buffers holding the last ``capacity`` samples.
+    
+    A sample has the fields listed in FIELDS: time (timestamp), rss
+    (bytes), cpu (percent of a CPU used since the previous sample), fds,
+    ctx_switches (per second since the previous sample), gc_count and
+    gc_garbage (see read_usage()).
+    """
+    
+    FIELDS = ("time", "rss", "cpu", "fds", "ctx_switches", "gc_count", "gc_garbage", )
+    # Fields summarized by summary().
+    GAUGES = ("rss", "cpu", "fds", "ctx_switches", "gc_count", "gc_garbage", )
+    
+    def __init__(self, capacity = 360, pid = None):
+        self.capacity = capacity
+        self.pid = pid
+        self.buffers = dict([(field, RingBuffer(capacity)) for field in self.FIELDS])
+        self.previous = None
+        # Samples are usually read by another thread (e.g. a control command).
+        self.lock = threading.Lock()
+    
+    def __repr__(self):
+        return "%s(pid = %r, %d samples)" % (type(self).__name__, self.pid, len(self), )
+    
+    def __len__(self):
+        return len(self.buffers["time"])
+    
+    def sample(self):
+        """
+        Reads and stores a sample. Returns False if the process doesn't
+        exist anymore.
+        """
+        now = time.time()
+        try:
+            usage = read_usage(self.pid)
+        except (IOError, OSError):
+            return False
+        
+        cpu = ctx_switches = NAN
+        if self.previous is not None:
+            elapsed = now - self.previous[0]
+            if elapsed > 0:
+                cpu = 100.0 * (usage["cpu_time"] - self.previous[1]["cpu_time"]) / elapsed
+                ctx_switches = (usage["ctx_switches"] -
+                                self.previous[1]["ctx_switches"]) / elapsed
+        self.previous = (now, usage)
+        
+        values = dict(usage, time = now, cpu = cpu, ctx_switches = ctx_switches)
+        with self.lock:
+            for field in self.FIELDS:
+                self.buffers[field].append(values[field])
+        return True
+    
+    def samples(self, count = None):
+        """
+        Returns a list of the last count samples (as dicts), the oldest
+        first.
+        """
+        with self.lock:
+            columns = [(field, self.buffers[field].values(count))
+                       for field in self.FIELDS]
+        return [dict([(field, clean(values[i])) for field, values in columns])
+                for i in range(len(columns[0][1]))]
+    
+    def summary(self, percentiles = (50, 90, 99, )):
+        """
+        Returns a dict mapping the gauge fields to dicts with the last,
+        minimal, maximal and mean value and the percentiles ("p50" etc.)
+        of the stored samples.
+        """
+        with self.lock:
+            columns = [(field, self.buffers[field].values())
+                       for field in self.GAUGES]
+        
+        result = {}
+        for field, values in columns:
+            stats = {"last": clean(values[-1]) if values else None, }
+            # Without NaNs.
+            values = [value for value in values if value == value]
+            if values:
+                stats["min"] = min(values)
+                stats["max"] = max(values)
+                stats["mean"] = sum(values) / len(values)
+            for p in percentiles:
+                stats["p%g" % (p, )] = percentile(values, p)
+            result[field] = stats
+        return result
+
+
+def clean(value):
+    """Replaces NaN by None (NaN is not valid JSON)."""
+    if value is None or value != value:
+        return None
+    return value
@@ -0,0 +1,244 @@
+# src/nmapps/resources.py
+
+"""
+Resource profiles of daemon processes.
+
+A ResourceProfile describes the CPU affinity, resource limits, scheduling
+priority and I/O priority a daemon should run with, so they don't have to
+be set by wrapper scripts (taskset, ulimit, nice, ionice). Settings which
+can't be applied raise ResourceException.
+"""
+
+import os
+import ctypes
+import ctypes.util
+import platform
+import resource
+
+from nmapps.utils import UserException
+
+
+__all__ = ["ResourceException", "ResourceProfile", "parse_cpus",
+           "get_affinity", "set_affinity", "set_priority", "set_io_priority", ]
+
+
+class ResourceException(UserException):
+    pass
+
+
+# I/O scheduling classes, see ioprio_set(2).
+IOPRIO_CLASSES = {"none": 0, "rt": 1, "realtime": 1, "be": 2, "best-effort": 2, "idle": 3, }
+IOPRIO_CLASS_SHIFT = 13
+IOPRIO_WHO_PROCESS = 1
+
+# Number of the ioprio_set system call on Linux.
+IOPRIO_SET_SYSCALLS = {
+    "x86_64": 251, "amd64": 251,
+    "i386": 289, "i486": 289, "i586": 289, "i686": 289,
+    "aarch64": 30, "arm64": 30,
+    "armv7l": 314, "armv6l": 314,
+    "ppc64": 273, "ppc64le": 273,
+    "s390x": 282,
+}
+
+PRIO_PROCESS = 0
+
+# Size of cpu_set_t in bytes (CPU_SETSIZE = 1024).
+CPU_SET_SIZE = 128
+
+_LIBC = []
+
+
+def libc():
+    if not _LIBC:
+        _LIBC.append(ctypes.CDLL(ctypes.util.find_library("c"), use_errno = True))
+    return _LIBC[0]
+
+
+def parse_cpus(cpus):
+    """
+    Returns a sorted list of CPU numbers from a list of numbers or a string
+    like ``"0-3,6"``.
+    """
+    if isinstance(cpus, basestring):
+        result = set()
+        for part in cpus.split(","):
+            part = part.strip()
+            if not part:
+                continue
+            try:
+                if "-" in part:
+                    first, last = part.split("-", 1)
+                    result.update(range(int(first), int(last) + 1))
+                else:
+                    result.add(int(part))
+            except ValueError:
+                raise ResourceException(msg = "Invalid CPU list: %r" % (cpus, ))
+        cpus = result
+    cpus = sorted(set(cpus))
+    if not cpus:
+        raise ResourceException(msg = "Empty CPU list.")
+    for cpu in cpus:
+        if not 0 <= cpu < CPU_SET_SIZE * 8:
+            raise ResourceException(msg = "Invalid CPU number: %r" % (cpu, ))
+    return cpus
+
+
+def get_affinity(pid = 0):
+    """
+    Returns the sorted list of CPUs the process (the current one by
+    default) may run on.
+    """
+    if hasattr(os, "sched_getaffinity"):
+        return sorted(os.sched_getaffinity(pid))
+    mask = ctypes.create_string_buffer(CPU_SET_SIZE)
+    if libc().sched_getaffinity(pid, CPU_SET_SIZE, mask) != 0:
+        raise ResourceException(msg = "Cannot get CPU affinity: %s" % (
+            os.strerror(ctypes.get_errno()), ))
+    return [cpu for cpu in range(CPU_SET_SIZE * 8)
+            if ord(mask.raw[cpu // 8]) & (1 << (cpu % 8))]
+
+
+def set_affinity(cpus, pid = 0):
+    cpus = parse_cpus(cpus)
+    if hasattr(os, "sched_setaffinity"):
+        try:
+            os.sched_setaffinity(pid, cpus)
+        except OSError as e:
+            raise ResourceException(
+                msg = "Cannot set CPU affinity to %s: %s" % (cpus, e.strerror, ))
+        return
+    mask = bytearray(CPU_SET_SIZE)
+    for cpu in cpus:
+        mask[cpu // 8] |= 1 << (cpu % 8)
+    buf = ctypes.create_string_buffer(bytes(mask), CPU_SET_SIZE)
+    if libc().sched_setaffinity(pid, CPU_SET_SIZE, buf) != 0:
+        raise ResourceException(msg = "Cannot set CPU affinity to %s: %s" % (
+            cpus, os.strerror(ctypes.get_errno()), ))
+
+
+def set_priority(nice, pid = 0):
+    """
+    Sets the scheduling priority (the absolute nice value, -20 to 19).
+    """
+    if hasattr(os, "setpriority"):
+        try:
+            os.setpriority(os.PRIO_PROCESS, pid, nice)
+        except OSError as e:
+            raise ResourceException(
+                msg = "Cannot set the nice value to %d: %s" % (nice, e.strerror, ))
+        return
+    if libc().setpriority(PRIO_PROCESS, pid, nice) != 0:
+        raise ResourceException(msg = "Cannot set the nice value to %d: %s" % (
+            nice, os.strerror(ctypes.get_errno()), ))
+
+
+def parse_io_priority(value):
+    """
+    Returns an (I/O scheduling class, level) tuple from a tuple or a string
+    like ``"be/4"``, ``"idle"`` or ``"rt/0"``.
+    """
+    if isinstance(value, basestring):
+        if "/" in value:
+            name, level = value.split("/", 1)
+        else:
+            name, level = value, 0
+        try:
+            value = (IOPRIO_CLASSES[name.strip().lower()], int(level), )
+        except (KeyError, ValueError):
+            raise ResourceException(msg = "Invalid I/O priority: %r" % (value, ))
+    io_class, level = value
+    if io_class not in IOPRIO_CLASSES.values() or not 0 <= level <= 7:
+        raise ResourceException(msg = "Invalid I/O priority: %r" % (value, ))
+    return io_class, level
+
+
+def set_io_priority(value, pid = 0):
+    """
+    Sets the I/O scheduling class and level, see ionice(1). Linux only.
+    """
+    io_class, level = parse_io_priority(value)
+    number = IOPRIO_SET_SYSCALLS.get(platform.machine().lower())
+    if number is None:
+        raise ResourceException(
+            msg = "I/O priority is not supported on %s." % (platform.machine(), ))
+    ioprio = (io_class << IOPRIO_CLASS_SHIFT) | level
+    if libc().syscall(number, IOPRIO_WHO_PROCESS, pid, ioprio) != 0:
+        raise ResourceException(msg = "Cannot set the I/O priority to %r: %s" % (
+            value, os.strerror(ctypes.get_errno()), ))
+
+
+def set_limit(name, limit, value):
+    """
+    Sets a resource limit to a number (both the soft and hard limit), a
+    (soft, hard) tuple or "unlimited".
+    """
+    if value == "unlimited" or value is None:
+        value = (resource.RLIM_INFINITY, resource.RLIM_INFINITY, )
+    elif isinstance(value, (int, long)):
+        value = (value, value, )
+    soft, hard = value
+    if hard == "unlimited":
+        hard = resource.RLIM_INFINITY
+    if soft == "unlimited":
+        soft = resource.RLIM_INFINITY
+    try:
+        resource.setrlimit(limit, (soft, hard, ))
+    except (ValueError, resource.error) as e:
+        raise ResourceException(msg = "Cannot set %s to %r: %s" % (name, value, e, ))
+
+
+class ResourceProfile(object):
+    """
+    Resources of a daemon process:
+    
+    - cpus -- CPUs the daemon may run on, a list or a string like ``"0-3"``;
+    - pin_workers -- pin the n-th worker of a preforking daemon to the n-th
+      CPU of cpus, or of the CPUs the daemon may run on (modulo their
+      number);
+    - nofile, core -- RLIMIT_NOFILE and RLIMIT_CORE, a number (used as both
+      the soft and hard limit), a (soft, hard) tuple or "unlimited";
+    - nice -- the nice value, -20 to 19;
+    - ionice -- the I/O priority, a (class, level) tuple or a string like
+      ``"be/4"``, ``"idle"`` or ``"rt/0"``.
+    
+    None leaves the inherited setting.
+    """
+    
+    def __init__(self, cpus = None, pin_workers = False, nofile = None,
+                 core = None, nice = None, ionice = None):
+        self.cpus = parse_cpus(cpus) if cpus is not None else None
+        self.pin_workers = pin_workers
+        self.nofile = nofile
+        self.core = core
+        self.nice = nice
+        self.ionice = parse_io_priority(ionice) if ionice is not None else None
+    
+    def __repr__(self):
+        return "%s(%s)" % (type(self).__name__, ", ".join([
+            "%s = %r" % (key, value, )
+            for key, value in sorted(self.__dict__.items())
+            if value is not None]), )
+    
+    def apply(self):
+        """
+        Applies the profile to the current process.
+        """
+        if self.nofile is not None:
+            set_limit("RLIMIT_NOFILE", resource.RLIMIT_NOFILE, self.nofile)
+        if self.core is not None:
+            set_limit("RLIMIT_CORE", resource.RLIMIT_CORE, self.core)
+        if self.cpus is not None:
+            set_affinity(self.cpus)
+        if self.nice is not None:
+            set_priority(self.nice)
+        if self.ionice is not None:
+            set_io_priority(self.ionice)
+    
+    def apply_worker(self, index):
+        """
+        Pins the current process (a worker) to its CPU.
+        """
+        if self.pin_workers:
+            cpus = self.cpus if self.cpus is not None else get_affinity()
+            set_affinity([cpus[index % len(cpus)]])
@@ -0,0 +1,389 @@
+# src/nmapps/scheduler.py
+
+"""
+Periodic jobs.
+
+A Scheduler keeps its jobs in a heap ordered by the time of their next run,
+so adding a job and finding the next one to run is O(log n) regardless of
+the number of jobs. A single thread waits for the earliest job (or for a
+wakeup when jobs are added or the scheduler stops) and hands the due jobs
+to a bounded thread pool.
+
+The runs are scheduled from the previous scheduled time, not from the end
+of the previous run, so intervals don't drift. Runs missed because the
+process was busy are skipped rather than run in a burst.
+"""
+
+import os
+import time
+import errno
+import fcntl
+import heapq
+import random
+import select
+import datetime
+import itertools
+import threading
+import logging
+import Queue
+
+from nmapps.utils import UserException, ThreadPool
+
+
+__all__ = ["SchedulerException", "Interval", "Cron", "Job", "Scheduler", ]
+
+
+LOGGER = logging.getLogger(__name__)
+
+
+class SchedulerException(UserException):
+    pass
+
+
+class Interval(object):
+    """
+    Runs a job every ``seconds`` seconds, first at ``start`` (a timestamp,
+    by default one interval from now).
+    """
+
+    def __init__(self, seconds, start = None):
+        if seconds <= 0:
+            raise SchedulerException(msg = "Interval must be positive, got %r." % (seconds, ))
+        self.seconds = seconds
+        self.start = start
+
+    def __repr__(self):
+        return "%s(%r)" % (type(self).__name__, self.seconds, )
+
+    def first(self, now):
+        if self.start is None:
+            return now + self.seconds
+        return self.next(self.start - self.seconds, now)
+
+    def next(self, scheduled, now):
+        result = scheduled + self.seconds
+        if result <= now:
+            # Skips the missed runs.
+            result += (int((now - result) / self.seconds) + 1) * self.seconds
+        return result
+
+
+class Cron(object):
+    """
+    Runs a job at the times matching a crontab expression (in local time):
+    minute, hour, day of month, month and day of week (0 or 7 is Sunday).
+    The fields can be ``*``, numbers, ranges (``1-5``), steps (``*/15``,
+    ``0-30/10``) and lists of those (``0,30``). Aliases like ``@hourly``
+    are supported as well.
+    """
+
+    ALIASES = {
+        "@yearly": "0 0 1 1 *",
+        "@annually": "0 0 1 1 *",
+        "@monthly": "0 0 1 * *",
+        "@weekly": "0 0 * * 0",
+        "@daily": "0 0 * * *",
+        "@midnight": "0 0 * * *",
+        "@hourly": "0 * * * *",
+    }
+
+    # (minimum, maximum) of the fields
+    RANGES = [(0, 59), (0, 23), (1, 31), (1, 12), (0, 7), ]
+
+    # Years to search for a matching time before giving up (e.g. for
+    # February 30).
+    max_years = 8
+
+    def __init__(self, expression):
+        self.expression = expression
+        fields = self.ALIASES.get(expression.strip(), expression).split()
+        if len(fields) != 5:
+            raise SchedulerException(
+                msg = "Cron expression must have 5 fields: %r" % (expression, ))
+
+        self.minutes, self.hours, self.days, self.months, weekdays = [
+            self.parse_field(field, low, high, )
+            for field, (low, high) in zip(fields, self.RANGES)]
+        self.weekdays = frozenset([day % 7 for day in weekdays])
+
+        # Like cron, when both the day of month and the day of week are
+        # restricted, a day matching either of them matches.
+        self.any_day = fields[2] == "*"
+        self.any_weekday = fields[4] == "*"
+
+    def __repr__(self):
+        return "%s(%r)" % (type(self).__name__, self.expression, )
+
+    def parse_field(self, field, low, high):
+        result = set()
+        for part in field.split(","):
+            step = 1
+            if "/" in part:
+                part, step = part.split("/", 1)
+                step = self.parse_number(step, 1, high)
+            if part == "*":
+                start, end = low, high
+            elif "-" in part:
+                start, end = part.split("-", 1)
+                start = self.parse_number(start, low, high)
+                end = self.parse_number(end, low, high)
+            else:
+                start = end = self.parse_number(part, low, high)
+            if start > end:
+                raise SchedulerException(msg = "Invalid cron range: %r" % (field, ))
+            result.update(range(start, end + 1, step))
+        return frozenset(result)
+
+    def parse_number(self, value, low, high):
+        try:
+            result = int(value)
+        except ValueError:
+            raise SchedulerException(msg = "Invalid cron value: %r" % (value, ))
+        if not low <= result <= high:
+            raise SchedulerException(
+                msg = "Cron value %d out of range %d-%d." % (result, low, high, ))
+        return result
+
+    def match_day(self, t):
+        day = t.day in self.days
+        weekday = (t.weekday() + 1) % 7 in self.weekdays
+        if self.any_day:
+            return weekday
+        if self.any_weekday:
+            return day
+        return day or weekday
+
+    def first(self, now):
+        return self.next(now, now)
+
+    def next(self, scheduled, now):
+        t = datetime.datetime.fromtimestamp(max(scheduled, now))
+        t = t.replace(second = 0, microsecond = 0) + datetime.timedelta(minutes = 1)
+        last_year = t.year + self.max_years
+
+        while t.year <= last_year:
+            if t.month not in self.months:
+                if t.month == 12:
+                    t = t.replace(year = t.year + 1, month = 1, day = 1, hour = 0, minute = 0)
+                else:
+                    t = t.replace(month = t.month + 1, day = 1, hour = 0, minute = 0)
+            elif not self.match_day(t):
+                t = t.replace(hour = 0, minute = 0) + datetime.timedelta(days = 1)
+            elif t.hour not in self.hours:
+                t = t.replace(minute = 0) + datetime.timedelta(hours = 1)
+            elif t.minute not in self.minutes:
+                t += datetime.timedelta(minutes = 1)
+            else:
+                return time.mktime(t.timetuple())
+
+        raise SchedulerException(
+            msg = "Cron expression %r never matches." % (self.expression, ))
+
+
+class Job(object):
+    """
+    A function called by a Scheduler according to a trigger (Interval or
+    Cron).
+
+    Unless ``overlap`` is True, a run is skipped when the previous one is
+    still running. Every run is delayed by a random number of seconds up to
+    ``jitter``, so jobs of many processes don't run all at once.
+    """
+
+    def __init__(self, func, trigger, args = (), kwargs = None, name = None,
+                 overlap = False, jitter = 0.0):
+        self.func = func
+        self.trigger = trigger
+        self.args = args
+        self.kwargs = kwargs or {}
+        self.name = name or getattr(func, "__name__", repr(func))
+        self.overlap = overlap
+        self.jitter = jitter
+
+        # Time of the next run without the jitter.
+        self.scheduled = None
+        self.running = 0
+        self.cancelled = False
+
+        self.runs = 0
+        self.skipped = 0
+        self.failures = 0
+        self.last_run = None
+
+    def __repr__(self):
+        return "%s(%r, %r)" % (type(self).__name__, self.name, self.trigger, )
+
+    def __call__(self):
+        return self.func(*self.args, **self.kwargs)
+
+    def cancel(self):
+        self.cancelled = True
+
+
+class Scheduler(object):
+    """
+    Runs jobs on a pool of at most ``workers`` threads. At most
+    ``queue_size`` runs wait for a free thread, further runs are skipped.
+    """
+
+    def __init__(self, workers = 4, queue_size = 100, logger = LOGGER):
+        self.workers = workers
+        self.queue_size = queue_size
+        self.logger = logger
+
+        self.heap = []
+        self.counter = itertools.count()
+        self.lock = threading.Lock()
+        self.pool = None
+        self.thread = None
+        self.wakeup = None
+        self.stopped = False
+
+    def __repr__(self):
+        return "%s(%d jobs)" % (type(self).__name__, len(self.heap), )
+
+    @property
+    def jobs(self):
+        with self.lock:
+            return sorted([job for at, n, job in self.heap if not job.cancelled],
+                          key = lambda job: job.scheduled)
+
+    def add(self, job):
+        with self.lock:
+            job.scheduled = job.trigger.first(time.time())
+            self.push(job)
+        self.notify()
+        return job
+
+    def every(self, seconds, func, *args, **options):
+        """
+        Calls func(*args) every ``seconds`` seconds. The options are passed
+        to Job (name, overlap, jitter), except ``start`` which is passed to
+        Interval.
+        """
+        trigger = Interval(seconds, options.pop("start", None))
+        return self.add(Job(func, trigger, args, **options))
+
+    def cron(self, expression, func, *args, **options):
+        """
+        Calls func(*args) at the times matching the crontab expression.
+        The options are passed to Job (name, overlap, jitter).
+        """
+        return self.add(Job(func, Cron(expression), args, **options))
+
+    def remove(self, job):
+        # The job is dropped from the heap when it is due.
+        job.cancel()
+
+    def push(self, job):
+        at = job.scheduled
+        if job.jitter:
+            at += random.uniform(0, job.jitter)
+        heapq.heappush(self.heap, (at, next(self.counter), job))
+
+    def start(self):
+        self.stopped = False
+        self.pool = ThreadPool(self.workers, self.queue_size,
+                               name = "nmapps.scheduler.worker")
+        self.wakeup = os.pipe()
+        for fd in self.wakeup:
+            fcntl.fcntl(fd, fcntl.F_SETFL,
+                        fcntl.fcntl(fd, fcntl.F_GETFL) | os.O_NONBLOCK)
+            fcntl.fcntl(fd, fcntl.F_SETFD,
+                        fcntl.fcntl(fd, fcntl.F_GETFD) | fcntl.FD_CLOEXEC)
+        self.thread = threading.Thread(target = self.serve, name = "nmapps.scheduler")
+        self.thread.daemon = True
+        self.thread.start()
+
+    def stop(self, wait = True):
+        """
+        Stops scheduling the jobs. With wait, waits for the running jobs
+        to finish. Can be called from a signal handler with wait = False.
+        """
+        if self.thread is None:
+            return
+        self.stopped = True
+        self.notify()
+        if wait:
+            self.thread.join()
+            self.thread = None
+            self.pool.shutdown()
+            for fd in self.wakeup:
+                os.close(fd)
+            self.wakeup = None
+
+    def notify(self):
+        if self.wakeup is None:
+            return
+        try:
+            os.write(self.wakeup[1], "x")
+        except OSError as e:
+            # The pipe is full, the thread wakes up anyway.
+            if e.errno != errno.EAGAIN:
+                raise
+
+    def serve(self):
+        wakeup = self.wakeup[0]
+
+        while not self.stopped:
+            timeout = None
+            due = []
+            now = time.time()
+            with self.lock:
+                while self.heap:
+                    at, n, job = self.heap[0]
+                    if job.cancelled:
+                        heapq.heappop(self.heap)
+                    elif at <= now:
+                        heapq.heappop(self.heap)
+                        due.append(job)
+                        job.scheduled = job.trigger.next(job.scheduled, now)
+                        self.push(job)
+                    else:
+                        timeout = at - now
+                        break
+
+            for job in due:
+                self.dispatch(job)
+            if due:
+                continue
+
+            try:
+                select.select([wakeup], [], [], timeout)
+            except (select.error, OSError, IOError) as e:
+                if e.args[0] != errno.EINTR:
+                    raise
+            try:
+                while os.read(wakeup, 512):
+                    pass
+            except OSError as e:
+                if e.errno != errno.EAGAIN:
+                    raise
+
+    def dispatch(self, job):
+        with self.lock:
+            if job.running and not job.overlap:
+                job.skipped += 1
+                self.logger.debug("Skipping job %s, it is still running.", job.name)
+                return
+            job.running += 1
+
+        try:
+            self.pool.submit_ex(self.execute, (job, ), block = False)
+        except Queue.Full:
+            with self.lock:
+                job.running -= 1
+                job.skipped += 1
+            self.logger.warning("Skipping job %s, all the workers are busy.", job.name)
+
+    def execute(self, job):
+        job.last_run = time.time()
+        try:
+            job()
+        except Exception:
+            job.failures += 1
+            self.logger.exception("Job %s failed.", job.name)
+        finally:
+            with self.lock:
+                job.running -= 1
+                job.runs += 1
@@ -0,0 +1,281 @@
+# src/nmapps/shared.py
+
+"""
+Counters and small records shared by the processes of a daemon.
+
+The memory is mapped before the daemon forks its workers, so all of them
+update the same pages without any IPC. Every process has its own slot of
+counters (padded to a cache line), so increments never race between
+processes and the value of a counter is the sum of its slots. Records are
+fixed-size structs (see the struct module) protected by a sequence lock:
+readers retry until they read a record no writer was changing.
+
+With a path, the memory is backed by a file, which also describes its
+layout, so other processes (e.g. the status command) can read it with
+SharedState.attach(). Writers of a record then take a lock of its bytes in
+the file, otherwise a record should only be written by a single process.
+
+Python has no memory barriers, so the counters and records are as atomic
+as aligned 8 byte writes of the platform (they are on x86-64 and ARM64).
+"""
+
+import os
+import mmap
+import json
+import fcntl
+import struct
+import threading
+
+from nmapps.utils import UserException
+
+
+__all__ = ["SharedException", "SharedState", ]
+
+
+MAGIC = "NMSH"
+VERSION = 1
+# magic, version, length of the JSON layout
+HEADER = struct.Struct("=4sII")
+COUNTER = struct.Struct("=q")
+SEQUENCE = struct.Struct("=Q")
+CACHE_LINE = 64
+
+
+class SharedException(UserException):
+    pass
+
+
+def align(value, alignment):
+    return (value + alignment - 1) // alignment * alignment
+
+
+class SharedState(object):
+    """
+    Integer counters and fixed-size records in shared memory.
+    
+    counters is a list of counter names, records maps record names to
+    struct formats (e.g. ``{"last_request": "dq"}``) and slots is the
+    number of processes updating the counters (e.g. the number of workers
+    plus one for the master). Each process selects its slot by
+    after_fork().
+    """
+    
+    def __init__(self, counters = (), records = None, slots = 1, path = None):
+        self.counters = list(counters)
+        self.records = dict(records or {})
+        self.slots = slots
+        self.path = path
+        
+        self.slot = 0
+        self.lock = threading.Lock()
+        self.map = None
+        self.fd = None
+        # The file until publish() renames it to the path.
+        self.temp_path = None
+        self.layout()
+    
+    def __repr__(self):
+        return "%s(%r, slots = %d)" % (type(self).__name__, self.path, self.slots, )
+    
+    def layout(self):
+        """
+        Computes the offsets of the counters and records.
+        """
+        description = json.dumps({
+            "counters": self.counters,
+            "records": self.records,
+            "slots": self.slots,
+        }, sort_keys = True)
+        self.description = description
+        offset = align(HEADER.size + len(description), CACHE_LINE)
+        
+        self.counter_index = dict([(name, i) for i, name in enumerate(self.counters)])
+        self.counters_offset = offset
+        self.slot_size = align(len(self.counters) * COUNTER.size, CACHE_LINE)
+        offset += self.slot_size * self.slots
+        
+        # name -> (offset of the sequence, struct of the record)
+        self.record_layout = {}
+        for name in sorted(self.records):
+            try:
+                record = struct.Struct("=" + self.records[name].lstrip("@=<>!"))
+            except struct.error as e:
+                raise SharedException(msg = "Invalid format of record %s: %s" % (name, e, ))
+            self.record_layout[name] = (offset, record)
+            offset = align(offset + SEQUENCE.size + record.size, CACHE_LINE)
+        
+        self.size = max(offset, mmap.PAGESIZE)
+    
+    def create(self, publish = True):
+        """
+        Maps new zeroed memory (in the file, if the state has a path).
+        Call before forking the processes sharing the state.
+        
+        Without publish, the file is created under a temporary name until
+        publish() is called, so it doesn't replace the file of another
+        process yet.
+        """
+        if self.path is None:
+            self.map = mmap.mmap(-1, self.size, mmap.MAP_SHARED)
+        else:
+            temp = "%s.%d.tmp" % (self.path, os.getpid(), )
+            fd = os.open(temp, os.O_RDWR | os.O_CREAT | os.O_TRUNC, 0644)
+            fcntl.fcntl(fd, fcntl.F_SETFD, fcntl.fcntl(fd, fcntl.F_GETFD) | fcntl.FD_CLOEXEC)
+            try:
+                os.ftruncate(fd, self.size)
+                self.map = mmap.mmap(fd, self.size, mmap.MAP_SHARED)
+            except:
+                os.close(fd)
+                os.remove(temp)
+                raise
+            self.fd = fd
+            self.temp_path = temp
+            if publish:
+                self.publish()
+        self.map[:HEADER.size + len(self.description)] = (
+            HEADER.pack(MAGIC, VERSION, len(self.description)) + self.description)
+        return self
+    
+    def publish(self):
+        """
+        Renames the file created by create() to the path. Replaces the file
+        atomically, processes reading the old one keep their mapping.
+        """
+        if self.temp_path is not None:
+            os.rename(self.temp_path, self.path)
+            self.temp_path = None
+    
+    @classmethod
+    def attach(cls, path):
+        """
+        Maps the state file created by another process for reading.
+        """
+        with open(path, "rb") as f:
+            size = os.fstat(f.fileno()).st_size
+            if size < HEADER.size:
+                raise SharedException(msg = "%s is not a shared state file." % (path, ))
+            data = mmap.mmap(f.fileno(), size, mmap.MAP_SHARED, mmap.PROT_READ)
+        magic, version, length = HEADER.unpack_from(data, 0)
+        if magic != MAGIC or version != VERSION:
+            data.close()
+            raise SharedException(msg = "%s is not a shared state file." % (path, ))
+        description = json.loads(data[HEADER.size:HEADER.size + length])
+        
+        state = cls(description["counters"], description["records"],
+                    description["slots"], path)
+        if state.size > size:
+            data.close()
+            raise SharedException(msg = "%s is truncated." % (path, ))
+        state.map = data
+        return state
+    
+    def close(self):
+        if self.map is not None:
+            self.map.close()
+            self.map = None
+        if self.fd is not None:
+            os.close(self.fd)
+            self.fd = None
+    
+    def remove(self):
+        """
+        Closes the state and removes its file, unless the file was already
+        replaced by another process (e.g. the next generation of a daemon).
+        """
+        if self.path is not None and self.fd is not None:
+            try:
+                if self.temp_path is not None:
+                    os.remove(self.temp_path)
+                elif os.stat(self.path).st_ino == os.fstat(self.fd).st_ino:
+                    os.remove(self.path)
+            except OSError:
+                pass
+            self.temp_path = None
+        self.close()
+    
+    def after_fork(self, slot):
+        """
+        Makes the current (forked) process use the slot for its counters.
+        """
+        if not 0 <= slot < self.slots:
+            raise SharedException(msg = "Invalid slot %d of %d." % (slot, self.slots, ))
+        self.slot = slot
+        # The lock could have been held by another thread at the fork.
+        self.lock = threading.Lock()
+    
+    def counter_offset(self, name, slot):
+        try:
+            index = self.counter_index[name]
+        except KeyError:
+            raise SharedException(msg = "Unknown counter %s." % (name, ))
+        return self.counters_offset + slot * self.slot_size + index * COUNTER.size
+    
+    def incr(self, name, value = 1):
+        """
+        Adds the value to the counter (in the slot of the current process),
+        returns the new value of the slot.
+        """
+        offset = self.counter_offset(name, self.slot)
+        with self.lock:
+            value += COUNTER.unpack_from(self.map, offset)[0]
+            COUNTER.pack_into(self.map, offset, value)
+        return value
+    
+    def get_slots(self, name):
+        return [COUNTER.unpack_from(self.map, self.counter_offset(name, slot))[0]
+                for slot in range(self.slots)]
+    
+    def get(self, name):
+        """
+        Returns the sum of the counter over all the processes.
+        """
+        return sum(self.get_slots(name))
+    
+    def record_offset(self, name):
+        try:
+            return self.record_layout[name]
+        except KeyError:
+            raise SharedException(msg = "Unknown record %s." % (name, ))
+    
+    def set_record(self, name, *values):
+        offset, record = self.record_offset(name)
+        data = record.pack(*values)
+        with self.lock:
+            if self.fd is not None:
+                fcntl.lockf(self.fd, fcntl.LOCK_EX, record.size + SEQUENCE.size, offset)
+            try:
+                sequence = SEQUENCE.unpack_from(self.map, offset)[0]
+                # An odd sequence marks a record being written.
+                SEQUENCE.pack_into(self.map, offset, sequence + 1)
+                self.map[offset + SEQUENCE.size:offset + SEQUENCE.size + record.size] = data
+                SEQUENCE.pack_into(self.map, offset, sequence + 2)
+            finally:
+                if self.fd is not None:
+                    fcntl.lockf(self.fd, fcntl.LOCK_UN, record.size + SEQUENCE.size, offset)
+    
+    def get_record(self, name, attempts = 1000):
+        """
+        Returns the values of the record as a tuple (zeros if it was never
+        written).
+        """
+        offset, record = self.record_offset(name)
+        start = offset + SEQUENCE.size
+        for i in xrange(attempts):
+            before = SEQUENCE.unpack_from(self.map, offset)[0]
+            if before & 1:
+                continue
+            data = self.map[start:start + record.size]
+            if SEQUENCE.unpack_from(self.map, offset)[0] == before:
+                return record.unpack(data)
+        raise SharedException(msg = "Record %s is being written for too long." % (name, ))
+    
+    def snapshot(self):
+        """
+        Returns a dict with the totals of the counters ("counters") and
+        the values of the records ("records").
+        """
+        return {
+            "counters": dict([(name, self.get(name)) for name in self.counters]),
+            "records": dict([(name, list(self.get_record(name)))
+                             for name in self.records]),
+        }
@@ -0,0 +1,97 @@
+# src/nmapps/tests/bench_fs.py
+
+"""Benchmark of :meth:`nmapps.fs.Directory.walk` on a synthetic tree,
+compared with :func:`os.walk`.
+
+Run as ``python -m nmapps.tests.bench_fs [ENTRIES [DIRECTORY]]``. The tree
+(a million entries by default) is created in DIRECTORY, or in a temporary
+directory which is removed afterwards. Drop the page cache before running
+to measure cold reads."""
+
+import os
+import sys
+import time
+import shutil
+import tempfile
+
+import nmapps.fs as fs
+
+
+ENTRIES = 1000000
+# Files per directory and subdirectories per directory.
+FILES = 100
+FANOUT = 10
+
+
+def make_tree(root, entries = ENTRIES):
+    """
+    Creates directories with FILES empty files each, FANOUT subdirectories
+    per directory, until the tree has at least the number of entries.
+    """
+    count = 0
+    pending = [root]
+    while count < entries:
+        directory = pending.pop(0)
+        for i in range(FILES):
+            open(os.path.join(directory, "file-%d.txt" % (i, )), "w").close()
+        count += FILES
+        for i in range(FANOUT):
+            child = os.path.join(directory, "dir-%d" % (i, ))
+            os.mkdir(child)
+            pending.append(child)
+        count += FANOUT
+    return count
+
+
+def walk_os(root):
+    count = 0
+    for directory, dirs, files in os.walk(root):
+        count += len(dirs) + len(files)
+    return count
+
+
+def walk_nmapps(root, **options):
+    count = 0
+    for f in fs.Directory(root).walk(**options):
+        count += 1
+    return count
+
+
+def bench(func, *args, **kwargs):
+    started = time.time()
+    count = func(*args, **kwargs)
+    return count, time.time() - started
+
+
+def main(argv = None):
+    argv = argv or []
+    entries = int(argv[0]) if len(argv) > 0 else ENTRIES
+    root = argv[1] if len(argv) > 1 else None
+    
+    remove = root is None
+    if remove:
+        root = tempfile.mkdtemp(prefix = "bench_fs.")
+    try:
+        if not os.listdir(root):
+            started = time.time()
+            make_tree(root, entries)
+            print "created:         %8.2f s" % (time.time() - started, )
+        
+        cases = [
+            ("os.walk", walk_os, {}),
+            ("walk", walk_nmapps, {}),
+            ("walk ordered", walk_nmapps, {"ordered": True}),
+            ("walk 8 threads", walk_nmapps, {"workers": 8}),
+            ("walk 8 ordered", walk_nmapps, {"workers": 8, "ordered": True}),
+        ]
+        for name, func, options in cases:
+            count, elapsed = bench(func, root, **options)
+            print "%-16s %8.2f s %10d entries %10.0f entries/s" % (
+                name + ":", elapsed, count, count / elapsed, )
+    finally:
+        if remove:
+            shutil.rmtree(root)
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
@@ -0,0 +1,53 @@
+# src/nmapps/tests/bench_injection.py
+
+"""Microbenchmark comparing the regular and the frozen resolution paths of
+:class:`nmapps.injection.DefaultDependencyManager`.
+
+Run as ``python -m nmapps.tests.bench_injection``."""
+
+import sys
+import timeit
+
+import nmapps.injection as injection
+
+
+KEYS = 100
+NUMBER = 200000
+
+
+def make_manager():
+    manager = injection.DefaultDependencyManager()
+    for i in range(KEYS):
+        key = "dependency-%d" % (i, )
+        manager.set(key, object(), name = "a")
+        manager.set(key, object(), name = "b")
+        manager.select(key, "a")
+        manager.set(key, object())
+    return manager
+
+
+def bench(manager, number = NUMBER):
+    get = manager.get
+    key = "dependency-%d" % (KEYS // 2, )
+    timer = timeit.Timer(lambda: get(key))
+    return min(timer.repeat(3, number))
+
+
+def main(argv = None):
+    number = NUMBER
+    if argv:
+        number = int(argv[0])
+    
+    manager = make_manager()
+    regular = bench(manager, number)
+    
+    manager.freeze()
+    frozen = bench(manager, number)
+    
+    print "regular: %8.1f ns/get" % (regular / number * 1e9, )
+    print "frozen:  %8.1f ns/get" % (frozen / number * 1e9, )
+    print "speedup: %8.2fx" % (regular / frozen, )
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
@@ -0,0 +1,74 @@
+# src/nmapps/tests/test_app.py
+
+import unittest
+import os
+import sys
+import stat
+import time
+
+import nmapps.app as app
+import nmapps.daemon as daemon
+
+
+class TestDaemonControlApp(unittest.TestCase):
+    """Tests the multi-instance control of nmapps.app.DaemonControlApp."""
+    
+    def setUp(self):
+        self.app = app.DaemonControlApp(daemon.Daemon(pidfile = "/tmp/nmapps-test.pid"))
+    
+    def parse(self, *argv):
+        self.app.parse_args(list(argv))
+        return self.app.get_instances()
+    
+    def test_instances(self):
+        self.assertIsNone(self.parse("status"))
+        instances = self.parse("--instances", "3", "status")
+        self.assertEqual([d.pidfile.path for d in instances],
+                         ["/tmp/nmapps-test.%d.pid" % (i, ) for i in range(3)])
+        self.assertEqual([d.instance_index for d in instances], [0, 1, 2])
+        self.assertIsNone(self.app.daemon.instance_index)
+    
+    def test_parse_instance_index(self):
+        self.assertEqual(app.parse_instance_index("/run/a.12.pid", 0), 12)
+        self.assertEqual(app.parse_instance_index("/run/a-b.pid", 3), 3)
+    
+    def test_map_instances(self):
+        def handler(cmd, args):
+            index = self.app.daemon.instance_index
+            print "%s %d" % (cmd, index, )
+            time.sleep(0.01 * (3 - index))
+            if index == 1:
+                sys.exit(3)
+        
+        instances = self.parse("--instances", "4", "x")
+        results = self.app.map_instances(instances, handler, "x", [], 2)
+        self.assertEqual([(status, output) for d, status, elapsed, output in results],
+                         [(0, "x 0\n"), (3, "x 1\n"), (0, "x 2\n"), (0, "x 3\n")])
+        
+        results = self.app.map_instances(instances, handler, "x", [], 1,
+                                         stop_on_failure = True)
+        self.assertEqual([status for d, status, elapsed, output in results],
+                         [0, 3, None, None])
+    
+    def test_map_instances_fds(self):
+        """Children don't inherit the output pipes of the other children."""
+        
+        def pipes():
+            result = []
+            for name in os.listdir("/proc/self/fd"):
+                try:
+                    if stat.S_ISFIFO(os.fstat(int(name)).st_mode):
+                        result.append(int(name))
+                except OSError:
+                    pass
+            return set(result) - set([1, 2])
+        
+        inherited = pipes()
+        def handler(cmd, args):
+            time.sleep(0.05)
+            print sorted(pipes() - inherited)
+        
+        instances = self.parse("--instances", "3", "x")
+        results = self.app.map_instances(instances, handler, "x", [], 3)
+        self.assertEqual([output for d, status, elapsed, output in results],
+                         ["[]\n"] * 3)
@@ -0,0 +1,55 @@
+# src/nmapps/tests/test_control.py
+
+import unittest
+import os
+import stat
+import shutil
+import tempfile
+
+import nmapps.control as control
+from nmapps.utils import UserException
+
+
+class TestControlServer(unittest.TestCase):
+    """Tests the nmapps.control.ControlServer class."""
+    
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.dir, "control.sock")
+        self.server = control.ControlServer(self.path, self.handle)
+        self.server.start()
+    
+    def tearDown(self):
+        self.server.stop()
+        shutil.rmtree(self.dir)
+    
+    def handle(self, command, args):
+        if command == "echo":
+            return args
+        raise UserException(msg = "Unknown command %s." % (command, ))
+    
+    def test_command(self):
+        self.assertEqual(control.send_command(self.path, "echo", [1, "a"]), [1, "a"])
+        self.assertEqual(control.send_command(self.path, "echo"), [])
+    
+    def test_error(self):
+        with self.assertRaises(control.ControlException) as context:
+            control.send_command(self.path, "unknown")
+        self.assertEqual(str(context.exception), "Unknown command unknown.")
+    
+    def test_mode(self):
+        self.assertEqual(stat.S_IMODE(os.stat(self.path).st_mode), 0600)
+        
+        self.server.stop()
+        umask = os.umask(0)
+        try:
+            self.server.start()
+        finally:
+            os.umask(umask)
+        self.assertEqual(stat.S_IMODE(os.stat(self.path).st_mode), 0600)
+    
+    def test_stopped(self):
+        self.server.stop()
+        self.assertFalse(os.path.exists(self.path))
+        with self.assertRaises(control.ControlException):
+            control.send_command(self.path, "echo")
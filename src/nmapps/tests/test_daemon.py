@@ -0,0 +1,802 @@
+# src/nmapps/tests/test_daemon.py
+
+import unittest
+import os
+import sys
+import time
+import errno
+import signal
+import socket
+import shutil
+import tempfile
+import threading
+import subprocess
+import logging
+import StringIO
+
+import nmapps.daemon as daemon
+import nmapps.control as control
+from nmapps.resources import ResourceProfile
+from nmapps.shared import SharedState
+
+
+LOGGER = logging.getLogger("nmapps.tests.daemon")
+LOGGER.addHandler(logging.NullHandler())
+LOGGER.propagate = False
+
+
+def wait_until(predicate, timeout = 5.0):
+    """Returns the first true result of predicate(), or None after the
+    timeout."""
+    deadline = time.time() + timeout
+    while True:
+        result = predicate()
+        if result or time.time() > deadline:
+            return result
+        time.sleep(0.01)
+
+
+class TestPIDFile(unittest.TestCase):
+    """Tests the nmapps.daemon.PIDFile class."""
+    
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.dir, "test.pid")
+        self.pidfile = daemon.PIDFile(self.path)
+        # flock() locks belong to open file descriptions, so a second
+        # instance behaves like another process.
+        self.other = daemon.PIDFile(self.path)
+    
+    def tearDown(self):
+        self.pidfile.unlock()
+        self.other.unlock()
+        shutil.rmtree(self.dir)
+    
+    def test_lock(self):
+        self.assertIsNone(self.other.read())
+        self.assertTrue(self.pidfile.lock())
+        
+        self.assertTrue(self.pidfile.locked)
+        self.assertEqual(self.other.read(), os.getpid())
+        self.assertTrue(self.other.exists)
+        self.assertFalse(self.other.lock())
+        
+        # Only removes stale PID files.
+        self.other.unlock()
+        self.assertTrue(os.path.exists(self.path))
+        
+        self.pidfile.unlock()
+        self.assertFalse(os.path.exists(self.path))
+        self.assertIsNone(self.other.read())
+        self.assertFalse(self.other.exists)
+    
+    def test_stale(self):
+        """PID files which are not locked are stale."""
+        
+        with open(self.path, "w") as f:
+            f.write("%d\n" % (os.getpid(), ))
+        
+        self.assertIsNone(self.other.read())
+        self.assertTrue(self.pidfile.lock())
+        self.assertEqual(self.other.read(), os.getpid())
+    
+    def test_write(self):
+        """Replacing the PID file keeps it locked."""
+        
+        self.assertTrue(self.pidfile.lock())
+        self.pidfile.write(12345)
+        
+        self.assertEqual(self.other.read(), 12345)
+        self.assertFalse(self.other.lock())
+        self.assertEqual(os.listdir(self.dir), ["test.pid"])
+    
+    def test_test_write(self):
+        self.assertIsNone(self.pidfile.test_write())
+        self.assertFalse(os.path.exists(self.path))
+
+
+class TestRestartPolicy(unittest.TestCase):
+    """Tests the nmapps.daemon.RestartPolicy class."""
+    
+    def test_backoff(self):
+        policy = daemon.RestartPolicy(delay = 0.5, factor = 2.0, max_delay = 3.0)
+        self.assertEqual([policy.next_delay(n) for n in range(6)],
+                         [0.0, 0.5, 1.0, 2.0, 3.0, 3.0])
+    
+    def test_failures(self):
+        policy = daemon.RestartPolicy(reset_after = 10.0, max_failures = 2)
+        failures = 0
+        for i in range(3):
+            failures = policy.failed(1.0, failures)
+            self.assertEqual(failures, i + 1)
+        self.assertTrue(policy.gives_up(failures))
+        self.assertFalse(policy.gives_up(2))
+        self.assertEqual(policy.failed(10.0, failures), 0)
+    
+    def test_respawn_delay(self):
+        d = daemon.Daemon(pidfile = "/tmp/nmapps-test.pid")
+        policy = d.get_restart_policy()
+        self.assertEqual(policy.next_delay(policy.failed(0.5, 0)), d.respawn_delay)
+        self.assertEqual(policy.next_delay(policy.failed(5.0, 7)), 0.0)
+        self.assertFalse(policy.gives_up(1000))
+
+
+class TestReadiness(unittest.TestCase):
+    """Tests the readiness notification of nmapps.daemon.Daemon."""
+    
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.daemon = daemon.Daemon(pidfile = os.path.join(self.dir, "test.pid"))
+        self.stdout, self.stderr = sys.stdout, sys.stderr
+        sys.stdout, sys.stderr = StringIO.StringIO(), StringIO.StringIO()
+    
+    def tearDown(self):
+        sys.stdout, sys.stderr = self.stdout, self.stderr
+        self.daemon.pidfile.unlock()
+        shutil.rmtree(self.dir)
+    
+    def wait_ready(self, notify, timeout = 1.0):
+        r, w = os.pipe()
+        self.daemon.ready_fd = w
+        notify()
+        if self.daemon.ready_fd is not None:
+            os.close(w)
+        with self.assertRaises(SystemExit) as context:
+            self.daemon.wait_ready(r, time.time(), timeout)
+        return context.exception.code
+    
+    def test_ready(self):
+        self.assertTrue(self.daemon.pidfile.lock())
+        self.assertEqual(self.wait_ready(self.daemon.notify_ready), 0)
+        self.assertIn("with PID %d" % (os.getpid(), ), sys.stdout.getvalue())
+    
+    def test_error(self):
+        code = self.wait_ready(lambda: self.daemon.notify_error("No\ndatabase."))
+        self.assertEqual(code, 1)
+        self.assertEqual(sys.stderr.getvalue(), "Daemon failed to start: No database.\n")
+    
+    def test_exited(self):
+        self.assertEqual(self.wait_ready(lambda: None), 1)
+        self.assertIn("Exited before becoming ready", sys.stderr.getvalue())
+
+
+class TestWaitForExit(unittest.TestCase):
+    """Tests nmapps.daemon.wait_for_exit() and process_exists()."""
+    
+    def setUp(self):
+        self.pids = []
+    
+    def tearDown(self):
+        for pid in self.pids:
+            try:
+                os.kill(pid, signal.SIGKILL)
+            except OSError:
+                pass
+            os.waitpid(pid, 0)
+    
+    def spawn(self, seconds):
+        pid = os.fork()
+        if pid == 0:
+            try:
+                time.sleep(seconds)
+            finally:
+                os._exit(0)
+        self.pids.append(pid)
+        return pid
+    
+    def reaped_pid(self):
+        pid = self.spawn(0)
+        self.pids.remove(pid)
+        os.waitpid(pid, 0)
+        return pid
+    
+    def test_process_exists(self):
+        self.assertTrue(daemon.process_exists(os.getpid()))
+        pid = self.spawn(10)
+        self.assertTrue(daemon.process_exists(pid))
+        os.kill(pid, signal.SIGKILL)
+        # Zombies are not running.
+        self.assertTrue(daemon.wait_for_exit(pid, 1.0))
+        self.assertFalse(daemon.process_exists(pid))
+        self.assertFalse(daemon.process_exists(self.reaped_pid()))
+    
+    def check_wait(self):
+        started = time.time()
+        self.assertTrue(daemon.wait_for_exit(self.spawn(0.1), 5.0))
+        self.assertLess(time.time() - started, 4.0)
+        
+        started = time.time()
+        self.assertFalse(daemon.wait_for_exit(self.spawn(10), 0.2))
+        self.assertGreaterEqual(time.time() - started, 0.15)
+        
+        self.assertTrue(daemon.wait_for_exit(self.reaped_pid(), 1.0))
+    
+    def test_wait(self):
+        self.check_wait()
+    
+    def test_wait_polling(self):
+        """Without pidfd_open(), the process is polled."""
+        
+        def pidfd_open(pid):
+            raise OSError(errno.ENOSYS, os.strerror(errno.ENOSYS))
+        
+        original = daemon.pidfd_open
+        daemon.pidfd_open = pidfd_open
+        try:
+            self.check_wait()
+        finally:
+            daemon.pidfd_open = original
+    
+    def test_pidfd_open(self):
+        try:
+            fd = daemon.pidfd_open(os.getpid())
+        except OSError as e:
+            if e.errno != errno.ENOSYS:
+                raise
+            self.skipTest("pidfd_open is not supported")
+        self.assertGreaterEqual(fd, 0)
+        os.close(fd)
+        with self.assertRaises(OSError) as context:
+            daemon.pidfd_open(self.reaped_pid())
+        self.assertEqual(context.exception.errno, errno.ESRCH)
+
+
+class TestStop(unittest.TestCase):
+    """Tests nmapps.daemon.Daemon.stop()."""
+    
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.dir, "test.pid")
+        self.stderr = sys.stderr
+        sys.stderr = StringIO.StringIO()
+        self.pid = None
+    
+    def tearDown(self):
+        sys.stderr = self.stderr
+        if self.pid is not None:
+            try:
+                os.kill(self.pid, signal.SIGKILL)
+            except OSError:
+                pass
+            os.waitpid(self.pid, 0)
+        shutil.rmtree(self.dir)
+    
+    def start(self, ignore_term):
+        """Forks a process holding the PID file."""
+        r, w = os.pipe()
+        pid = os.fork()
+        if pid == 0:
+            try:
+                os.close(r)
+                if ignore_term:
+                    signal.signal(signal.SIGTERM, signal.SIG_IGN)
+                else:
+                    signal.signal(signal.SIGTERM, lambda *args: os._exit(0))
+                daemon.PIDFile(self.path).lock()
+                os.write(w, "x")
+                time.sleep(10)
+            finally:
+                os._exit(1)
+        self.pid = pid
+        os.close(w)
+        self.assertEqual(os.read(r, 1), "x")
+        os.close(r)
+    
+    def test_stop(self):
+        self.start(False)
+        d = daemon.Daemon(pidfile = self.path)
+        self.assertLess(d.stop(timeout = 5.0), 4.0)
+        self.assertEqual(sys.stderr.getvalue(), "")
+        self.assertFalse(daemon.process_exists(self.pid))
+        self.assertFalse(os.path.exists(self.path))
+    
+    def test_kill(self):
+        """Processes which do not exit after SIGTERM are killed."""
+        
+        self.start(True)
+        d = daemon.Daemon(pidfile = self.path)
+        self.assertGreaterEqual(d.stop(timeout = 0.2), 0.15)
+        self.assertIn("did not stop in 0.2 s, killing it", sys.stderr.getvalue())
+        _, status = os.waitpid(self.pid, 0)
+        self.pid = None
+        self.assertEqual(os.WTERMSIG(status), signal.SIGKILL)
+        self.assertFalse(os.path.exists(self.path))
+    
+    def test_not_running(self):
+        self.assertIsNone(daemon.Daemon(pidfile = self.path).stop())
+        self.assertIn("does not exist", sys.stderr.getvalue())
+
+
+class RecordingDaemon(daemon.Daemon):
+    """Daemon whose workers record their events in a file."""
+    
+    prefork = True
+    workers = 2
+    respawn_delay = 0.1
+    events_path = None
+    
+    def record(self, event):
+        fd = os.open(self.events_path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0600)
+        try:
+            os.write(fd, "%s %d %d %r\n" % (event, self.worker_index, os.getpid(),
+                                            time.time(), ))
+        finally:
+            os.close(fd)
+    
+    def on_hangup(self):
+        self.record("hup")
+    
+    def flush_caches(self):
+        if self.worker_index is not None:
+            self.record("flush-" + logging.getLevelName(logging.getLogger().level))
+    
+    def run(self):
+        self.record("start")
+        while not self.wait():
+            pass
+        self.record("stop")
+
+
+class CrashingDaemon(RecordingDaemon):
+    """Supervised daemon whose worker always exits with status 3."""
+    
+    prefork = False
+    supervise = True
+    restart_policy = daemon.RestartPolicy(delay = 0.1, factor = 2.0, max_delay = 0.3,
+                                          max_failures = 4)
+    
+    def run(self):
+        self.record("start")
+        os._exit(3)
+
+
+class SlowDaemon(RecordingDaemon):
+    """Daemon whose workers become ready after a while."""
+    
+    auto_ready = False
+    
+    def run(self):
+        time.sleep(0.3)
+        self.record("ready")
+        self.notify_ready()
+        RecordingDaemon.run(self)
+
+
+class TestMaster(unittest.TestCase):
+    """Tests the master process of the prefork mode (run_master())."""
+    
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.daemon = RecordingDaemon(pidfile = os.path.join(self.dir, "test.pid"),
+                                      logger = LOGGER, control_socket = True)
+        self.daemon.events_path = os.path.join(self.dir, "events")
+        self.master = None
+    
+    def tearDown(self):
+        if self.master is not None:
+            os.kill(self.master, signal.SIGKILL)
+            os.waitpid(self.master, 0)
+            for pid in self.worker_pids():
+                try:
+                    os.kill(pid, signal.SIGKILL)
+                except OSError:
+                    pass
+        shutil.rmtree(self.dir)
+    
+    def start(self, wait = True):
+        """Runs the master in a child process."""
+        pid = os.fork()
+        if pid == 0:
+            status = 1
+            try:
+                self.daemon.pidfile.lock()
+                self.daemon.start_control()
+                try:
+                    if self.daemon.run_master():
+                        status = 0
+                finally:
+                    self.daemon.stop_control()
+            finally:
+                os._exit(status)
+        self.master = pid
+        if wait:
+            self.assertTrue(wait_until(lambda: len(self.events("start")) >= 2))
+    
+    def join(self, timeout = 5.0):
+        """Returns the exit status of the master, or None if it is still
+        running after the timeout."""
+        def exited():
+            pid, status = os.waitpid(self.master, os.WNOHANG)
+            return pid and [status]
+        result = wait_until(exited, timeout)
+        if not result:
+            return None
+        self.master = None
+        return os.WEXITSTATUS(result[0])
+    
+    def events(self, name = None):
+        try:
+            with open(self.daemon.events_path) as f:
+                events = [line.split() for line in f]
+        except IOError:
+            return []
+        return [(event, int(index), int(pid)) for event, index, pid, at in events
+                if name is None or event == name]
+    
+    def event_times(self, name):
+        with open(self.daemon.events_path) as f:
+            return [float(line.split()[3]) for line in f if line.split()[0] == name]
+    
+    def worker_pids(self):
+        state = self.daemon.read_state() or {}
+        return [worker["pid"] for worker in state.get("workers", [])
+                if worker["pid"] is not None]
+    
+    def test_spawn(self):
+        self.start()
+        started = self.events("start")
+        self.assertEqual(sorted([index for event, index, pid in started]), [0, 1])
+        self.assertEqual(wait_until(lambda: sorted(self.worker_pids())),
+                         sorted([pid for event, index, pid in started]))
+        
+        status = control.send_command(self.daemon.control_path, "status")
+        self.assertTrue(status["prefork"])
+        self.assertEqual(status["pid"], self.master)
+        self.assertEqual([(w["index"], w["pid"], w["restarts"]) for w in status["workers"]],
+                         sorted([(index, pid, 0) for event, index, pid in started]))
+    
+    def test_respawn(self):
+        """Crashed workers are started again."""
+        
+        self.start()
+        crashed = dict([(index, pid) for event, index, pid in self.events("start")])[0]
+        os.kill(crashed, signal.SIGKILL)
+        self.assertTrue(wait_until(lambda: len(self.events("start")) >= 3))
+        
+        event, index, pid = self.events("start")[-1]
+        self.assertEqual(index, 0)
+        self.assertNotEqual(pid, crashed)
+        
+        def restarted():
+            workers = control.send_command(self.daemon.control_path, "workers")
+            return workers[0]["pid"] == pid and workers[0]
+        worker = wait_until(restarted)
+        self.assertTrue(worker)
+        self.assertEqual(worker["restarts"], 1)
+        self.assertEqual(worker["last_status"], -signal.SIGKILL)
+    
+    def test_hangup(self):
+        """SIGHUP is forwarded to the workers."""
+        
+        self.start()
+        os.kill(self.master, signal.SIGHUP)
+        self.assertTrue(wait_until(lambda: len(self.events("hup")) == 2))
+        self.assertEqual(sorted([pid for event, index, pid in self.events("hup")]),
+                         sorted([pid for event, index, pid in self.events("start")]))
+        self.assertEqual(len(self.events("stop")), 0)
+    
+    def test_forward_commands(self):
+        """The loglevel and flush commands reach the workers."""
+        
+        self.start()
+        path = self.daemon.control_path
+        self.assertEqual(control.send_command(path, "loglevel", ["error"]), "ERROR")
+        self.assertTrue(control.send_command(path, "flush"))
+        self.assertTrue(wait_until(lambda: len(self.events("flush-ERROR")) == 2))
+        self.assertEqual(sorted([pid for event, index, pid in self.events("flush-ERROR")]),
+                         sorted([pid for event, index, pid in self.events("start")]))
+        
+        # Respawned workers get the level too.
+        pid = self.events("start")[0][2]
+        os.kill(pid, signal.SIGKILL)
+        self.assertTrue(wait_until(lambda: len(self.events("start")) == 3))
+        self.assertTrue(control.send_command(path, "flush"))
+        self.assertTrue(wait_until(lambda: len(self.events("flush-ERROR")) == 4))
+    
+    def test_term(self):
+        """SIGTERM stops the workers and then the master."""
+        
+        self.start()
+        os.kill(self.master, signal.SIGTERM)
+        self.assertEqual(self.join(), 0)
+        self.assertEqual(sorted([pid for event, index, pid in self.events("stop")]),
+                         sorted([pid for event, index, pid in self.events("start")]))
+        self.assertIsNone(self.daemon.read_state())
+        self.assertFalse(os.path.exists(self.daemon.control_path))
+    
+    def test_ready(self):
+        """The master is ready once its first worker is."""
+        
+        self.daemon = SlowDaemon(pidfile = self.daemon.pidfile.path, logger = LOGGER)
+        self.daemon.events_path = os.path.join(self.dir, "events")
+        r, self.daemon.ready_fd = os.pipe()
+        self.start(wait = False)
+        os.close(self.daemon.ready_fd)
+        self.daemon.ready_fd = None
+        
+        ok, message = daemon.read_ready(r, 5.0)
+        ready_at = time.time()
+        os.close(r)
+        self.assertEqual((ok, message), (True, str(self.master)))
+        self.assertGreaterEqual(ready_at, min(self.event_times("ready")))
+    
+    def test_supervise_gives_up(self):
+        """A crashing worker is restarted with growing delays until the
+        supervisor gives up."""
+        
+        self.daemon = CrashingDaemon(pidfile = self.daemon.pidfile.path, logger = LOGGER)
+        self.daemon.events_path = os.path.join(self.dir, "events")
+        self.start(wait = False)
+        self.assertEqual(self.join(), 1)
+        
+        # The first run and a restart after each of the max_failures failures.
+        times = self.event_times("start")
+        self.assertEqual(len(times), 5)
+        delays = [b - a for a, b in zip(times, times[1:])]
+        for delay, expected in zip(delays, [0.1, 0.2, 0.3, 0.3]):
+            self.assertGreaterEqual(delay, expected - 0.01)
+            self.assertLess(delay, expected + 0.5)
+        
+        state = self.daemon.read_state()
+        self.assertIsNotNone(state["gave_up"])
+        worker = state["workers"][0]
+        self.assertEqual((worker["failures"], worker["restarts"], worker["last_status"]),
+                         (5, 4, 3))
+    
+    def test_setup_failure(self):
+        """Workers failing to apply the resource profile are not restarted."""
+        
+        # No such CPU.
+        self.daemon.resource_profile = ResourceProfile(cpus = [1023], pin_workers = True)
+        self.start(wait = False)
+        self.assertEqual(self.join(), 1)
+        self.assertEqual(self.events(), [])
+        state = self.daemon.read_state()
+        self.assertIsNotNone(state["gave_up"])
+        self.assertEqual([w["restarts"] for w in state["workers"]], [0, 0])
+
+
+SERVER_SCRIPT = """
+import os
+import sys
+import errno
+import socket
+
+sys.path.insert(0, %(path)r)
+
+from nmapps.daemon import Daemon
+from nmapps.app import DaemonControlApp
+
+
+DIR = %(dir)r
+
+
+class ServerDaemon(Daemon):
+    name = "nmapps-test"
+    log_path = os.path.join(DIR, "daemon.log")
+    control_socket = True
+    reload_timeout = 5.0
+    shared_counters = ("requests", )
+    
+    def setup_listeners(self):
+        if os.path.exists(os.path.join(DIR, "fail")):
+            raise Exception("Failing on purpose.")
+        self.sock = self.listen(os.path.join(DIR, "server.sock"))
+        self.sock.settimeout(0.05)
+    
+    def handle_term(self):
+        # Finishes the current request.
+        self.request_stop()
+    
+    def run(self):
+        # Serves until drain() closes the socket.
+        while self.listeners and not self.stopping:
+            try:
+                conn, address = self.sock.accept()
+            except socket.timeout:
+                continue
+            except socket.error as e:
+                if e.errno == errno.EINTR:
+                    continue
+                break
+            self.shared.incr("requests")
+            conn.sendall("%%d\\n" %% (os.getpid(), ))
+            conn.close()
+
+
+DaemonControlApp(ServerDaemon(pidfile = os.path.join(DIR, "test.pid"))).run()
+"""
+
+
+class Client(threading.Thread):
+    """Connects to the server repeatedly, collects the PIDs it answers
+    with and the errors."""
+    
+    def __init__(self, path):
+        threading.Thread.__init__(self)
+        self.daemon = True
+        self.path = path
+        self.pids = []
+        self.errors = []
+        self.stopped = threading.Event()
+    
+    def request(self):
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            sock.settimeout(5.0)
+            sock.connect(self.path)
+            return int(sock.makefile().readline())
+        finally:
+            sock.close()
+    
+    def run(self):
+        while not self.stopped.is_set():
+            try:
+                self.pids.append(self.request())
+            except (socket.error, ValueError) as e:
+                self.errors.append(e)
+    
+    def stop(self):
+        self.stopped.set()
+        self.join()
+
+
+class TestReload(unittest.TestCase):
+    """Tests the zero-downtime reload (spawn_generation()) of a running
+    daemon."""
+    
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.script = os.path.join(self.dir, "server.py")
+        path = os.path.dirname(os.path.dirname(os.path.abspath(daemon.__file__)))
+        with open(self.script, "w") as f:
+            f.write(SERVER_SCRIPT % {"path": path, "dir": self.dir})
+        self.pidfile = daemon.PIDFile(os.path.join(self.dir, "test.pid"))
+        self.socket_path = os.path.join(self.dir, "server.sock")
+        self.control_path = self.pidfile.path + ".sock"
+    
+    def tearDown(self):
+        self.command("stop")
+        shutil.rmtree(self.dir)
+    
+    def command(self, *args):
+        process = subprocess.Popen([sys.executable, self.script] + list(args),
+                                   stdout = subprocess.PIPE,
+                                   stderr = subprocess.STDOUT)
+        output = process.communicate()[0]
+        return process.returncode, output
+    
+    def start(self):
+        status, output = self.command("start")
+        self.assertEqual(status, 0, output)
+        pid = self.pidfile.read()
+        self.assertIsNotNone(pid)
+        return pid
+    
+    def test_reload(self):
+        pid = self.start()
+        client = Client(self.socket_path)
+        client.start()
+        try:
+            self.assertTrue(wait_until(lambda: len(client.pids) > 10))
+            status, output = self.command("reload")
+            self.assertEqual(status, 0, output)
+            new_pid = self.pidfile.read()
+            self.assertNotEqual(new_pid, pid)
+            self.assertIn("PID %d -> %d" % (pid, new_pid, ), output)
+            self.assertTrue(wait_until(lambda: client.pids.count(new_pid) > 10))
+        finally:
+            client.stop()
+        
+        self.assertEqual(client.errors, [])
+        self.assertEqual(set(client.pids), set([pid, new_pid]))
+        self.assertTrue(daemon.wait_for_exit(pid, 5.0))
+        status = control.send_command(self.control_path, "status")
+        self.assertEqual(status["pid"], new_pid)
+        # The counters are per generation.
+        self.assertEqual(status["shared"]["counters"]["requests"],
+                         client.pids.count(new_pid))
+    
+    def test_failed_reload(self):
+        """The old generation keeps running if the new one fails."""
+        
+        pid = self.start()
+        fds = sorted(os.listdir("/proc/%d/fd" % (pid, )))
+        
+        open(os.path.join(self.dir, "fail"), "w").close()
+        status, output = self.command("reload")
+        self.assertEqual(status, 1, output)
+        self.assertIn("Failing on purpose.", output)
+        
+        # The old generation closed the readiness pipe and kept its
+        # listening socket and control socket.
+        self.assertEqual(self.pidfile.read(), pid)
+        self.assertEqual(sorted(os.listdir("/proc/%d/fd" % (pid, ))), fds)
+        self.assertEqual(Client(self.socket_path).request(), pid)
+        self.assertEqual(control.send_command(self.control_path, "status")["pid"], pid)
+        state = SharedState.attach(self.pidfile.path + ".shm")
+        self.assertEqual(state.get("requests"), 1)
+        state.close()
+        
+        os.remove(os.path.join(self.dir, "fail"))
+        status, output = self.command("reload")
+        self.assertEqual(status, 0, output)
+        new_pid = self.pidfile.read()
+        self.assertNotEqual(new_pid, pid)
+        self.assertEqual(Client(self.socket_path).request(), new_pid)
+
+
+class TestAsyncDaemon(unittest.TestCase):
+    """Tests the nmapps.daemon.AsyncDaemon class."""
+    
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.pidfile = os.path.join(self.dir, "test.pid")
+    
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+    
+    @unittest.skipIf(daemon.asyncio is not None, "asyncio is available")
+    def test_requires_asyncio(self):
+        with self.assertRaises(daemon.DaemonException):
+            daemon.AsyncDaemon(self.pidfile)
+    
+    @unittest.skipIf(daemon.asyncio is None, "asyncio is not available")
+    def test_execute(self):
+        """execute() runs the run() coroutine in a new event loop."""
+        
+        asyncio = daemon.asyncio
+        result = []
+        
+        class Daemon(daemon.AsyncDaemon):
+            def run(self):
+                result.append(self.loop)
+                return asyncio.sleep(0.01)
+        
+        self.assertTrue(Daemon(self.pidfile).execute())
+        self.assertEqual(len(result), 1)
+        self.assertTrue(result[0].is_closed())
+    
+    @unittest.skipIf(daemon.asyncio is None, "asyncio is not available")
+    def test_term(self):
+        """SIGTERM cancels run() and the tasks it started."""
+        
+        asyncio = daemon.asyncio
+        cancelled = []
+        
+        @asyncio.coroutine
+        def sleep(name):
+            try:
+                yield asyncio.From(asyncio.sleep(10))
+            except asyncio.CancelledError:
+                cancelled.append(name)
+                raise
+        
+        class Daemon(daemon.AsyncDaemon):
+            @asyncio.coroutine
+            def run(self):
+                asyncio.ensure_future(sleep("task"), loop = self.loop)
+                self.loop.call_later(0.01, os.kill, os.getpid(), signal.SIGTERM)
+                yield asyncio.From(sleep("run"))
+        
+        d = Daemon(self.pidfile, logger = LOGGER)
+        self.assertTrue(d.execute())
+        self.assertTrue(d.stopping)
+        self.assertEqual(sorted(cancelled), ["run", "task"])
+    
+    @unittest.skipIf(daemon.asyncio is None, "asyncio is not available")
+    def test_error(self):
+        asyncio = daemon.asyncio
+        
+        class Daemon(daemon.AsyncDaemon):
+            @asyncio.coroutine
+            def run(self):
+                yield asyncio.From(asyncio.sleep(0))
+                raise ValueError("Failed.")
+        
+        d = Daemon(self.pidfile, logger = LOGGER)
+        r, d.ready_fd = os.pipe()
+        d.auto_ready = False
+        self.assertFalse(d.execute())
+        self.assertEqual(daemon.read_ready(r, 1.0), (False, "run() failed: ValueError: Failed."))
+        os.close(r)
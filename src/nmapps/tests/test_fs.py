@@ -0,0 +1,512 @@
+# src/nmapps/tests/test_fs.py
+
+import unittest
+import os
+import stat
+import errno
+import time
+import shutil
+import tempfile
+import zipfile
+
+import nmapps.fs as fs
+import nmapps.utils as utils
+
+
+class TestPath(unittest.TestCase):
+    """Tests the nmapps.fs.Path class."""
+    
+    def setUp(self):
+        self.tempdir = tempfile.mkdtemp()
+        self.file = os.path.join(self.tempdir, "a.txt")
+        with open(self.file, "w") as f:
+            f.write("hello")
+        
+        self.stat_calls = 0
+        self.original_stat = os.stat
+        def counting_stat(value):
+            self.stat_calls += 1
+            return self.original_stat(value)
+        os.stat = counting_stat
+    
+    def tearDown(self):
+        os.stat = self.original_stat
+        fs.disable_stat_cache()
+        shutil.rmtree(self.tempdir)
+    
+    def test_single_stat(self):
+        pth = fs.Path(self.file)
+        self.assertTrue(pth.exists)
+        self.assertTrue(pth.is_file)
+        self.assertFalse(pth.is_dir)
+        self.assertEqual(pth.size, 5)
+        self.assertEqual(self.stat_calls, 1)
+        
+        self.assertTrue(fs.File.make(pth).exists)
+        self.assertEqual(self.stat_calls, 1)
+    
+    def test_types(self):
+        link = os.path.join(self.tempdir, "link")
+        os.symlink(self.file, link)
+        self.assertTrue(fs.Path(self.tempdir).is_dir)
+        self.assertTrue(fs.Path(link).is_link)
+        self.assertTrue(fs.Path(link).is_file)
+        self.assertFalse(fs.Path(self.file).is_link)
+        
+        missing = fs.Path(os.path.join(self.tempdir, "missing"))
+        self.assertFalse(missing.exists)
+        self.assertFalse(missing.is_file)
+        self.assertIsNone(missing.size)
+        self.assertFalse(fs.Path(os.path.join(self.file, "x")).exists)
+    
+    def test_stat_errors(self):
+        """The predicates are False when stat fails, stat() raises."""
+        
+        def failing_stat(value):
+            raise OSError(errno.EACCES, os.strerror(errno.EACCES), value)
+        os.stat = failing_stat
+        pth = fs.Path(self.file)
+        self.assertFalse(pth.exists)
+        self.assertFalse(pth.is_file)
+        self.assertFalse(pth.is_dir)
+        self.assertFalse(fs.File(pth).exists)
+        with self.assertRaises(OSError):
+            pth.stat()
+        with self.assertRaises(OSError):
+            pth.size
+    
+    def test_refresh(self):
+        pth = fs.Path(self.file)
+        self.assertTrue(pth.exists)
+        os.remove(self.file)
+        self.assertTrue(pth.exists)
+        self.assertFalse(pth.refresh().exists)
+        self.assertEqual(self.stat_calls, 2)
+    
+    def test_ttl(self):
+        pth = fs.Path(self.file, ttl = 0)
+        pth.exists
+        pth.exists
+        self.assertEqual(self.stat_calls, 2)
+    
+    @unittest.skipIf(fs.scandir is None, "scandir is not installed")
+    def test_entry_ttl(self):
+        """Directory entries are used only until the ttl expires."""
+        
+        pth = fs.Path.from_entry(list(fs.scandir(self.tempdir))[0])
+        cached = fs.Path.from_entry(list(fs.scandir(self.tempdir))[0])
+        pth.stat_ttl = 0.05
+        self.assertTrue(pth.is_file)
+        self.assertEqual(pth.size, 5)
+        self.assertEqual(cached.size, 5)
+        os.remove(self.file)
+        time.sleep(0.1)
+        self.assertFalse(pth.is_file)
+        self.assertFalse(pth.exists)
+        self.assertIsNone(pth.size)
+        self.assertIsNone(pth.entry)
+        
+        self.assertTrue(cached.is_file)
+        self.assertFalse(cached.refresh().is_file)
+        self.assertIsNone(cached.entry)
+    
+    def test_stat_cache(self):
+        cache = fs.enable_stat_cache(capacity = 2)
+        self.assertTrue(fs.Path(self.file).is_file)
+        self.assertTrue(fs.Path(self.file).is_file)
+        self.assertEqual(self.stat_calls, 1)
+        self.assertEqual((cache.hits, cache.misses), (1, 1))
+        
+        fs.Path(self.tempdir).is_dir
+        fs.Path(os.path.join(self.tempdir, "missing")).exists
+        # The least recently used entry was evicted.
+        self.assertEqual(len(cache), 2)
+        fs.Path(self.file).exists
+        self.assertEqual(self.stat_calls, 4)
+        
+        os.remove(self.file)
+        self.assertTrue(fs.Path(self.file).exists)
+        self.assertFalse(fs.Path(self.file).refresh().exists)
+
+
+class FakeEntry(object):
+    """A directory entry like the ones returned by os.scandir."""
+    
+    def __init__(self, directory, name):
+        self.name = name
+        self.path = os.path.join(directory, name)
+        self.mode = os.lstat(self.path).st_mode
+    
+    def is_dir(self):
+        return stat.S_ISDIR(self.mode)
+    
+    def is_file(self):
+        return stat.S_ISREG(self.mode)
+    
+    def is_symlink(self):
+        return stat.S_ISLNK(self.mode)
+    
+    def stat(self, follow_symlinks = True):
+        if follow_symlinks:
+            return os.stat(self.path)
+        return os.lstat(self.path)
+
+
+class TestDirectory(unittest.TestCase):
+    """Tests the nmapps.fs.Directory class."""
+    
+    def setUp(self):
+        self.tempdir = tempfile.mkdtemp()
+        os.mkdir(os.path.join(self.tempdir, "sub"))
+        for name in ("a.txt", "b.zip", ):
+            with open(os.path.join(self.tempdir, name), "w") as f:
+                f.write(name)
+        
+        self.original_scandir = fs.scandir
+        self.original_stat = os.stat
+    
+    def tearDown(self):
+        fs.scandir = self.original_scandir
+        os.stat = self.original_stat
+        shutil.rmtree(self.tempdir)
+    
+    def list_types(self):
+        directory = fs.Directory(self.tempdir)
+        result = sorted([(f.path.base, type(f).__name__) for f in directory.iter_list()])
+        self.assertEqual(sorted([(f.path.base, type(f).__name__) for f in directory.list()]),
+                         result)
+        return result
+    
+    def test_list(self):
+        expected = [("a.txt", "File"), ("b.zip", "ZipFile"), ("sub", "Directory"), ]
+        
+        fs.scandir = None
+        self.assertEqual(self.list_types(), expected)
+        
+        fs.scandir = lambda value: [FakeEntry(value, name) for name in os.listdir(value)]
+        def failing_stat(value):
+            raise AssertionError("stat called for %s" % (value, ))
+        os.stat = failing_stat
+        self.assertEqual(self.list_types(), expected)
+    
+    def count_stats(self):
+        calls = []
+        original_lstat = os.lstat
+        def counting_stat(value):
+            calls.append(value)
+            return self.original_stat(value)
+        def counting_lstat(value):
+            calls.append(value)
+            return original_lstat(value)
+        os.stat = counting_stat
+        os.lstat = counting_lstat
+        try:
+            self.list_types()
+        finally:
+            os.lstat = original_lstat
+            os.stat = self.original_stat
+        return len(calls)
+    
+    @unittest.skipIf(fs.scandir is None, "scandir is not installed")
+    def test_scandir_stats(self):
+        self.assertEqual(self.count_stats(), 0)
+    
+    def test_fallback_stats(self):
+        # Without scandir, every entry is stat'ed to find directories (once
+        # per listing, see list_types()).
+        fs.scandir = None
+        self.assertEqual(self.count_stats(), 2 * 3)
+    
+    def test_entry_stat(self):
+        fs.scandir = lambda value: [FakeEntry(value, name) for name in os.listdir(value)]
+        files = dict([(f.path.base, f) for f in fs.Directory(self.tempdir)])
+        self.assertTrue(files["a.txt"].exists)
+        self.assertEqual(files["a.txt"].path.size, 5)
+        self.assertFalse(files["a.txt"].path.is_link)
+        self.assertTrue(files["sub"].exists)
+        
+        pth = files["a.txt"].path
+        os.remove(str(pth))
+        self.assertTrue(pth.is_file)
+        self.assertFalse(pth.refresh().is_file)
+
+
+class TestWalk(unittest.TestCase):
+    """Tests nmapps.fs.Directory.walk()."""
+    
+    def setUp(self):
+        self.tempdir = tempfile.mkdtemp()
+        for name in ("a/b/c", "a/d", "e", ):
+            os.makedirs(os.path.join(self.tempdir, name))
+        for name in ("1.txt", "a/2.txt", "a/b/3.py", "a/b/c/4.txt", "e/5.py", ):
+            with open(os.path.join(self.tempdir, name), "w") as f:
+                f.write(name)
+        with zipfile.ZipFile(os.path.join(self.tempdir, "a/z.zip"), "w") as z:
+            z.writestr("x.txt", "x")
+            z.writestr("y/z.py", "z")
+        # A loop.
+        os.symlink(os.path.join(self.tempdir, "a"), os.path.join(self.tempdir, "a/b/up"))
+    
+    def tearDown(self):
+        shutil.rmtree(self.tempdir)
+    
+    def walk(self, **options):
+        prefix = len(self.tempdir) + 1
+        return [str(f)[prefix:] if not isinstance(f, fs.ZipFileEntry) else str(f)
+                for f in fs.Directory(self.tempdir).walk(**options)]
+    
+    def test_ordered(self):
+        expected = ["1.txt", "a", "a/2.txt", "a/b", "a/b/3.py", "a/b/c", "a/b/c/4.txt",
+                    "a/b/up", "a/d", "a/z.zip", "e", "e/5.py", ]
+        self.assertEqual(self.walk(ordered = True), expected)
+        self.assertEqual(self.walk(ordered = True, workers = 4), expected)
+        self.assertEqual(sorted(self.walk(workers = 4)), expected)
+        self.assertEqual(sorted(self.walk()), expected)
+    
+    def test_filters(self):
+        self.assertEqual(self.walk(ordered = True, include = "*.txt"),
+                         ["1.txt", "a/2.txt", "a/b/c/4.txt", ])
+        self.assertEqual(self.walk(ordered = True, include = "*.txt", exclude = ["b", "1.*"]),
+                         ["a/2.txt", ])
+        self.assertEqual(self.walk(ordered = True, include = "a/*/*"),
+                         ["a/b/3.py", "a/b/c", "a/b/c/4.txt", "a/b/up", ])
+        self.assertEqual(sorted(self.walk(workers = 3, exclude = lambda f: not f.path.is_dir)),
+                         ["a", "a/b", "a/b/c", "a/b/up", "a/d", "e", ])
+    
+    def test_max_depth(self):
+        self.assertEqual(self.walk(ordered = True, max_depth = 1), ["1.txt", "a", "e", ])
+        self.assertEqual(len(self.walk(max_depth = 2, workers = 2)), 8)
+    
+    def test_follow_symlinks(self):
+        files = self.walk(ordered = True, follow_symlinks = True)
+        # The directory a is walked only once.
+        self.assertEqual(files, self.walk(ordered = True))
+        self.assertEqual(sorted(self.walk(follow_symlinks = True, workers = 4)), files)
+        
+        outside = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, outside)
+        open(os.path.join(outside, "6.txt"), "w").close()
+        os.symlink(outside, os.path.join(self.tempdir, "a/d/out"))
+        self.assertIn("a/d/out/6.txt", self.walk(follow_symlinks = True, ordered = True))
+        self.assertNotIn("a/d/out/6.txt", self.walk(ordered = True))
+    
+    def test_zip_files(self):
+        files = self.walk(ordered = True, zip_files = True, workers = 2)
+        index = files.index("a/z.zip")
+        self.assertEqual(files[index + 1:index + 3], ["x.txt", "y/z.py", ])
+        self.assertEqual(self.walk(zip_files = True, include = "*.py", ordered = True),
+                         ["a/b/3.py", "y/z.py", "e/5.py", ])
+        self.assertEqual(self.walk(zip_files = True, include = "a/z.zip/y/*"), ["y/z.py", ])
+    
+    def test_filter_errors(self):
+        def failing(f):
+            if f.path.base == "d":
+                raise RuntimeError("failing filter")
+            return False
+        for options in ({}, {"workers": 2}, {"workers": 2, "ordered": True}, ):
+            self.assertRaises(RuntimeError, self.walk, exclude = failing, **options)
+    
+    def test_errors(self):
+        with open(os.path.join(self.tempdir, "e/bad.zip"), "w") as f:
+            f.write("not a zip file")
+        errors = []
+        for workers in (1, 2, ):
+            files = self.walk(zip_files = True, workers = workers, onerror = errors.append)
+            self.assertIn("e/bad.zip", files)
+        self.assertEqual([type(e) for e in errors], [zipfile.BadZipfile] * 2)
+
+    
+    def test_unreadable(self):
+        """Unreadable directories are passed to onerror and skipped."""
+        
+        locked = os.path.join(self.tempdir, "a", "b")
+        def failing(value):
+            raise OSError(errno.EACCES, os.strerror(errno.EACCES), value)
+        original_scandir = fs.scandir
+        original_stat = os.stat
+        def restore():
+            fs.scandir = original_scandir
+            os.stat = original_stat
+        self.addCleanup(restore)
+        
+        def scandir(value):
+            if value == locked:
+                failing(value)
+            return [FakeEntry(value, name) for name in os.listdir(value)]
+        fs.scandir = scandir
+        expected = ["1.txt", "a", "a/2.txt", "a/b", "a/d", "a/z.zip", "e", "e/5.py", ]
+        for options in ({}, {"workers": 2}, {"workers": 2, "ordered": True}, ):
+            errors = []
+            self.assertEqual(sorted(self.walk(onerror = errors.append, **options)), expected)
+            self.assertEqual([e.errno for e in errors], [errno.EACCES])
+        
+        fs.scandir = lambda value: [FakeEntry(value, name) for name in os.listdir(value)]
+        def stat(value):
+            if value == locked:
+                failing(value)
+            return original_stat(value)
+        os.stat = stat
+        for options in ({}, {"workers": 2}, ):
+            errors = []
+            files = self.walk(follow_symlinks = True, onerror = errors.append, **options)
+            self.assertEqual(sorted(files), expected)
+            self.assertEqual([e.errno for e in errors], [errno.EACCES])
+
+
+class TestFile(unittest.TestCase):
+    """Tests reading nmapps.fs.File."""
+    
+    def setUp(self):
+        self.tempdir = tempfile.mkdtemp()
+        self.path = os.path.join(self.tempdir, "data.bin")
+        self.data = "".join([chr(i % 256) for i in range(10000)])
+        with open(self.path, "wb") as f:
+            f.write(self.data)
+    
+    def tearDown(self):
+        shutil.rmtree(self.tempdir)
+    
+    def test_read(self):
+        self.assertEqual(fs.File(self.path).read(), self.data)
+        self.assertEqual(fs.File(self.path).basename, "data.bin")
+        self.assertRaises(IOError, fs.File(os.path.join(self.tempdir, "missing")).read)
+    
+    def test_mmap(self):
+        mapping = fs.File(self.path).mmap()
+        try:
+            self.assertEqual(len(mapping), len(self.data))
+            self.assertEqual(mapping[100:110], self.data[100:110])
+            self.assertRaises(TypeError, mapping.__setitem__, 0, "x")
+        finally:
+            mapping.close()
+        
+        empty = os.path.join(self.tempdir, "empty")
+        open(empty, "w").close()
+        self.assertRaises(ValueError, fs.File(empty).mmap)
+    
+    def test_iter_chunks(self):
+        chunks = []
+        for chunk in fs.File(self.path).iter_chunks(4096):
+            chunks.append(chunk.tobytes())
+        self.assertEqual([len(chunk) for chunk in chunks], [4096, 4096, 1808])
+        self.assertEqual("".join(chunks), self.data)
+    
+    def test_readinto(self):
+        buf = bytearray(100)
+        self.assertEqual(fs.File(self.path).readinto(buf), 100)
+        self.assertEqual(str(buf), self.data[:100])
+        self.assertEqual(fs.File(self.path).readinto(memoryview(buf)[10:20], 9995), 5)
+        self.assertEqual(str(buf[10:15]), self.data[9995:])
+
+
+class TestZipFile(unittest.TestCase):
+    """Tests the nmapps.fs.ZipFile class."""
+    
+    def setUp(self):
+        self.tempdir = tempfile.mkdtemp()
+        self.path = os.path.join(self.tempdir, "test.egg")
+        self.members = dict([("pkg/mod%d.py" % (i, ), "# module %d\\n" % (i, ) * 100)
+                             for i in range(50)])
+        self.members["pkg/sub/data.txt"] = "data"
+        self.members["top.txt"] = "top"
+        with zipfile.ZipFile(self.path, "w", zipfile.ZIP_DEFLATED) as z:
+            z.writestr("empty/", "")
+            for name, data in sorted(self.members.items()):
+                z.writestr(name, data)
+    
+    def tearDown(self):
+        shutil.rmtree(self.tempdir)
+    
+    def test_get(self):
+        with fs.ZipFile(self.path) as archive:
+            self.assertIn("top.txt", archive)
+            self.assertNotIn("missing", archive)
+            self.assertEqual(archive.get("pkg/sub/data.txt").read(), "data")
+            self.assertRaises(KeyError, archive.get, "missing")
+            with archive.get("top.txt").open() as f:
+                self.assertEqual(f.read(), "top")
+        self.assertIsNone(archive._zip_file)
+        self.assertEqual(archive._handles, [])
+    
+    def test_list_dir(self):
+        archive = fs.ZipFile(self.path)
+        self.assertEqual(archive.list_dir(), ["empty/", "pkg/", "top.txt"])
+        self.assertEqual(archive.list_dir("pkg")[-2:], ["mod9.py", "sub/"])
+        self.assertEqual(archive.list_dir("pkg/sub/"), ["data.txt"])
+        self.assertEqual(archive.list_dir("empty/"), [])
+        self.assertRaises(KeyError, archive.list_dir, "top.txt")
+        archive.close()
+    
+    def test_concurrent_reads(self):
+        archive = fs.ZipFile(self.path, max_handles = 2)
+        entries = archive.list()
+        with utils.ThreadPool(8) as pool:
+            for i in range(4):
+                results = list(pool.map(lambda entry: (str(entry), entry.read()), entries))
+                self.assertEqual(dict(results), dict(self.members, **{"empty/": ""}))
+        self.assertTrue(len(archive._handles) <= 2)
+        self.assertEqual(archive._in_use, set())
+        
+        stream = entries[1].open()
+        archive.close()
+        self.assertEqual(stream.read(), self.members[str(entries[1])])
+        stream.close()
+        self.assertEqual(archive._handles, [])
+        self.assertEqual(archive._stale, set())
+        archive.close()
+    
+    def test_read_many(self):
+        names = sorted(self.members)
+        for processes in (False, True, ):
+            results = list(fs.ZipFile(self.path).read_many(names, workers = 3,
+                                                           processes = processes))
+            self.assertEqual([name for name, data in results], names)
+            self.assertEqual(dict(results), self.members)
+        
+        results = fs.ZipFile(self.path).read_many(workers = 2)
+        self.assertEqual(next(results), ("empty/", ""))
+        results.close()
+    
+    def test_extract_all(self):
+        dest = os.path.join(self.tempdir, "out")
+        for processes in (False, True, ):
+            archive = fs.ZipFile(self.path)
+            results = archive.extract_all(dest, workers = 3, processes = processes)
+            self.assertEqual([name for name, extracted in results],
+                             archive.zip_file.namelist())
+            result = dict(results)
+            self.assertEqual(set(result), set(self.members) | set(["empty/"]))
+            self.assertEqual(set(result.values()), set([not processes]))
+            archive.close()
+        for name, data in self.members.items():
+            with open(os.path.join(dest, name)) as f:
+                self.assertEqual(f.read(), data)
+        self.assertTrue(os.path.isdir(os.path.join(dest, "empty")))
+        
+        with open(os.path.join(dest, "top.txt"), "w") as f:
+            f.write("tip")
+        results = fs.ZipFile(self.path).extract_all(dest, ["top.txt", "empty/", "pkg/mod1.py"])
+        self.assertEqual(results, [("top.txt", True), ("empty/", False),
+                                         ("pkg/mod1.py", False)])
+        with open(os.path.join(dest, "top.txt")) as f:
+            self.assertEqual(f.read(), "top")
+        self.assertEqual([name for name in os.listdir(dest) if name.endswith(".tmp")], [])
+    
+    def test_iter_extract(self):
+        dest = os.path.join(self.tempdir, "out")
+        archive = fs.ZipFile(self.path)
+        names = ["top.txt", "empty/", "pkg/mod1.py"]
+        results = archive.iter_extract(dest, names, workers = 1)
+        self.assertTrue(os.path.isdir(os.path.join(dest, "empty")))
+        self.assertEqual(next(results), ("top.txt", True))
+        self.assertEqual(list(results), [("empty/", True), ("pkg/mod1.py", True)])
+        with open(os.path.join(dest, "pkg", "mod1.py")) as f:
+            self.assertEqual(f.read(), self.members["pkg/mod1.py"])
+        archive.close()
+    
+    def test_extract_outside(self):
+        with zipfile.ZipFile(self.path, "a") as z:
+            z.writestr("../evil.txt", "x")
+        dest = os.path.join(self.tempdir, "out")
+        self.assertRaises(ValueError, fs.ZipFile(self.path).extract_all, dest)
+        self.assertFalse(os.path.exists(os.path.join(self.tempdir, "evil.txt")))
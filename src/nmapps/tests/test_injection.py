@@ -3,6 +3,8 @@
 
 import unittest
 import sys
+import threading
+import time
 import logging
 
 logging.basicConfig(level = logging.DEBUG, filename = "test_injection.log")
@@ -44,6 +46,82 @@ class TestPackage(unittest.TestCase):
         with self.assertRaises(injection.DependencyException):
             unknown = injection.get("unknown-dependency")
 
+    
+    def test_provides(self):
+        """Decorated factories are called lazily."""
+        calls = []
+        
+        @injection.provides("service", "named-alternative", 42)
+        class Service(object):
+            def __init__(self, value):
+                calls.append(value)
+                self.value = value
+        
+        self.assertEqual(calls, [])
+        
+        service = injection.get("service")
+        self.assertIsInstance(service, Service)
+        self.assertEqual(service.value, 42)
+        self.assertIs(injection.get("service"), service)
+        self.assertEqual(calls, [42])
+
+
+class TestProviders(unittest.TestCase):
+    """Tests the lifetimes of lazy dependency providers."""
+    
+    def setUp(self):
+        self.manager = injection.DefaultDependencyManager()
+    
+    def tearDown(self):
+        self.manager = None
+    
+    def test_transient(self):
+        self.manager.provide("dependency", object, lifetime = injection.TRANSIENT)
+        self.assertIsNot(self.manager.get("dependency"),
+                         self.manager.get("dependency"))
+    
+    def test_thread(self):
+        self.manager.provide("dependency", object, lifetime = injection.THREAD)
+        
+        value = self.manager.get("dependency")
+        self.assertIs(self.manager.get("dependency"), value)
+        
+        other = []
+        thread = threading.Thread(
+            target = lambda: other.append(self.manager.get("dependency")))
+        thread.start()
+        thread.join()
+        self.assertIsNot(other[0], value)
+    
+    def test_singleton_race(self):
+        """Singletons are built only once, even when threads race on them."""
+        calls = []
+        
+        def factory():
+            calls.append(None)
+            time.sleep(0.01)
+            return object()
+        
+        self.manager.provide("dependency", factory)
+        
+        results = []
+        threads = [threading.Thread(
+                       target = lambda: results.append(self.manager.get("dependency")))
+                   for i in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        
+        self.assertEqual(len(calls), 1)
+        self.assertEqual(len(results), 8)
+        for result in results:
+            self.assertIs(result, results[0])
+    
+    def test_unknown_lifetime(self):
+        with self.assertRaises(injection.DependencyException):
+            self.manager.provide("dependency", object, lifetime = "forever")
+
 
 class TestDefaultDependencyManager(unittest.TestCase):
     """Tests the nmapps.injection.DefaultDependencyManager class."""
@@ -102,3 +180,446 @@ class TestDefaultDependencyManager(unittest.TestCase):
         self.assertIs(dependency, value)
 
 
+
+
+class TestFrozenDependencyManager(unittest.TestCase):
+    """Tests the snapshot-backed resolution of a frozen manager."""
+    
+    def setUp(self):
+        self.manager = injection.DefaultDependencyManager()
+    
+    def tearDown(self):
+        self.manager = None
+    
+    def test_get_frozen(self):
+        """Frozen manager resolves the same values as the regular one."""
+        
+        value = object()
+        self.manager.set("dependency", object(), name = "a")
+        self.manager.set("dependency", value, name = "b")
+        self.manager.select("dependency", "b")
+        self.manager.set("dependency", object())
+        
+        self.manager.freeze()
+        
+        self.assertIs(self.manager.get("dependency"), value)
+        with self.assertRaises(injection.DependencyException):
+            self.manager.get("unknown-dependency")
+        fallback = object()
+        self.assertIs(self.manager.get("unknown-dependency", fallback), fallback)
+    
+    def test_invalidate(self):
+        """Changes made after freezing invalidate the snapshot."""
+        
+        self.manager.set("dependency", object(), name = "a")
+        self.manager.freeze()
+        
+        value = object()
+        self.manager.set("dependency", value)
+        self.assertIs(self.manager.get("dependency"), value)
+        
+        value = object()
+        self.manager.set("dependency", value, name = "b")
+        self.manager.select("dependency", "b")
+        self.manager.set("dependency", object())
+        self.assertIs(self.manager.get("dependency"), value)
+        
+        self.manager.clear()
+        with self.assertRaises(injection.DependencyException):
+            self.manager.get("dependency")
+
+
+class TestAutowired(unittest.TestCase):
+    """Tests constructor auto-wiring."""
+    
+    def setUp(self):
+        injection.clear()
+    
+    def tearDown(self):
+        injection.clear()
+    
+    def test_autowired(self):
+        """Parameters are filled by key, defaults apply to unset keys."""
+        
+        @injection.autowired(db = "database")
+        class Service(object):
+            def __init__(self, db, cache, timeout = 10):
+                self.db = db
+                self.cache = cache
+                self.timeout = timeout
+        
+        db = object()
+        cache = object()
+        injection.set("database", db)
+        injection.set("cache", cache)
+        
+        service = Service()
+        self.assertIs(service.db, db)
+        self.assertIs(service.cache, cache)
+        self.assertEqual(service.timeout, 10)
+        
+        injection.set("timeout", 20)
+        self.assertEqual(Service().timeout, 20)
+        
+        other = object()
+        self.assertIs(Service(other).db, other)
+        self.assertIs(Service(cache = other).cache, other)
+        
+        plan = Service.__injection_plan__
+        self.assertEqual(plan.keys, ("database", "cache", "timeout", ))
+        self.assertEqual(plan.optional, (False, False, True, ))
+        self.assertIs(Service().__injection_plan__, plan)
+    
+    def test_missing(self):
+        """Unset required dependencies raise exception."""
+        
+        @injection.autowired
+        class Service(object):
+            def __init__(self, db):
+                self.db = db
+        
+        with self.assertRaises(injection.DependencyException):
+            Service()
+    
+    def test_rewire(self):
+        """Wiring the class again invalidates the cached plan."""
+        
+        @injection.autowired
+        class Service(object):
+            def __init__(self, db):
+                self.db = db
+        
+        first, second = object(), object()
+        injection.set("db", first)
+        injection.set("other-db", second)
+        
+        self.assertIs(Service().db, first)
+        
+        injection.wire(Service, db = "other-db")
+        self.assertIsNone(Service.__injection_plan__)
+        self.assertIs(Service().db, second)
+
+
+class TestScopes(unittest.TestCase):
+    """Tests scoped child managers."""
+    
+    def setUp(self):
+        injection.clear()
+    
+    def tearDown(self):
+        injection.clear()
+    
+    def test_overlay(self):
+        """Scopes read through to the parent and keep changes local."""
+        
+        parent = injection.DefaultDependencyManager()
+        value, named = object(), object()
+        parent.set("dependency", value)
+        parent.set("dependency", named, name = "named")
+        parent.set("other", value)
+        
+        child = parent.scope()
+        self.assertEqual(child.entries, {})
+        self.assertIs(child.get("dependency"), named)
+        
+        child.select("dependency", "named")
+        local = object()
+        child.set("other", local)
+        
+        self.assertIs(child.get("dependency"), named)
+        self.assertIs(child.get("other"), local)
+        self.assertIs(parent.get("other"), value)
+        self.assertIsNone(parent.get_entry("dependency").selected_name)
+        
+        with self.assertRaises(injection.DependencyException):
+            child.get("unknown-dependency")
+    
+    def test_current(self):
+        """Entered scopes become current in the calling thread only."""
+        
+        value = object()
+        injection.set("dependency", value)
+        
+        with injection.scope() as manager:
+            self.assertIs(injection.current(), manager)
+            
+            local = object()
+            injection.set("dependency", local)
+            self.assertIs(injection.get("dependency"), local)
+            
+            other = []
+            thread = threading.Thread(
+                target = lambda: other.append(injection.get("dependency")))
+            thread.start()
+            thread.join()
+            self.assertIs(other[0], value)
+        
+        self.assertIs(injection.current(), injection.MANAGER)
+        self.assertIs(injection.get("dependency"), value)
+
+
+class TestConcurrency(unittest.TestCase):
+    """Stress tests of concurrent changes and lookups."""
+    
+    THREADS = 8
+    ITERATIONS = 500
+    
+    def setUp(self):
+        self.manager = injection.DefaultDependencyManager()
+        
+        self.interval = None
+        if hasattr(sys, "setcheckinterval"):
+            self.interval = sys.getcheckinterval()
+            sys.setcheckinterval(1)
+    
+    def tearDown(self):
+        self.manager = None
+        if self.interval is not None:
+            sys.setcheckinterval(self.interval)
+    
+    def run_threads(self, targets):
+        threads = [threading.Thread(target = target) for target in targets]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+    
+    def test_no_lost_updates(self):
+        """Concurrent sets on shared and new keys are never lost."""
+        
+        def writer(index):
+            def target():
+                for i in range(self.ITERATIONS):
+                    self.manager.set("shared", (index, i))
+                    self.manager.set("key-%d-%d" % (index, i % 10), (index, i))
+            return target
+        
+        self.run_threads([writer(i) for i in range(self.THREADS)])
+        
+        entry = self.manager.get_entry("shared")
+        self.assertEqual(len(entry.alternatives), self.THREADS * self.ITERATIONS)
+        self.assertEqual(len(set(entry.alternatives)), self.THREADS * self.ITERATIONS)
+        self.assertIs(self.manager.get("shared"), entry.alternatives[-1])
+        self.assertEqual(len(self.manager.entries), 1 + self.THREADS * 10)
+    
+    def test_no_torn_selection(self):
+        """Lookups racing with changes only ever see a valid selection."""
+        
+        a, b = object(), object()
+        self.manager.set("dependency", a, name = "a")
+        self.manager.set("dependency", b, name = "b")
+        self.manager.select("dependency", "a")
+        self.manager.freeze()
+        
+        errors = []
+        
+        def writer():
+            for i in range(self.ITERATIONS):
+                self.manager.select("dependency", "ab"[i % 2])
+                self.manager.set("dependency", object())
+        
+        def reader():
+            for i in range(self.ITERATIONS * 4):
+                value = self.manager.get("dependency")
+                if value is not a and value is not b:
+                    errors.append(value)
+        
+        self.run_threads([writer] * 2 + [reader] * (self.THREADS - 2))
+        
+        self.assertEqual(errors, [])
+        
+        entry = self.manager.get_entry("dependency")
+        self.assertIs(self.manager.get("dependency"),
+                      entry.named[entry.selected_name])
+
+
+class TestResolveAll(unittest.TestCase):
+    """Tests the concurrent initialization of singleton providers."""
+    
+    def setUp(self):
+        self.manager = injection.DefaultDependencyManager()
+    
+    def tearDown(self):
+        self.manager = None
+    
+    def slow(self, value = None, delay = 0.2):
+        def factory():
+            time.sleep(delay)
+            return value if value is not None else object()
+        return factory
+    
+    def test_concurrent(self):
+        """Independent providers are built concurrently, in dependency order."""
+        
+        for key in ("a", "b", "c"):
+            self.manager.provide(key, self.slow())
+        self.manager.provide("d", self.slow(), requires = ("a", "b", ))
+        self.manager.set("e", object())
+        
+        start = time.time()
+        built = self.manager.resolve_all()
+        elapsed = time.time() - start
+        
+        self.assertEqual(sorted(built), ["a", "b", "c", "d"])
+        self.assertEqual(built[-1], "d")
+        self.assertLess(elapsed, 0.7)
+        self.assertEqual(self.manager.resolve_all(), [])
+    
+    def test_autowired_requires(self):
+        """Dependencies of autowired classes are derived from the plan."""
+        
+        @injection.autowired
+        class Service(object):
+            def __init__(self, db):
+                self.db = db
+        
+        db = object()
+        self.manager.provide("service", Service)
+        self.manager.provide("db", self.slow(db, 0.01))
+        
+        self.assertEqual(self.manager.resolve_all(workers = 1), ["db", "service"])
+        with self.manager:
+            self.assertIs(self.manager.get("service").db, db)
+    
+    def test_cycle(self):
+        self.manager.provide("a", object, requires = ("b", ))
+        self.manager.provide("b", object, requires = ("c", ))
+        self.manager.provide("c", object, requires = ("a", ))
+        
+        with self.assertRaises(injection.DependencyException) as context:
+            self.manager.resolve_all()
+        self.assertIn("Circular", str(context.exception))
+    
+    def test_failure(self):
+        def fail():
+            raise ValueError("failure")
+        
+        self.manager.provide("a", fail)
+        self.manager.provide("b", object, requires = ("a", ))
+        
+        with self.assertRaises(injection.DependencyException) as context:
+            self.manager.resolve_all()
+        self.assertIsInstance(context.exception.inner_exception, ValueError)
+    
+    def test_undeclared_cycle(self):
+        """Factories requesting each other without declaring it fail
+        instead of waiting for each other forever."""
+        
+        def factory(other):
+            def build():
+                time.sleep(0.05)
+                return self.manager.get(other)
+            return build
+        
+        self.manager.provide("a", factory("b"))
+        self.manager.provide("b", factory("a"))
+        
+        with self.assertRaises(injection.DependencyException) as context:
+            self.manager.resolve_all(workers = 2)
+        self.assertIn("Circular", str(context.exception))
+    
+    @unittest.skipIf(injection.asyncio is None, "asyncio is not available")
+    def test_coroutine(self):
+        """Coroutine factories are run to completion."""
+        
+        asyncio = injection.asyncio
+        value = object()
+        self.manager.provide("a", lambda: asyncio.sleep(0.01, result = value))
+        
+        self.assertEqual(self.manager.resolve_all(), ["a"])
+        self.assertIs(self.manager.get("a"), value)
+    
+    @unittest.skipIf(injection.asyncio is None, "asyncio is not available")
+    def test_coroutine_loop(self):
+        """Coroutine factories run in the current loop, which is kept."""
+        
+        asyncio = injection.asyncio
+        
+        @asyncio.coroutine
+        def factory():
+            yield asyncio.From(asyncio.sleep(0))
+            raise asyncio.Return(asyncio.get_event_loop())
+        
+        loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(loop)
+        try:
+            self.manager.provide("a", factory)
+            self.manager.provide("b", factory)
+            self.assertIs(self.manager.get("a"), loop)
+            self.assertIs(asyncio.get_event_loop(), loop)
+            self.assertFalse(loop.is_closed())
+            
+            @asyncio.coroutine
+            def inside():
+                yield asyncio.From(asyncio.sleep(0))
+                self.manager.get("b")
+            
+            with self.assertRaises(injection.DependencyException):
+                loop.run_until_complete(inside())
+            self.assertIs(asyncio.get_event_loop(), loop)
+        finally:
+            asyncio.set_event_loop(None)
+            loop.close()
+    
+    @unittest.skipIf(injection.asyncio is None, "asyncio is not available")
+    def test_async(self):
+        """resolve_all_async() awaits independent providers concurrently
+        in the caller's loop."""
+        
+        asyncio = injection.asyncio
+        
+        def slow(delay = 0.2):
+            @asyncio.coroutine
+            def factory():
+                yield asyncio.From(asyncio.sleep(delay))
+                raise asyncio.Return(asyncio.get_event_loop())
+            return factory
+        
+        for key in ("a", "b", "c"):
+            self.manager.provide(key, slow())
+        self.manager.provide("d", slow(), requires = ("a", "b", ))
+        self.manager.provide("e", object, requires = ("d", ))
+        
+        loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(loop)
+        try:
+            start = time.time()
+            built = loop.run_until_complete(self.manager.resolve_all_async())
+            elapsed = time.time() - start
+            
+            self.assertEqual(sorted(built), ["a", "b", "c", "d", "e"])
+            self.assertEqual(built[-2:], ["d", "e"])
+            self.assertLess(elapsed, 0.7)
+            self.assertIs(self.manager.get("a"), loop)
+            self.assertIs(asyncio.get_event_loop(), loop)
+            self.assertFalse(loop.is_closed())
+            self.assertEqual(loop.run_until_complete(self.manager.resolve_all_async()), [])
+        finally:
+            asyncio.set_event_loop(None)
+            loop.close()
+    
+    @unittest.skipIf(injection.asyncio is None, "asyncio is not available")
+    def test_async_errors(self):
+        asyncio = injection.asyncio
+        loop = asyncio.new_event_loop()
+        
+        @asyncio.coroutine
+        def fail():
+            yield asyncio.From(asyncio.sleep(0, loop = loop))
+            raise ValueError("failure")
+        
+        self.manager.provide("a", fail)
+        self.manager.provide("b", object, requires = ("a", ))
+        
+        try:
+            with self.assertRaises(injection.DependencyException) as context:
+                loop.run_until_complete(self.manager.resolve_all_async(loop = loop))
+            self.assertIsInstance(context.exception.inner_exception, ValueError)
+            
+            self.manager.provide("c", object, requires = ("d", ))
+            self.manager.provide("d", object, requires = ("c", ))
+            with self.assertRaises(injection.DependencyException) as context:
+                loop.run_until_complete(self.manager.resolve_all_async(loop = loop))
+            self.assertIn("Circular", str(context.exception))
+        finally:
+            loop.close()
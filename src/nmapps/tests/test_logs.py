@@ -0,0 +1,86 @@
+# src/nmapps/tests/test_logs.py
+
+import unittest
+import os
+import shutil
+import tempfile
+import logging
+
+import nmapps.logs as logs
+
+
+class TestLogWriter(unittest.TestCase):
+    """Tests the nmapps.logs.LogWriter class."""
+    
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.dir, "test.log")
+    
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+    
+    def read(self, path = None):
+        with open(path or self.path) as f:
+            return f.read()
+    
+    def test_write(self):
+        writer = logs.LogWriter(self.path)
+        writer.start()
+        for i in range(100):
+            writer.put("line %d\n" % (i, ))
+        writer.stop()
+        self.assertEqual(self.read().splitlines(),
+                         ["line %d" % (i, ) for i in range(100)])
+    
+    def test_drop(self):
+        writer = logs.LogWriter(self.path, queue_size = 2)
+        writer.queue = logs.Queue.Queue(2)
+        for i in range(5):
+            writer.put("line %d\n" % (i, ))
+        self.assertEqual(writer.dropped, 3)
+        
+        writer.open()
+        writer.write(["line 5\n"])
+        writer.close()
+        self.assertEqual(self.read(), "3 log records were dropped.\nline 5\n")
+    
+    def test_rotate(self):
+        writer = logs.LogWriter(self.path, max_bytes = 10, backup_count = 2)
+        writer.open()
+        for i in range(4):
+            writer.write(["0123456789\n"])
+        writer.close()
+        self.assertEqual(self.read(), "")
+        self.assertTrue(os.path.exists(self.path + ".1"))
+        self.assertTrue(os.path.exists(self.path + ".2"))
+        self.assertFalse(os.path.exists(self.path + ".3"))
+    
+    def test_reopen(self):
+        writer = logs.LogWriter(self.path)
+        writer.start()
+        writer.put("before\n")
+        writer.stop()
+        os.rename(self.path, self.path + ".old")
+        
+        writer.open()
+        writer.reopen()
+        writer.write(["after\n"])
+        writer.close()
+        self.assertEqual(self.read(self.path + ".old"), "before\n")
+        self.assertEqual(self.read(), "after\n")
+    
+    def test_handler(self):
+        writer = logs.LogWriter(self.path)
+        writer.start()
+        logger = logging.getLogger("nmapps.tests.test_logs")
+        logger.propagate = False
+        handler = logs.QueueHandler(writer)
+        handler.setFormatter(logging.Formatter("%(levelname)s %(message)s"))
+        logger.addHandler(handler)
+        try:
+            logger.warning(u"Hello %s.", u"\u017elu\u0165ou\u010dk\xfd")
+        finally:
+            logger.removeHandler(handler)
+            writer.stop()
+        self.assertEqual(self.read().decode("utf-8"),
+                         u"WARNING Hello \u017elu\u0165ou\u010dk\xfd.\n")
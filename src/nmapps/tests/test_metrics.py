@@ -0,0 +1,68 @@
+# src/nmapps/tests/test_metrics.py
+
+import unittest
+import os
+
+import nmapps.metrics as metrics
+
+
+class TestRingBuffer(unittest.TestCase):
+    """Tests the nmapps.metrics.RingBuffer class."""
+    
+    def test_append(self):
+        buf = metrics.RingBuffer(4)
+        self.assertEqual(buf.values(), [])
+        self.assertIsNone(buf.last())
+        for i in range(3):
+            buf.append(i)
+        self.assertEqual(buf.values(), [0, 1, 2])
+        self.assertEqual(len(buf), 3)
+    
+    def test_wrap(self):
+        buf = metrics.RingBuffer(4)
+        for i in range(10):
+            buf.append(i)
+        self.assertEqual(len(buf), 4)
+        self.assertEqual(buf.values(), [6, 7, 8, 9])
+        self.assertEqual(buf.values(3), [7, 8, 9])
+        self.assertEqual(buf.values(10), [6, 7, 8, 9])
+        self.assertEqual(buf.last(), 9)
+        self.assertEqual(len(buf.data), 4)
+    
+    def test_percentile(self):
+        values = range(1, 101)
+        self.assertEqual(metrics.percentile(values, 0), 1)
+        self.assertEqual(metrics.percentile(values, 100), 100)
+        self.assertAlmostEqual(metrics.percentile(values, 50), 50.5)
+        self.assertAlmostEqual(metrics.percentile(values, 99), 99.01)
+        self.assertIsNone(metrics.percentile([], 50))
+
+
+class TestResourceSampler(unittest.TestCase):
+    """Tests the nmapps.metrics.ResourceSampler class."""
+    
+    def test_sample(self):
+        sampler = metrics.ResourceSampler(capacity = 3)
+        for i in range(5):
+            self.assertTrue(sampler.sample())
+        samples = sampler.samples()
+        self.assertEqual(len(samples), 3)
+        self.assertGreater(samples[-1]["rss"], 0)
+        self.assertGreater(samples[-1]["fds"], 0)
+        self.assertIsNotNone(samples[-1]["cpu"])
+        
+        summary = sampler.summary()
+        self.assertEqual(summary["rss"]["last"], samples[-1]["rss"])
+        self.assertLessEqual(summary["fds"]["p50"], summary["fds"]["max"])
+    
+    @unittest.skipUnless(os.path.exists("/proc/self/stat"), "requires /proc")
+    def test_other_process(self):
+        sampler = metrics.ResourceSampler(pid = os.getppid())
+        self.assertTrue(sampler.sample())
+        self.assertGreater(sampler.samples()[0]["rss"], 0)
+        self.assertIsNone(sampler.samples()[0]["gc_count"])
+    
+    def test_missing_process(self):
+        sampler = metrics.ResourceSampler(pid = 2 ** 22 + 1)
+        self.assertFalse(sampler.sample())
+        self.assertEqual(sampler.samples(), [])
@@ -0,0 +1,67 @@
+# src/nmapps/tests/test_resources.py
+
+import unittest
+import resource
+
+import nmapps.resources as resources
+
+
+class TestResourceProfile(unittest.TestCase):
+    """Tests the nmapps.resources module."""
+    
+    def test_parse_cpus(self):
+        self.assertEqual(resources.parse_cpus("0-3,6"), [0, 1, 2, 3, 6])
+        self.assertEqual(resources.parse_cpus([2, 1, 2]), [1, 2])
+        for cpus in ["", "a", "1-x", [-1], [4096]]:
+            with self.assertRaises(resources.ResourceException):
+                resources.parse_cpus(cpus)
+    
+    def test_parse_io_priority(self):
+        self.assertEqual(resources.parse_io_priority("be/4"), (2, 4))
+        self.assertEqual(resources.parse_io_priority("idle"), (3, 0))
+        self.assertEqual(resources.parse_io_priority((1, 0)), (1, 0))
+        for value in ["fast", "be/8", "be/x", (5, 0)]:
+            with self.assertRaises(resources.ResourceException):
+                resources.parse_io_priority(value)
+    
+    def test_affinity(self):
+        cpus = resources.get_affinity()
+        self.assertTrue(cpus)
+        resources.set_affinity(cpus)
+        self.assertEqual(resources.get_affinity(), cpus)
+    
+    def test_limits(self):
+        limits = resource.getrlimit(resource.RLIMIT_CORE)
+        try:
+            resources.ResourceProfile(core = (0, limits[1])).apply()
+            self.assertEqual(resource.getrlimit(resource.RLIMIT_CORE), (0, limits[1]))
+        finally:
+            resource.setrlimit(resource.RLIMIT_CORE, limits)
+    
+    def test_limits_error(self):
+        soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+        if hard == resource.RLIM_INFINITY:
+            self.skipTest("RLIMIT_NOFILE is unlimited")
+        with self.assertRaises(resources.ResourceException):
+            # The soft limit can't exceed the hard limit.
+            resources.ResourceProfile(nofile = (hard + 1, hard)).apply()
+    
+    def test_pin_workers(self):
+        cpus = resources.get_affinity()
+        profile = resources.ResourceProfile(cpus = cpus, pin_workers = True)
+        try:
+            profile.apply_worker(len(cpus))
+            self.assertEqual(resources.get_affinity(), cpus[:1])
+        finally:
+            resources.set_affinity(cpus)
+    
+    def test_pin_workers_default(self):
+        """Without cpus, workers are pinned to the CPUs of the daemon."""
+        
+        cpus = resources.get_affinity()
+        profile = resources.ResourceProfile(pin_workers = True)
+        try:
+            profile.apply_worker(len(cpus) + 1)
+            self.assertEqual(resources.get_affinity(), cpus[1:2] or cpus[:1])
+        finally:
+            resources.set_affinity(cpus)
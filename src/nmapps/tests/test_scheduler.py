@@ -0,0 +1,143 @@
+# src/nmapps/tests/test_scheduler.py
+
+import unittest
+import time
+import datetime
+import threading
+
+import nmapps.scheduler as scheduler
+
+
+def timestamp(*args):
+    return time.mktime(datetime.datetime(*args).timetuple())
+
+
+class TestInterval(unittest.TestCase):
+    """Tests the nmapps.scheduler.Interval class."""
+    
+    def test_next(self):
+        interval = scheduler.Interval(10.0)
+        self.assertEqual(interval.first(100.0), 110.0)
+        self.assertEqual(interval.next(110.0, 111.0), 120.0)
+        # The missed runs are skipped.
+        self.assertEqual(interval.next(110.0, 145.0), 150.0)
+    
+    def test_start(self):
+        interval = scheduler.Interval(10.0, start = 105.0)
+        self.assertEqual(interval.first(100.0), 105.0)
+        self.assertEqual(interval.first(107.0), 115.0)
+    
+    def test_invalid(self):
+        with self.assertRaises(scheduler.SchedulerException):
+            scheduler.Interval(0)
+
+
+class TestCron(unittest.TestCase):
+    """Tests the nmapps.scheduler.Cron class."""
+    
+    def test_parse(self):
+        cron = scheduler.Cron("*/15 8-10 1,15 * 1-5")
+        self.assertEqual(cron.minutes, frozenset([0, 15, 30, 45]))
+        self.assertEqual(cron.hours, frozenset([8, 9, 10]))
+        self.assertEqual(cron.days, frozenset([1, 15]))
+        self.assertEqual(cron.months, frozenset(range(1, 13)))
+        self.assertEqual(cron.weekdays, frozenset([1, 2, 3, 4, 5]))
+    
+    def test_invalid(self):
+        for expression in ["* * * *", "60 * * * *", "a * * * *", "5-1 * * * *"]:
+            with self.assertRaises(scheduler.SchedulerException):
+                scheduler.Cron(expression)
+    
+    def test_next(self):
+        cron = scheduler.Cron("30 2 * * *")
+        self.assertEqual(cron.first(timestamp(2024, 3, 1, 1, 0, 10)),
+                         timestamp(2024, 3, 1, 2, 30))
+        self.assertEqual(cron.first(timestamp(2024, 3, 1, 2, 30)),
+                         timestamp(2024, 3, 2, 2, 30))
+        
+        cron = scheduler.Cron("@monthly")
+        self.assertEqual(cron.first(timestamp(2024, 12, 5, 12, 0)),
+                         timestamp(2025, 1, 1, 0, 0))
+    
+    def test_weekdays(self):
+        # 2024-03-01 is a Friday.
+        cron = scheduler.Cron("0 12 * * 0")
+        self.assertEqual(cron.first(timestamp(2024, 3, 1)),
+                         timestamp(2024, 3, 3, 12, 0))
+        cron = scheduler.Cron("0 12 10 * 0")
+        self.assertEqual(cron.first(timestamp(2024, 3, 4)),
+                         timestamp(2024, 3, 10, 12, 0))
+        self.assertEqual(cron.first(timestamp(2024, 3, 10, 13)),
+                         timestamp(2024, 3, 17, 12, 0))
+    
+    def test_never(self):
+        with self.assertRaises(scheduler.SchedulerException):
+            scheduler.Cron("0 0 30 2 *").first(time.time())
+
+
+class TestScheduler(unittest.TestCase):
+    """Tests the nmapps.scheduler.Scheduler class."""
+    
+    def setUp(self):
+        self.scheduler = scheduler.Scheduler(workers = 2)
+        self.scheduler.start()
+    
+    def tearDown(self):
+        self.scheduler.stop()
+    
+    def test_every(self):
+        event = threading.Event()
+        calls = []
+        def job(value):
+            calls.append(value)
+            if len(calls) == 3:
+                event.set()
+        
+        started = time.time()
+        self.scheduler.every(0.02, job, "x")
+        self.assertTrue(event.wait(2.0))
+        self.assertEqual(calls[:3], ["x", "x", "x"])
+        self.assertGreaterEqual(time.time() - started, 0.06)
+    
+    def test_order(self):
+        calls = []
+        done = threading.Event()
+        now = time.time()
+        self.scheduler.every(10.0, calls.append, 3, start = now + 0.06)
+        self.scheduler.every(10.0, calls.append, 1, start = now + 0.02)
+        self.scheduler.every(10.0, calls.append, 2, start = now + 0.04)
+        self.scheduler.every(10.0, done.set, start = now + 0.08)
+        self.assertTrue(done.wait(2.0))
+        self.assertEqual(calls, [1, 2, 3])
+    
+    def test_overlap(self):
+        release = threading.Event()
+        job = self.scheduler.every(0.01, release.wait, 5.0)
+        time.sleep(0.1)
+        self.assertEqual(job.running, 1)
+        self.assertGreater(job.skipped, 0)
+        release.set()
+    
+    def test_remove(self):
+        calls = []
+        job = self.scheduler.every(0.01, calls.append, 1)
+        self.scheduler.remove(job)
+        time.sleep(0.05)
+        self.assertEqual(calls, [])
+        self.assertEqual(self.scheduler.jobs, [])
+    
+    def test_failure(self):
+        done = threading.Event()
+        def job():
+            done.set()
+            raise ValueError()
+        job = self.scheduler.every(0.01, job, name = "failing")
+        self.assertTrue(done.wait(2.0))
+        time.sleep(0.02)
+        self.assertGreater(job.failures, 0)
+    
+    def test_stop(self):
+        self.scheduler.every(3600.0, lambda: None)
+        started = time.time()
+        self.scheduler.stop()
+        self.assertLess(time.time() - started, 0.5)
@@ -0,0 +1,115 @@
+# src/nmapps/tests/test_shared.py
+
+import unittest
+import os
+import shutil
+import tempfile
+
+import nmapps.shared as shared
+
+
+class TestSharedState(unittest.TestCase):
+    """Tests the nmapps.shared.SharedState class."""
+    
+    def setUp(self):
+        self.tempdir = tempfile.mkdtemp()
+        self.path = os.path.join(self.tempdir, "test.shm")
+    
+    def tearDown(self):
+        shutil.rmtree(self.tempdir)
+    
+    def test_counters(self):
+        state = shared.SharedState(["a", "b"], slots = 3).create()
+        self.assertEqual(state.incr("a"), 1)
+        self.assertEqual(state.incr("a", 5), 6)
+        state.after_fork(2)
+        state.incr("a", 10)
+        self.assertEqual(state.get_slots("a"), [6, 0, 10])
+        self.assertEqual(state.get("a"), 16)
+        self.assertEqual(state.get("b"), 0)
+        self.assertRaises(shared.SharedException, state.incr, "c")
+        self.assertRaises(shared.SharedException, state.after_fork, 3)
+        state.close()
+    
+    def test_slots_cache_lines(self):
+        state = shared.SharedState(["a"], slots = 2)
+        self.assertEqual(state.counter_offset("a", 1) - state.counter_offset("a", 0),
+                         shared.CACHE_LINE)
+    
+    def test_records(self):
+        state = shared.SharedState(records = {"last": "dq", "flag": "?"}).create()
+        self.assertEqual(state.get_record("last"), (0.0, 0))
+        state.set_record("last", 1.5, 42)
+        state.set_record("flag", True)
+        self.assertEqual(state.get_record("last"), (1.5, 42))
+        self.assertEqual(state.snapshot()["records"], {"last": [1.5, 42], "flag": [True]})
+        self.assertRaises(shared.SharedException, state.set_record, "other", 1)
+        state.close()
+    
+    def test_invalid_format(self):
+        self.assertRaises(shared.SharedException, shared.SharedState,
+                          records = {"bad": "zz"})
+    
+    def test_fork(self):
+        state = shared.SharedState(["requests"], {"last": "q"}, slots = 5,
+                                   path = self.path).create()
+        pids = []
+        for slot in range(1, 5):
+            pid = os.fork()
+            if pid == 0:
+                try:
+                    state.after_fork(slot)
+                    for i in range(1000):
+                        state.incr("requests")
+                        state.set_record("last", i)
+                finally:
+                    os._exit(0)
+            pids.append(pid)
+        for pid in pids:
+            os.waitpid(pid, 0)
+        self.assertEqual(state.get_slots("requests"), [0, 1000, 1000, 1000, 1000])
+        self.assertEqual(state.get_record("last"), (999, ))
+        
+        reader = shared.SharedState.attach(self.path)
+        self.assertEqual(reader.snapshot(),
+                         {"counters": {"requests": 4000}, "records": {"last": [999]}})
+        reader.close()
+        
+        state.remove()
+        self.assertFalse(os.path.exists(self.path))
+    
+    def test_remove_replaced(self):
+        old = shared.SharedState(["a"], path = self.path).create()
+        new = shared.SharedState(["a"], path = self.path).create()
+        old.remove()
+        self.assertTrue(os.path.exists(self.path))
+        new.remove()
+        self.assertFalse(os.path.exists(self.path))
+    
+    def test_publish(self):
+        old = shared.SharedState(["a"], path = self.path).create()
+        old.incr("a")
+        new = shared.SharedState(["a"], path = self.path).create(publish = False)
+        reader = shared.SharedState.attach(self.path)
+        self.assertEqual(reader.get("a"), 1)
+        reader.close()
+        
+        new.publish()
+        reader = shared.SharedState.attach(self.path)
+        self.assertEqual(reader.get("a"), 0)
+        reader.close()
+        old.remove()
+        new.remove()
+        self.assertEqual(os.listdir(self.tempdir), [])
+    
+    def test_remove_unpublished(self):
+        old = shared.SharedState(["a"], path = self.path).create()
+        new = shared.SharedState(["a"], path = self.path).create(publish = False)
+        new.remove()
+        self.assertEqual(os.listdir(self.tempdir), ["test.shm"])
+        old.remove()
+    
+    def test_attach_invalid(self):
+        with open(self.path, "w") as f:
+            f.write("x" * 100)
+        self.assertRaises(shared.SharedException, shared.SharedState.attach, self.path)
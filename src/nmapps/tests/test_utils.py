@@ -1,6 +1,8 @@
 # src/nmapps/tests/test_usrexcept.py
 
 import unittest
+import threading
+import Queue
 
 import nmapps.utils as utils
 
@@ -21,3 +23,32 @@ class TestUserException(unittest.TestCase):
             self.assertIsNotNone(e.inner_exception.exc_info[2])
 
 
+class TestThreadPool(unittest.TestCase):
+    def test_submit(self):
+        with utils.ThreadPool(2) as pool:
+            futures = [pool.submit(pow, 2, n) for n in range(10)]
+            self.assertEqual([f.result(1.0) for f in futures],
+                             [2 ** n for n in range(10)])
+            self.assertLessEqual(len(pool.threads), 2)
+    
+    def test_exception(self):
+        with utils.ThreadPool(1) as pool:
+            future = pool.submit(int, "x")
+            with self.assertRaises(ValueError):
+                future.result(1.0)
+    
+    def test_map(self):
+        with utils.ThreadPool(3) as pool:
+            self.assertEqual(list(pool.map(lambda x: x * x, range(20), window = 4)),
+                             [x * x for x in range(20)])
+    
+    def test_full(self):
+        release = threading.Event()
+        pool = utils.ThreadPool(1, queue_size = 1)
+        pool.submit(release.wait)
+        pool.submit(release.wait)
+        with self.assertRaises(Queue.Full):
+            for i in range(2):
+                pool.submit_ex(release.wait, block = False)
+        release.set()
+        pool.shutdown()
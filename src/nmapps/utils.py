@@ -2,6 +2,8 @@
 
 
 import sys
+import threading
+import Queue
 
 
 def decorate_exception(e):
@@ -38,3 +40,119 @@ class UserException(Exception):
         )
 
 
+class Future(object):
+    """
+    Result of a call submitted to a ThreadPool.
+    """
+    
+    def __init__(self):
+        self.event = threading.Event()
+        self.value = None
+        self.exc_info = None
+    
+    def done(self):
+        return self.event.is_set()
+    
+    def set_result(self, value):
+        self.value = value
+        self.event.set()
+    
+    def set_exc_info(self, exc_info):
+        self.exc_info = exc_info
+        self.event.set()
+    
+    def result(self, timeout = None):
+        """
+        Waits for the call to finish, returns its return value or raises
+        its exception. Raises Queue.Empty on timeout.
+        """
+        if not self.event.wait(timeout):
+            raise Queue.Empty()
+        if self.exc_info is not None:
+            raise self.exc_info[0], self.exc_info[1], self.exc_info[2]
+        return self.value
+
+
+class ThreadPool(object):
+    """
+    A bounded pool of daemon threads calling submitted functions.
+    
+    The threads are started on demand, up to ``workers``. With queue_size,
+    at most queue_size calls wait for a free thread and submit() blocks
+    (or, with ``block = False``, raises Queue.Full) when the queue is full.
+    """
+    
+    def __init__(self, workers = 4, queue_size = 0, name = "nmapps.utils.ThreadPool"):
+        self.workers = workers
+        self.name = name
+        self.queue = Queue.Queue(queue_size)
+        self.threads = []
+        self.idle = 0
+        self.lock = threading.Lock()
+        self.closed = False
+    
+    def __enter__(self):
+        return self
+    
+    def __exit__(self, type, value, traceback):
+        self.shutdown()
+    
+    def submit(self, func, *args, **kwargs):
+        return self.submit_ex(func, args, kwargs)
+    
+    def submit_ex(self, func, args = (), kwargs = None, block = True):
+        if self.closed:
+            raise RuntimeError("The pool is shut down.")
+        future = Future()
+        self.queue.put((future, func, args, kwargs or {}), block)
+        with self.lock:
+            if self.idle < self.queue.qsize() and len(self.threads) < self.workers:
+                thread = threading.Thread(target = self.serve,
+                                          name = "%s-%d" % (self.name, len(self.threads), ))
+                thread.daemon = True
+                self.threads.append(thread)
+                thread.start()
+        return future
+    
+    def map(self, func, iterable, window = None):
+        """
+        Calls func for all the items, yields the results in the order of the
+        items. At most window calls (twice the number of threads by default)
+        are submitted ahead of the consumer.
+        """
+        window = window or 2 * self.workers
+        pending = []
+        for item in iterable:
+            pending.append(self.submit(func, item))
+            if len(pending) >= window:
+                yield pending.pop(0).result()
+        while pending:
+            yield pending.pop(0).result()
+    
+    def serve(self):
+        while True:
+            with self.lock:
+                self.idle += 1
+            task = self.queue.get()
+            with self.lock:
+                self.idle -= 1
+            if task is None:
+                return
+            future, func, args, kwargs = task
+            try:
+                future.set_result(func(*args, **kwargs))
+            except BaseException:
+                future.set_exc_info(sys.exc_info())
+    
+    def shutdown(self, wait = True):
+        """
+        Lets the threads finish the queued calls and stop.
+        """
+        self.closed = True
+        with self.lock:
+            threads = list(self.threads)
+        for thread in threads:
+            self.queue.put(None)
+        if wait:
+            for thread in threads:
+                thread.join()